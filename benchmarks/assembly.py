@@ -0,0 +1,66 @@
+"""
+Final assembly of piece files: the old compile loop (every piece file read whole into a new
+string and written on its own) against PieceDirStorage.finalize, which streams consecutive pieces
+through one fixed buffer.
+
+Writes synthetic piece files for a single file torrent, assembles them both ways and syncs the
+result.
+
+Usage (from the repository root):
+	python benchmarks/assembly.py [pieces] [piece length in kB]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.filemap import FileMap
+from coast.storage import PieceDirStorage
+
+
+def write_piece_files(storage, piece_count, piece_length):
+	block = os.urandom(piece_length)
+	for index in range(piece_count):
+		storage.write_piece(index, block)
+
+
+def piece_by_piece(storage, pieces):
+	for index in pieces:
+		with open(storage.get_piece_path(index), "rb") as piece_file:
+			storage.file_map.write_block(index, 0, piece_file.read())
+		os.remove(storage.get_piece_path(index))
+	os.rmdir(storage.directory)
+
+
+def main(piece_count, piece_length):
+	megabytes = piece_count * piece_length / (1024.0 * 1024)
+	print ("{} pieces of {} kB ({:.0f} MB)".format(piece_count, piece_length / 1024, megabytes))
+	for name in ("piece by piece", "fixed buffer"):
+		directory = tempfile.mkdtemp()
+		try:
+			file_map = FileMap([(["torrent.iso"], piece_count * piece_length)], piece_length, directory)
+			storage = PieceDirStorage(file_map, directory)
+			write_piece_files(storage, piece_count, piece_length)
+
+			start = time.time()
+			if name == "fixed buffer":
+				storage.finalize(range(piece_count))
+			else:
+				piece_by_piece(storage, range(piece_count))
+			file_map.close()
+			handle = os.open(file_map.paths[0], os.O_RDONLY)
+			os.fsync(handle)
+			os.close(handle)
+			elapsed = time.time() - start
+			print ("{:15} {:6.2f}s {:8.1f} MB/s".format(name, elapsed, megabytes / elapsed))
+		finally:
+			shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 2048,
+		 (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024)
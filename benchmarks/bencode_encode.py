@@ -0,0 +1,97 @@
+"""
+Compares the bencode encoders on metainfo-sized inputs.
+
+	bencode				the list-and-join encoder
+	BEncoder			one reusable encoder (reset between runs)
+	BEncoder -> file	encoder writing through to a file
+	Bencached info		BEncoder with the info dict pre-encoded (e.g. rewriting a .torrent)
+
+Usage (from the repository root):
+	python benchmarks/bencode_encode.py [repeats]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.bencode import bencode, bencached, BEncoder
+
+
+def single_file_metainfo(piece_count):
+	return {
+		"announce": "http://localhost:6969/announce",
+		"creation date": 1490000000,
+		"info": {
+			"name": "single-file",
+			"piece length": 256 * 1024,
+			"length": piece_count * 256 * 1024,
+			"pieces": "\x01" * (20 * piece_count)
+		}
+	}
+
+
+def multi_file_metainfo(file_count):
+	return {
+		"announce": "http://localhost:6969/announce",
+		"info": {
+			"name": "multi-file",
+			"piece length": 256 * 1024,
+			"files": [{"length": 1000 + index, "path": ["directory{}".format(index / 100), "file{}.dat".format(index)]}
+					  for index in range(file_count)],
+			"pieces": "\x01" * (20 * file_count / 100)
+		}
+	}
+
+
+def measure(function, repeats):
+	start = time.time()
+	for repeat in range(repeats):
+		function()
+	return (time.time() - start) / repeats
+
+
+def main(repeats):
+	inputs = [
+		("10k pieces", single_file_metainfo(10000)),
+		("1M pieces", single_file_metainfo(1000000)),
+		("10k files", multi_file_metainfo(10000)),
+		("100k files", multi_file_metainfo(100000)),
+	]
+	encoder = BEncoder()
+	sink = tempfile.TemporaryFile()
+	file_encoder = BEncoder(sink=sink)
+
+	print ("{0:12} {1:>10} {2:>10} {3:>10} {4:>16} {5:>10}".format(
+		"input", "MB", "bencode", "BEncoder", "BEncoder -> file", "Bencached"))
+	for name, metainfo in inputs:
+		expected = bencode(metainfo)
+		encoder.reset()
+		assert encoder.encode(metainfo).getvalue() == expected
+
+		def encode_reused():
+			encoder.reset()
+			encoder.encode(metainfo).getvalue()
+
+		def encode_to_file():
+			sink.seek(0)
+			file_encoder.encode(metainfo)
+
+		cached_metainfo = dict(metainfo, info=bencached(metainfo["info"]))
+
+		def encode_cached():
+			encoder.reset()
+			encoder.encode(cached_metainfo).getvalue()
+
+		print ("{0:12} {1:10.1f} {2:9.2f}ms {3:9.2f}ms {4:15.2f}ms {5:9.2f}ms".format(
+			name, len(expected) / (1024.0 * 1024),
+			measure(lambda: bencode(metainfo), repeats) * 1000,
+			measure(encode_reused, repeats) * 1000,
+			measure(encode_to_file, repeats) * 1000,
+			measure(encode_cached, repeats) * 1000))
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,268 @@
+"""
+Benchmark and conformance suite for coast/bencode.py.
+
+Generates synthetic payloads (metainfo with 10k to 1M pieces, a multi-file tree with 100k
+entries, tracker responses with 5k peers, deeply nested lists), checks that every decoder and
+encoder agrees on them, and records throughput and peak memory:
+
+	decode			bdecode, MB/s
+	decode_stream	BDecoder fed 16 kB chunks, MB/s
+	encode			bencode, MB/s
+	encode_buffer	BEncoder (reused), MB/s
+	decode_memory	peak RSS growth while decoding, MB
+
+Each payload runs in its own process so the memory figures don't mix. Throughput depends on the
+machine, so the baseline stores the streaming decoder and the reusable encoder as ratios against
+bdecode and bencode measured in the same run, along with the memory figures. The script exits
+with status 1 if any of these is worse than the baseline by more than the threshold.
+
+Usage (from the repository root):
+	python benchmarks/bencode_suite.py [--threshold 0.25] [--baseline FILE] [--update-baseline]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.bencode import bdecode, bdecode_spans, bencode, BDecoder, BEncoder
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bencode_baseline.json")
+STREAM_CHUNK_SIZE = 16 * 1024
+REPEATS = 3
+MIN_RUN_TIME = 0.05						# seconds
+# figures compared as a ratio against another figure of the same run (higher is better)
+RATIO_METRICS = {"decode_stream": "decode", "encode_buffer": "encode"}
+# figures compared as they are (lower is better)
+MEMORY_METRICS = ["decode_memory"]
+
+
+def metainfo(piece_count):
+	return {
+		"announce": "http://tracker.example.com:6969/announce",
+		"creation date": 1490000000,
+		"info": {
+			"name": "synthetic-{}".format(piece_count),
+			"piece length": 256 * 1024,
+			"length": piece_count * 256 * 1024,
+			"pieces": os.urandom(20 * piece_count)
+		}
+	}
+
+
+def multi_file_tree(file_count):
+	return {
+		"announce": "http://tracker.example.com:6969/announce",
+		"info": {
+			"name": "synthetic-tree",
+			"piece length": 4 * 1024 * 1024,
+			"files": [{
+				"length": random.randint(0, 10 ** 9),
+				"path": ["directory{}".format(index / 1000), "subdirectory{}".format(index / 100), "file{}.dat".format(index)]
+			} for index in range(file_count)],
+			"pieces": os.urandom(20 * (file_count / 10))
+		}
+	}
+
+
+def compact_tracker_response(peer_count):
+	return {"interval": 1800, "min interval": 900, "complete": peer_count / 2, "incomplete": peer_count / 2,
+			"peers": os.urandom(6 * peer_count)}
+
+
+def tracker_response(peer_count):
+	return {"interval": 1800, "complete": peer_count / 2, "incomplete": peer_count / 2,
+			"peers": [{"ip": "10.{}.{}.{}".format(index / 65536, index / 256 % 256, index % 256),
+					   "port": 6881 + index % 10,
+					   "peer id": os.urandom(20)} for index in range(peer_count)]}
+
+
+def deep_nesting(depth, copies):
+	nested = "leaf"
+	for level in range(depth):
+		nested = [nested, level]
+	return [nested] * copies
+
+
+PAYLOADS = [
+	("metainfo-10k", lambda: metainfo(10000)),
+	("metainfo-100k", lambda: metainfo(100000)),
+	("metainfo-1M", lambda: metainfo(1000000)),
+	("multi-file-100k", lambda: multi_file_tree(100000)),
+	("tracker-compact-5k", lambda: compact_tracker_response(5000)),
+	("tracker-dicts-5k", lambda: tracker_response(5000)),
+	("deep-nesting-200", lambda: deep_nesting(200, 500)),
+]
+
+
+def timed_run(function, iterations):
+	start = time.time()
+	for iteration in range(iterations):
+		function()
+	return time.time() - start
+
+
+def best_time(function):
+	"""
+	Returns the best time per call over REPEATS runs, each long enough (MIN_RUN_TIME) to time
+	"""
+	iterations = 1
+	elapsed = timed_run(function, iterations)
+	while elapsed < MIN_RUN_TIME:
+		iterations *= 2
+		elapsed = timed_run(function, iterations)
+
+	times = [elapsed] + [timed_run(function, iterations) for repeat in range(REPEATS - 1)]
+	return min(times) / iterations
+
+
+def decode_stream(data):
+	decoder = BDecoder()
+	for start in range(0, len(data), STREAM_CHUNK_SIZE):
+		decoder.feed(data[start:start + STREAM_CHUNK_SIZE])
+	return decoder.result()
+
+
+def check_conformance(name, value, data):
+	"""
+	Every decoder must return the value, and every encoder must reproduce the data
+	"""
+	failures = []
+	if bdecode(data) != value:
+		failures.append("bdecode")
+	decoded, spans = bdecode_spans(data)
+	if decoded != value or spans[()] != (0, len(data)):
+		failures.append("bdecode_spans")
+	if decode_stream(data) != value:
+		failures.append("BDecoder")
+	if bencode(value) != data:
+		failures.append("bencode")
+	if BEncoder().encode(value).getvalue() != data:
+		failures.append("BEncoder")
+	if failures:
+		raise AssertionError("{}: {} do not conform".format(name, ", ".join(failures)))
+
+
+def run_payload(name, path):
+	"""
+	Runs in a child process: measures one payload and prints its figures as json
+	"""
+	with open(path, "rb") as payload_file:
+		data = payload_file.read()
+	megabytes = len(data) / (1024.0 * 1024)
+
+	peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	value = bdecode(data)
+	# ru_maxrss is in kilobytes on linux
+	decode_memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before) / 1024.0
+
+	check_conformance(name, value, data)
+	encoder = BEncoder()
+
+	def encode_buffer():
+		encoder.reset()
+		encoder.encode(value).getvalue()
+
+	print (json.dumps({
+		"size": megabytes,
+		"decode": megabytes / best_time(lambda: bdecode(data)),
+		"decode_stream": megabytes / best_time(lambda: decode_stream(data)),
+		"encode": megabytes / best_time(lambda: bencode(value)),
+		"encode_buffer": megabytes / best_time(encode_buffer),
+		"decode_memory": decode_memory
+	}))
+
+
+def get_baseline_figures(figures):
+	"""
+	Returns the figures of a payload that are kept in the baseline
+	:param figures: dict of the payload's measurements
+	:return: dict of ratios and memory figures
+	"""
+	baseline_figures = {}
+	for metric, reference in RATIO_METRICS.items():
+		baseline_figures[metric] = figures[metric] / figures[reference]
+	for metric in MEMORY_METRICS:
+		baseline_figures[metric] = figures[metric]
+	return baseline_figures
+
+
+def compare(results, baseline, threshold):
+	"""
+	:return: list of regressions (strings), figures worse than the baseline by more than threshold
+	"""
+	regressions = []
+	for name, figures in sorted(results.items()):
+		for metric, value in sorted(get_baseline_figures(figures).items()):
+			if metric not in baseline.get(name, {}):
+				continue
+			expected = baseline[name][metric]
+			if metric in RATIO_METRICS:
+				worse = value < expected * (1 - threshold)
+			else:
+				# memory figures of a few MB are noise, so allow one MB on top of the threshold
+				worse = value > expected * (1 + threshold) + 1
+			if worse:
+				regressions.append("{} {}: {:.2f} (baseline {:.2f})".format(name, metric, value, expected))
+	return regressions
+
+
+def main(arguments):
+	random.seed(0)
+	directory = tempfile.mkdtemp()
+	results = {}
+	try:
+		for name, generate in PAYLOADS:
+			path = os.path.join(directory, name)
+			with open(path, "wb") as payload_file:
+				payload_file.write(bencode(generate()))
+			output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--payload", name, path])
+			results[name] = json.loads(output)
+			figures = results[name]
+			print ("{0:20} {1:8.1f} MB  decode {2:7.1f} MB/s  stream {3:7.1f} MB/s  encode {4:7.1f} MB/s  "
+				   "buffer {5:7.1f} MB/s  memory {6:6.1f} MB".format(
+						name, figures["size"], figures["decode"], figures["decode_stream"], figures["encode"],
+						figures["encode_buffer"], figures["decode_memory"]))
+	finally:
+		shutil.rmtree(directory)
+
+	if arguments.update_baseline:
+		baseline = dict((name, get_baseline_figures(figures)) for name, figures in results.items())
+		with open(arguments.baseline, "w") as baseline_file:
+			json.dump(baseline, baseline_file, indent=4, sort_keys=True)
+		print ("Baseline written to {}".format(arguments.baseline))
+		return 0
+
+	if not os.path.exists(arguments.baseline):
+		print ("No baseline at {} (run with --update-baseline)".format(arguments.baseline))
+		return 0
+
+	with open(arguments.baseline) as baseline_file:
+		regressions = compare(results, json.load(baseline_file), arguments.threshold)
+	if regressions:
+		print ("Regressions beyond {:.0%} of the baseline:".format(arguments.threshold))
+		for regression in regressions:
+			print ("  " + regression)
+		return 1
+	print ("No regressions beyond {:.0%} of the baseline".format(arguments.threshold))
+	return 0
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--payload":
+		run_payload(sys.argv[2], sys.argv[3])
+		sys.exit(0)
+
+	parser = argparse.ArgumentParser(description="bencode benchmark and conformance suite")
+	parser.add_argument("--threshold", type=float, default=0.25, help="allowed regression (fraction of the baseline)")
+	parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline json file")
+	parser.add_argument("--update-baseline", action="store_true", help="record the results as the new baseline")
+	sys.exit(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+"""
+Profiles the per-read work of a peer connection after the handshake.
+
+Feeds a connected PeerProtocol a stream of small reads (HAVE messages) and prints the time per
+read together with a cProfile listing of the hottest functions. For comparison it also times the
+bencode + SHA-1 of the info dict that used to be paid on every read (and for every new connection
+and StreamProcessor).
+
+Usage (from the repository root):
+	python benchmarks/connection_hot_path.py [reads]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import pstats
+import hashlib
+import cProfile
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast import bencode
+from coast.peer import Peer
+from coast.torrent import Torrent
+from coast.messages import HandshakeMessage, HaveMessage
+from coast.protocols import PeerFactory
+from coast.helpermethods import convert_int_to_hex
+
+TORRENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "test",
+							"ubuntu-16.10-desktop-amd64.iso.torrent")
+
+
+def connect(torrent):
+	peer = Peer(torrent, u"N\xe6\xcd2\xc5D")
+	factory = PeerFactory(torrent, Clock(), peer)
+	protocol = factory.buildProtocol(None)
+	protocol.makeConnection(StringTransport())
+	protocol.dataReceived(HandshakeMessage(info_hash=torrent.info_hash, peer_id="-XX0001-000000000000").message())
+	return protocol
+
+
+def feed(protocol, reads):
+	for index in range(reads):
+		protocol.dataReceived(HaveMessage(piece_index=convert_int_to_hex(index % 3040, 4)).message())
+		protocol.transport.clear()
+
+
+def main(reads):
+	torrent = Torrent("-CO0001-5208360bf90d", 6881, TORRENT_FILE)
+	protocol = connect(torrent)
+
+	start = time.time()
+	feed(protocol, reads)
+	per_read = (time.time() - start) / reads
+
+	start = time.time()
+	for index in range(reads):
+		hashlib.sha1(bencode.bencode(torrent.metadata["info"])).digest()
+	info_hash_cost = (time.time() - start) / reads
+
+	start = time.time()
+	for index in range(100):
+		connect(torrent)
+	per_connection = (time.time() - start) / 100
+
+	print ("{} reads of {} pieces".format(reads, len(torrent.pieces_hashes)))
+	print ("per read:                        {0:8.1f} us".format(per_read * 10 ** 6))
+	print ("per connection (incl. handshake): {0:8.1f} us".format(per_connection * 10 ** 6))
+	print ("info hash recomputation (was paid per read): {0:8.1f} us".format(info_hash_cost * 10 ** 6))
+
+	profiler = cProfile.Profile()
+	profiler.enable()
+	feed(protocol, reads)
+	profiler.disable()
+	pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
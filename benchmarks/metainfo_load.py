@@ -0,0 +1,99 @@
+"""
+Load time and memory benchmark for metainfo (.torrent) files.
+
+Writes a synthetic single-file torrent with a million pieces (20 MB of piece hashes) and loads it
+in a fresh process per mode, reporting the wall time and peak RSS of each:
+
+	legacy	bdecode, split `pieces` into a list of 20-byte strings, re-bencode `info` for the hash
+	spans	bdecode_spans, PieceHashes over the pieces string, SHA-1 of the original info span
+	torrent	a full Torrent object built from the file
+
+Usage (from the repository root):
+	python benchmarks/metainfo_load.py [pieces]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import hashlib
+import resource
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast import bencode
+from coast.piece import PieceHashes
+
+PIECE_LENGTH = 256 * 1024
+TORRENT_NAME = "coast-metainfo-benchmark"
+
+
+def write_torrent(path, piece_count):
+	metainfo = {
+		"announce": "http://localhost:6969/announce",
+		"info": {
+			"name": TORRENT_NAME,
+			"piece length": PIECE_LENGTH,
+			"length": piece_count * PIECE_LENGTH,
+			"pieces": os.urandom(20 * piece_count)
+		}
+	}
+	with open(path, "wb") as torrent_file:
+		torrent_file.write(bencode.bencode(metainfo))
+
+
+def load_legacy(path):
+	with open(path, "rb") as torrent_file:
+		decoded = bencode.bdecode(torrent_file.read())
+	pieces = decoded["info"]["pieces"]
+	hashes = [pieces[x:x + 20] for x in range(0, len(pieces), 20)]
+	info_hash = hashlib.sha1(bencode.bencode(decoded["info"])).digest()
+	return hashes, info_hash
+
+
+def load_spans(path):
+	with open(path, "rb") as torrent_file:
+		data = torrent_file.read()
+	decoded, spans = bencode.bdecode_spans(data)
+	hashes = PieceHashes(decoded["info"]["pieces"])
+	info_start, info_end = spans[("info",)]
+	info_hash = hashlib.sha1(memoryview(data)[info_start:info_end]).digest()
+	return hashes, info_hash
+
+
+def load_torrent(path):
+	from coast.torrent import Torrent
+	torrent = Torrent("-CO0001-5208360bf90d", 6881, path)
+	shutil.rmtree(torrent.download_root, ignore_errors=True)
+	return torrent.pieces_hashes, torrent.info_hash
+
+
+def run_mode(mode, path):
+	start = time.time()
+	hashes, info_hash = {"legacy": load_legacy, "spans": load_spans, "torrent": load_torrent}[mode](path)
+	elapsed = time.time() - start
+	# ru_maxrss is in kilobytes on linux
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+	print ("{0:8} {1:8.3f}s {2:9.1f} MB  {3} pieces  {4}".format(
+		mode, elapsed, peak_rss, len(hashes), info_hash.encode("hex")))
+
+
+def main(piece_count):
+	directory = tempfile.mkdtemp()
+	path = os.path.join(directory, "synthetic.torrent")
+	try:
+		write_torrent(path, piece_count)
+		print ("{} pieces, {:.1f} MB metainfo".format(piece_count, os.path.getsize(path) / (1024.0 * 1024)))
+		for mode in ("legacy", "spans", "torrent"):
+			subprocess.check_call([sys.executable, os.path.abspath(__file__), "--mode", mode, path])
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--mode":
+		run_mode(sys.argv[2], sys.argv[3])
+	else:
+		main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
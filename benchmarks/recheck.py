@@ -0,0 +1,75 @@
+"""
+Recheck throughput: the serial loop (one process hashing piece after piece) against the
+process pool used by Recheck.
+
+Writes synthetic piece files to a temporary directory and hashes them both ways.
+
+Usage (from the repository root):
+	python benchmarks/recheck.py [pieces] [piece length in kB] [processes]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from bitarray import bitarray
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.recheck import Recheck
+from coast.filemap import FileMap
+from coast.storage import PieceDirStorage
+
+
+class SyntheticTorrent:
+	def __init__(self, directory, piece_count, piece_length):
+		self.storage = PieceDirStorage(FileMap([(["data"], piece_count * piece_length)], piece_length, directory), directory)
+		self.pieces_hashes = []
+		self.bitfield = bitarray(piece_count, endian="big")
+		self.bitfield.setall(False)
+		block = os.urandom(piece_length)
+		for index in range(piece_count):
+			data = str(index).zfill(8) + block[8:]
+			self.storage.write_piece(index, data)
+			self.pieces_hashes.append(hashlib.sha1(data).digest())
+
+
+def serial_recheck(torrent):
+	for index in range(len(torrent.pieces_hashes)):
+		if hashlib.sha1(torrent.storage.read_piece(index)).digest() == torrent.pieces_hashes[index]:
+			torrent.bitfield[index] = 1
+
+
+def main(piece_count, piece_length, processes):
+	directory = tempfile.mkdtemp()
+	try:
+		torrent = SyntheticTorrent(directory, piece_count, piece_length)
+		megabytes = piece_count * piece_length / (1024.0 * 1024)
+
+		start = time.time()
+		serial_recheck(torrent)
+		serial_time = time.time() - start
+		assert torrent.bitfield.all()
+
+		torrent.bitfield.setall(False)
+		start = time.time()
+		Recheck(torrent, processes=processes).run()
+		parallel_time = time.time() - start
+		assert torrent.bitfield.all()
+
+		print ("{} pieces of {} kB ({:.0f} MB), {} cpus".format(
+			piece_count, piece_length / 1024, megabytes, multiprocessing.cpu_count()))
+		print ("serial:             {0:6.2f}s {1:8.1f} MB/s".format(serial_time, megabytes / serial_time))
+		print ("Recheck ({} procs): {:6.2f}s {:8.1f} MB/s".format(
+			processes or multiprocessing.cpu_count(), parallel_time, megabytes / parallel_time))
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+		 (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024,
+		 int(sys.argv[3]) if len(sys.argv) > 3 else 0)
@@ -0,0 +1,89 @@
+"""
+Storage backends: piece files, seek + write / read through the FileHandlePool (coast's stand-in
+for pwrite / pread, which Python 2 lacks), memory mapped files, a pack file and memory (the
+baseline without the disk).
+
+The download workload writes every verified piece of a multiple file torrent in a random order
+and then flushes it to disk. The seeding workload reads random 16 kB blocks, as peers request
+them.
+
+Usage (from the repository root):
+	python benchmarks/storage_backends.py [files] [pieces] [piece length in kB] [block reads]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.filemap import FileMap
+from coast.storage import PieceDirStorage, FileStorage, MemoryStorage
+from coast.mmapstorage import MmapStorage
+from coast.packstorage import PackStorage
+from coast.constants import REQUEST_SIZE
+
+
+def build_file_map(directory, file_count, total_length, piece_length):
+	file_length = total_length / file_count
+	files = [(["file{}".format(i)], file_length) for i in range(file_count - 1)]
+	files.append((["file{}".format(file_count - 1)], total_length - file_length * (file_count - 1)))
+	return FileMap(files, piece_length, directory)
+
+
+def download(storage, piece_data):
+	file_map = storage.file_map
+	piece_count = (file_map.total_length + file_map.piece_length - 1) / file_map.piece_length
+	order = range(piece_count)
+	random.shuffle(order)
+	start = time.time()
+	for index in order:
+		storage.write_piece(index, piece_data[:file_map.get_piece_length(index)])
+	storage.flush()
+	return time.time() - start
+
+
+def seed(storage, requests):
+	start = time.time()
+	for index, begin in requests:
+		block = storage.read_block(index, begin, REQUEST_SIZE)
+		assert len(block) == REQUEST_SIZE
+		# what the transport gets
+		str(block)
+	return time.time() - start
+
+
+def main(file_count, piece_count, piece_length, block_reads):
+	random.seed(1)
+	piece_data = os.urandom(piece_length)
+	megabytes = piece_count * piece_length / (1024.0 * 1024)
+	requests = [(random.randrange(piece_count), random.randrange(piece_length / REQUEST_SIZE) * REQUEST_SIZE)
+				for i in range(block_reads)]
+	seed_megabytes = block_reads * REQUEST_SIZE / (1024.0 * 1024)
+
+	print ("{} files, {} pieces of {} kB ({:.0f} MB), {} block reads".format(
+		file_count, piece_count, piece_length / 1024, megabytes, block_reads))
+	for name, backend in (("piece files", PieceDirStorage), ("pwrite / pread", FileStorage), ("mmap", MmapStorage),
+						  ("pack file", PackStorage), ("memory", MemoryStorage)):
+		directory = tempfile.mkdtemp()
+		try:
+			file_map = build_file_map(directory, file_count, piece_count * piece_length, piece_length)
+			storage = backend(file_map, directory)
+			download_time = download(storage, piece_data)
+			seed_time = seed(storage, requests)
+			storage.close()
+
+			print ("{:15} download {:6.2f}s {:8.1f} MB/s   seeding {:6.2f}s {:8.1f} MB/s".format(
+				name, download_time, megabytes / download_time, seed_time, seed_megabytes / seed_time))
+		finally:
+			shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+		 int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+		 (int(sys.argv[3]) if len(sys.argv) > 3 else 256) * 1024,
+		 int(sys.argv[4]) if len(sys.argv) > 4 else 50000)
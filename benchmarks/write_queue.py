@@ -0,0 +1,89 @@
+"""
+Write-behind queue: verified pieces written to the torrent's files one at a time (syncing after
+every piece, or on a timer) against the WriteQueue, which holds them back and coalesces runs of
+consecutive pieces.
+
+Pieces are written in a random order, as rarest first hands them out, and the storage is synced
+every [sync MB] of pieces, standing in for the torrent's flush timer. The os calls the storage
+makes are counted by wrapping them.
+
+Usage (from the repository root):
+	python benchmarks/write_queue.py [pieces] [piece length in kB] [sync MB] [max dirty MB]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from coast.filemap import FileMap
+from coast.storage import FileStorage
+from coast.writequeue import WriteQueue
+
+COUNTED_CALLS = ("open", "lseek", "write", "fsync", "close")
+calls = {"count": 0}
+
+
+def counted(call):
+	def counted_call(*arguments, **keywords):
+		calls["count"] += 1
+		return call(*arguments, **keywords)
+	return counted_call
+
+
+def count_calls():
+	for name in COUNTED_CALLS:
+		setattr(os, name, counted(getattr(os, name)))
+
+
+def run(name, piece_count, piece_length, sync_pieces, max_dirty, piece_data):
+	directory = tempfile.mkdtemp()
+	try:
+		storage = FileStorage(FileMap([(["file"], piece_count * piece_length)], piece_length, directory), directory)
+		queue = WriteQueue(storage, max_dirty=max_dirty)
+		order = range(piece_count)
+		random.seed(1)
+		random.shuffle(order)
+
+		calls["count"] = 0
+		start = time.time()
+		for position, index in enumerate(order):
+			if name == "write behind":
+				queue.put(index, piece_data)
+			else:
+				storage.write_piece(index, piece_data)
+			if name == "sync per piece":
+				storage.flush()
+			elif (position + 1) % sync_pieces == 0:
+				queue.flush()
+		queue.flush()
+		elapsed = time.time() - start
+		storage.close()
+
+		gigabytes = piece_count * piece_length / (1024.0 ** 3)
+		print ("{:15} {:6.2f}s {:8.1f} MB/s {:10.0f} calls / GB".format(
+			name, elapsed, gigabytes * 1024 / elapsed, calls["count"] / gigabytes))
+	finally:
+		shutil.rmtree(directory)
+
+
+def main(piece_count, piece_length, sync_bytes, max_dirty):
+	piece_data = os.urandom(piece_length)
+	sync_pieces = max(1, sync_bytes / piece_length)
+	print ("{} pieces of {} kB ({:.0f} MB), synced every {} pieces, {} MB held back at most".format(
+		piece_count, piece_length / 1024, piece_count * piece_length / (1024.0 * 1024), sync_pieces,
+		max_dirty / (1024 * 1024)))
+	count_calls()
+	for name in ("sync per piece", "per piece", "write behind"):
+		run(name, piece_count, piece_length, sync_pieces, max_dirty, piece_data)
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+		 (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024,
+		 (int(sys.argv[3]) if len(sys.argv) > 3 else 128) * 1024 * 1024,
+		 (int(sys.argv[4]) if len(sys.argv) > 4 else 64) * 1024 * 1024)
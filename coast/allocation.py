@@ -0,0 +1,66 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+
+"""
+Disk space helpers: preallocating files and measuring allocated and free space.
+
+Pieces arrive rarest first, so without preallocation a file's blocks are allocated in the order
+its pieces happen to arrive and end up scattered over the disk (on ext4 / xfs as much as
+anywhere), which slows down seeding and reading the finished file. posix_fallocate reserves all
+of them up front, ideally contiguously. Python 2's os module doesn't have it, so it is called
+from libc; where it isn't available (or the filesystem doesn't support it) the file is extended
+sparsely instead. Running out of space is an error, not a reason to fall back.
+"""
+
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	posix_fallocate = getattr(libc, "posix_fallocate64", None) or libc.posix_fallocate
+	posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+	posix_fallocate = None
+
+
+def preallocate(handle, length):
+	"""
+	Reserves the disk blocks for the first length bytes of a file, or extends it sparsely to that
+	length if the filesystem can't reserve them
+	:param handle: file descriptor, open for writing
+	:param length: bytes to allocate
+	:raises IOError: if the blocks can't be reserved for another reason (e.g. ENOSPC)
+	:return: True if the blocks were reserved
+	"""
+	if posix_fallocate is not None:
+		# the error is returned, errno isn't set
+		error = posix_fallocate(handle, 0, length)
+		if error == 0:
+			return True
+		if error not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+			raise IOError(error, os.strerror(error))
+	if os.fstat(handle).st_size < length:
+		os.ftruncate(handle, length)
+	return False
+
+
+def get_allocated_bytes(path):
+	"""
+	Returns the disk space taken by a file (less than its size if it is sparse)
+	:param path: path of the file
+	:return: bytes (0 if the file doesn't exist)
+	"""
+	if not os.path.isfile(path):
+		return 0
+	return os.stat(path).st_blocks * 512
+
+
+def get_free_bytes(path):
+	"""
+	Returns the space available to us on the filesystem a path is (or would be) on
+	:param path: path, which doesn't have to exist yet
+	:return: bytes
+	"""
+	while not os.path.exists(path) and os.path.dirname(path) != path:
+		path = os.path.dirname(path)
+	status = os.statvfs(path)
+	return status.f_bavail * status.f_frsize
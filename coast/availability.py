@@ -0,0 +1,144 @@
+import numpy
+
+from constants import MAX_PEERS
+
+"""
+This class keeps track of which connected peers have which pieces of a torrent.
+
+Bitfields are stored as a packed (peers x pieces) bit matrix, one row per peer, alongside a
+per-piece availability vector (the number of connected peers that have each piece). BITFIELD and
+HAVE messages update a whole row (or a single bit) with numpy operations so that swarm-wide
+questions like "who has piece i" or "which wanted pieces are rarest" never loop over peers in
+Python.
+"""
+
+
+class AvailabilityMatrix:
+	def __init__(self, piece_count, initial_rows=MAX_PEERS):
+		self.piece_count = piece_count
+		self.row_bytes = (piece_count + 7) / 8
+		self.bits = numpy.zeros((initial_rows, self.row_bytes), dtype=numpy.uint8)
+		self.availability = numpy.zeros(piece_count, dtype=numpy.int32)
+		self.rows = {}
+		self.row_peers = [None] * initial_rows
+
+	def unpack_row(self, packed_row):
+		return numpy.unpackbits(packed_row)[:self.piece_count].astype(numpy.int32)
+
+	def get_row(self, peer):
+		"""
+		Returns the row of the given peer, giving it a free one (and growing the matrix if needed)
+		if it doesn't have one yet
+		:param peer: Peer (or any hashable peer key)
+		:return: row index
+		"""
+		if peer in self.rows:
+			return self.rows[peer]
+
+		if None not in self.row_peers:
+			extra_rows = len(self.row_peers)
+			self.bits = numpy.vstack((self.bits, numpy.zeros((extra_rows, self.row_bytes), dtype=numpy.uint8)))
+			self.row_peers += [None] * extra_rows
+
+		row = self.row_peers.index(None)
+		self.row_peers[row] = peer
+		self.rows[peer] = row
+		return row
+
+	def set_bitfield(self, peer, bitfield_bytes):
+		"""
+		Replaces the peer's row with the given (big endian, BITFIELD message style) bitfield
+		:param peer: Peer the bitfield came from
+		:param bitfield_bytes: byte-string with one bit per piece
+		:return: void
+		"""
+		row = self.get_row(peer)
+		new_row = numpy.zeros(self.row_bytes, dtype=numpy.uint8)
+		received = numpy.frombuffer(bitfield_bytes[:self.row_bytes], dtype=numpy.uint8)
+		new_row[:len(received)] = received
+		# clear the spare bits at the end of the last byte
+		if self.piece_count % 8 != 0:
+			new_row[-1] &= (0xff << (8 - self.piece_count % 8)) & 0xff
+
+		self.availability += self.unpack_row(new_row) - self.unpack_row(self.bits[row])
+		self.bits[row] = new_row
+
+	def add_piece(self, peer, index):
+		"""
+		Records a HAVE message
+		:param peer: Peer the message came from
+		:param index: index of the piece the peer now has
+		:return: void
+		"""
+		row = self.get_row(peer)
+		byte, mask = index / 8, 0x80 >> (index % 8)
+		if not self.bits[row, byte] & mask:
+			self.bits[row, byte] |= mask
+			self.availability[index] += 1
+
+	def remove_peer(self, peer):
+		"""
+		Forgets a (disconnected) peer and the pieces it contributed to the swarm
+		:param peer: Peer to remove
+		:return: void
+		"""
+		if peer not in self.rows:
+			return
+
+		row = self.rows.pop(peer)
+		self.availability -= self.unpack_row(self.bits[row])
+		self.bits[row] = 0
+		self.row_peers[row] = None
+
+	def get_peer_pieces(self, peer):
+		"""
+		Returns a boolean vector of the pieces the peer has
+		:param peer: Peer
+		:return: numpy bool array (one entry per piece)
+		"""
+		if peer not in self.rows:
+			return numpy.zeros(self.piece_count, dtype=bool)
+		return self.unpack_row(self.bits[self.rows[peer]]).astype(bool)
+
+	def peers_with_piece(self, index):
+		"""
+		Returns the peers that have the given piece (a single column of the matrix)
+		:param index: index of the piece
+		:return: list of peers
+		"""
+		byte, mask = index / 8, 0x80 >> (index % 8)
+		return [self.row_peers[row] for row in numpy.flatnonzero(self.bits[:, byte] & mask)]
+
+	def rarest_wanted(self, wanted, count=1):
+		"""
+		Returns up to `count` of the wanted pieces that the fewest connected peers have (pieces
+		nobody has are skipped), rarest first with ties broken by index.
+
+		:param wanted: numpy bool array, one entry per piece
+		:param count: maximum number of pieces to return
+		:return: list of piece indices
+		"""
+		candidates = numpy.flatnonzero(wanted & (self.availability > 0))
+		if len(candidates) == 0:
+			return []
+
+		counts = self.availability[candidates]
+		if count < len(candidates):
+			# keep every piece tied with the count-th rarest so that ties are broken by index
+			rarest = counts <= numpy.partition(counts, count - 1)[count - 1]
+			candidates, counts = candidates[rarest], counts[rarest]
+
+		order = numpy.lexsort((candidates, counts))
+		return candidates[order][:count].tolist()
+
+	def distributed_copies(self):
+		"""
+		Returns the number of complete copies of the torrent among the connected peers: the
+		availability of the rarest piece plus the fraction of pieces that are more common than it.
+		:return: float
+		"""
+		if self.piece_count == 0:
+			return 0.0
+
+		minimum = self.availability.min()
+		return float(minimum) + float(numpy.count_nonzero(self.availability > minimum)) / self.piece_count
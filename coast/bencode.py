@@ -63,15 +63,228 @@ decode_func['7'] = decode_string
 decode_func['8'] = decode_string
 decode_func['9'] = decode_string
 
+def describe_input(x):
+    """
+    Short description of a (possibly multi-MB) input for error messages
+    """
+    return "{} bytes starting {!r}".format(len(x), x[:32])
+
 def bdecode(x):
     try:
         r, l = decode_func[x[0]](x, 0)
     except (IndexError, KeyError, ValueError):
-        raise BTFailure("not a valid bencoded string\ninput:{}".format(x))
+        raise BTFailure("not a valid bencoded string ({})".format(describe_input(x)))
     if l != len(x):
-        raise BTFailure("invalid bencoded value (data after valid prefix)\ninput:{}".format(x))
+        raise BTFailure("invalid bencoded value (data after valid prefix at offset {}, {})".format(l, describe_input(x)))
     return r
 
+def decode_list_spans(x, f, path, spans):
+    r, f = [], f+1
+    while x[f] != 'e':
+        start = f
+        v, f = decode_spans(x, f, path + (len(r),), spans)
+        spans[path + (len(r),)] = (start, f)
+        r.append(v)
+    return (r, f + 1)
+
+def decode_dict_spans(x, f, path, spans):
+    r, f = {}, f+1
+    while x[f] != 'e':
+        k, f = decode_string(x, f)
+        start = f
+        r[k], f = decode_spans(x, f, path + (k,), spans)
+        spans[path + (k,)] = (start, f)
+    return (r, f + 1)
+
+def decode_spans(x, f, path, spans):
+    if x[f] == 'd':
+        return decode_dict_spans(x, f, path, spans)
+    if x[f] == 'l':
+        return decode_list_spans(x, f, path, spans)
+    return decode_func[x[f]](x, f)
+
+def bdecode_spans(x):
+    """
+    Decodes like bdecode, and also returns where every value sits in the input: a dict mapping the
+    path of each value (a tuple of dict keys and list indices, () for the whole input) to its
+    (start, end) byte offsets. x[start:end] is the original encoding of the value, so it can be
+    hashed or copied without re-encoding (e.g. spans[("info",)] for the info-hash).
+    """
+    spans = {}
+    try:
+        r, l = decode_spans(x, 0, (), spans)
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string ({})".format(describe_input(x)))
+    if l != len(x):
+        raise BTFailure("invalid bencoded value (data after valid prefix at offset {}, {})".format(l, describe_input(x)))
+    spans[()] = (0, l)
+    return r, spans
+
+# longest integer token ("i...e") and string length prefix the incremental decoder will wait for
+MAX_INT_TOKEN = 64
+MAX_LENGTH_PREFIX = 20
+
+class BDecoder(object):
+    """
+    Incremental bencode decoder for input that arrives in chunks (HTTP or UDP tracker responses,
+    metadata exchange). Chunks are passed to feed() as they arrive. Nothing is re-parsed, and
+    buffered data is only joined once there is enough of it to make progress.
+
+    The limits guard against hostile input: max_size caps the total input (a string longer
+    than what is left is rejected from its length prefix, before it is buffered), max_depth caps
+    the nesting of lists and dicts, and max_elements caps the number of decoded values. None means
+    unlimited. Errors raise BTFailure with the offset of the problem, never the input itself.
+    """
+
+    def __init__(self, max_size=None, max_depth=None, max_elements=None):
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.max_elements = max_elements
+        self.chunks = []
+        self.buffered = 0
+        # bytes that must be buffered before parsing can make progress
+        self.needed = 1
+        # input offset of the first buffered byte
+        self.offset = 0
+        self.received = 0
+        self.elements = 0
+        # open containers, as [container, key, has_key] (the key is only used by dicts)
+        self.stack = []
+        self.value = None
+        self.complete = False
+
+    def fail(self, reason, position):
+        raise BTFailure("{} at offset {}".format(reason, self.offset + position))
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        if self.complete:
+            self.fail("data after complete value", self.buffered)
+        self.received += len(chunk)
+        if self.max_size is not None and self.received > self.max_size:
+            raise BTFailure("input larger than {} bytes".format(self.max_size))
+
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= self.needed:
+            self.parse()
+
+    def parse(self):
+        data = ''.join(self.chunks)
+        position = 0
+        needed = 0
+        while not self.complete and needed == 0:
+            needed, position = self.parse_token(data, position)
+
+        if self.complete and position != len(data):
+            self.fail("data after complete value", position)
+        remaining = data[position:]
+        self.chunks = [remaining] if remaining else []
+        self.buffered = len(remaining)
+        self.offset += position
+        self.needed = max(needed, 1)
+
+    def parse_token(self, data, position):
+        """
+        Parses one token starting at the given position
+        :return: (bytes needed from position before the token can be parsed (0 if it was parsed), new position)
+        """
+        if position >= len(data):
+            return 1, position
+
+        token = data[position]
+        if token == 'e':
+            if not self.stack:
+                self.fail("unexpected end marker", position)
+            container, key, has_key = self.stack.pop()
+            if has_key:
+                self.fail("dict key without a value", position)
+            self.add_value(container, position)
+            return 0, position + 1
+
+        if token == 'i':
+            end = data.find('e', position + 1)
+            if end == -1:
+                if len(data) - position > MAX_INT_TOKEN:
+                    self.fail("integer too long", position)
+                return len(data) - position + 1, position
+            digits = data[position + 1:end]
+            if not digits or digits == '-' or (digits[0] == '0' and len(digits) > 1) or digits.startswith('-0'):
+                self.fail("invalid integer", position)
+            try:
+                value = int(digits)
+            except ValueError:
+                self.fail("invalid integer", position)
+            self.count_element(position)
+            self.add_value(value, position)
+            return 0, end + 1
+
+        if token.isdigit():
+            colon = data.find(':', position)
+            if colon == -1:
+                if len(data) - position > MAX_LENGTH_PREFIX:
+                    self.fail("string length too long", position)
+                return len(data) - position + 1, position
+            prefix = data[position:colon]
+            if not prefix.isdigit() or (prefix[0] == '0' and len(prefix) > 1):
+                self.fail("invalid string length", position)
+            length = int(prefix)
+            end = colon + 1 + length
+            if self.max_size is not None and self.offset + end > self.max_size:
+                self.fail("string of {} bytes exceeds the {} byte limit".format(length, self.max_size), position)
+            if end > len(data):
+                return end - position, position
+            self.count_element(position)
+            self.add_value(data[colon + 1:end], position, string=True)
+            return 0, end
+
+        if token == 'l' or token == 'd':
+            if self.max_depth is not None and len(self.stack) >= self.max_depth:
+                self.fail("nesting deeper than {}".format(self.max_depth), position)
+            self.check_not_key(position)
+            self.count_element(position)
+            self.stack.append([[] if token == 'l' else {}, None, False])
+            return 0, position + 1
+
+        self.fail("unexpected byte {!r}".format(token), position)
+
+    def check_not_key(self, position):
+        if self.stack and isinstance(self.stack[-1][0], dict) and not self.stack[-1][2]:
+            self.fail("dict key is not a string", position)
+
+    def count_element(self, position):
+        self.elements += 1
+        if self.max_elements is not None and self.elements > self.max_elements:
+            self.fail("more than {} elements".format(self.max_elements), position)
+
+    def add_value(self, value, position, string=False):
+        if not self.stack:
+            self.value = value
+            self.complete = True
+            return
+
+        frame = self.stack[-1]
+        if isinstance(frame[0], list):
+            frame[0].append(value)
+        elif frame[2]:
+            frame[0][frame[1]] = value
+            frame[1], frame[2] = None, False
+        elif string:
+            frame[1], frame[2] = value, True
+        else:
+            self.fail("dict key is not a string", position)
+
+    def result(self):
+        """
+        Returns the decoded value once the input is complete
+        """
+        if not self.complete:
+            raise BTFailure("incomplete bencoded value ({} bytes received)".format(self.received))
+        return self.value
+
+import sys
+from collections import OrderedDict
 from types import StringType, IntType, LongType, DictType, ListType, TupleType
 
 
@@ -120,14 +333,143 @@ encode_func[StringType] = encode_string
 encode_func[ListType] = encode_list
 encode_func[TupleType] = encode_list
 encode_func[DictType] = encode_dict
+encode_func[OrderedDict] = encode_dict
 
 try:
     from types import BooleanType
     encode_func[BooleanType] = encode_bool
 except ImportError:
-    pass
+    BooleanType = None
 
 def bencode(x):
     r = []
     encode_func[type(x)](x, r)
     return ''.join(r)
+
+def bencached(x):
+    """
+    Encodes a value once, for embedding in later encodings (e.g. the info dict of a torrent)
+    """
+    return Bencached(bencode(x))
+
+class BEncoder(object):
+    """
+    Reusable bencode encoder that can stream its output to a file-like sink (anything with
+    write()). Fragments are collected in a list that is kept between encodings and, with a
+    sink, written out whenever enough of them have piled up, so large outputs never have to be
+    held in memory whole. Long strings are written to the sink as they are, without being copied.
+
+    Without a sink (and with sorted keys) values are encoded by the same functions as bencode(),
+    which are the fastest for nested containers such as the file list of a multi-file torrent.
+    With a sink, Bencached values are copied in as they are and strings and ints inside lists and
+    dicts are encoded inline rather than through the type table. With sort_keys=False dict keys are
+    written in iteration order, which is only valid bencode if the caller knows they are
+    already ordered (e.g. an OrderedDict built in key order).
+    """
+
+    def __init__(self, sink=None, sort_keys=True, flush_size=4096):
+        """
+        :param sink: file-like object the output is written to (None to keep it in memory)
+        :param sort_keys: sort dict keys (False if the keys are known to be ordered)
+        :param flush_size: fragments (and bytes for a single string) held before writing to the sink
+        """
+        self.fragments = []
+        self.sink = sink
+        self.sort_keys = sort_keys
+        self.flush_size = flush_size
+        self.inline_limit = flush_size if sink is not None else sys.maxint
+        self.encoders = {
+            Bencached: self.encode_bencached,
+            IntType: self.encode_int,
+            LongType: self.encode_int,
+            StringType: self.encode_string,
+            ListType: self.encode_list,
+            TupleType: self.encode_list,
+            DictType: self.encode_dict,
+            OrderedDict: self.encode_dict
+        }
+        if BooleanType is not None:
+            self.encoders[BooleanType] = self.encode_int
+
+    def encode(self, x):
+        """
+        Encodes a value (written on to the sink, if there is one)
+        :return: self
+        """
+        if self.sink is None and self.sort_keys:
+            encode_func[type(x)](x, self.fragments)
+            return self
+        self.encoders[type(x)](x)
+        if self.sink is not None:
+            self.flush()
+        return self
+
+    def getvalue(self):
+        return ''.join(self.fragments)
+
+    def reset(self):
+        """
+        Forgets the encoded output so the encoder can be used again
+        """
+        del self.fragments[:]
+
+    def flush(self):
+        if self.sink is not None and self.fragments:
+            self.sink.write(''.join(self.fragments))
+            del self.fragments[:]
+
+    def encode_bencached(self, x):
+        self.encode_string_data(x.bencoded)
+
+    def encode_int(self, x):
+        self.fragments.extend(('i', str(int(x)), 'e'))
+
+    def encode_string(self, x):
+        self.fragments.append(str(len(x)) + ':')
+        self.encode_string_data(x)
+
+    def encode_string_data(self, x):
+        if self.sink is not None and len(x) >= self.flush_size:
+            self.flush()
+            self.sink.write(x)
+        else:
+            self.fragments.append(x)
+
+    def encode_list(self, x):
+        fragments = self.fragments
+        encoders = self.encoders
+        # strings longer than this are left to encode_string (so they can go straight to the sink)
+        inline_limit = self.inline_limit
+        fragments.append('l')
+        for v in x:
+            t = type(v)
+            if t is StringType and len(v) < inline_limit:
+                fragments.extend((str(len(v)), ':', v))
+            elif t is IntType:
+                fragments.extend(('i', str(v), 'e'))
+            else:
+                encoders[t](v)
+        fragments.append('e')
+        if len(fragments) >= inline_limit:
+            self.flush()
+
+    def encode_dict(self, x):
+        fragments = self.fragments
+        encoders = self.encoders
+        inline_limit = self.inline_limit
+        fragments.append('d')
+        items = x.items()
+        if self.sort_keys:
+            items.sort()
+        for k, v in items:
+            fragments.extend((str(len(k)), ':', k))
+            t = type(v)
+            if t is StringType and len(v) < inline_limit:
+                fragments.extend((str(len(v)), ':', v))
+            elif t is IntType:
+                fragments.extend(('i', str(v), 'e'))
+            else:
+                encoders[t](v)
+        fragments.append('e')
+        if len(fragments) >= inline_limit:
+            self.flush()
@@ -0,0 +1,114 @@
+import math
+import time
+import random
+from twisted.internet import reactor, task
+
+from constants import CHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_INTERVAL, DEFAULT_UPLOAD_SLOTS, UPLOAD_RATE_LIMIT
+
+"""
+This class decides which of a torrent's peers we upload to (tit-for-tat choking).
+
+Every CHOKE_INTERVAL seconds the peers that give us the best download rate (or that take the best
+upload rate from us once we are seeding) are unchoked. Every OPTIMISTIC_UNCHOKE_INTERVAL seconds
+one extra, randomly chosen peer is unchoked so that new peers get a chance to prove themselves.
+"""
+
+
+class Choker:
+	def __init__(self, torrent, upload_rate_limit=UPLOAD_RATE_LIMIT):
+		self.torrent = torrent
+		self.upload_rate_limit = upload_rate_limit
+		self.optimistic_peer = None
+		self.rounds = 0
+		self.looping_call = None
+
+	def start(self, clock=reactor):
+		"""
+		Schedules the choking rounds on the given clock (the reactor by default)
+		:param clock: IReactorTime provider
+		:return: void
+		"""
+		self.looping_call = task.LoopingCall(self.run_round)
+		self.looping_call.clock = clock
+		self.looping_call.start(CHOKE_INTERVAL, now=False)
+
+	def stop(self):
+		if self.looping_call is not None and self.looping_call.running:
+			self.looping_call.stop()
+		self.looping_call = None
+
+	def get_upload_slots(self):
+		"""
+		Returns the number of peers we upload to at once (including the optimistic slot). Scales
+		with the configured upload rate so that each slot gets a useful share of the bandwidth.
+
+		:return: int
+		"""
+		if self.upload_rate_limit <= 0:
+			return DEFAULT_UPLOAD_SLOTS
+
+		kbps = self.upload_rate_limit / 1024.0
+		if kbps < 9:
+			return 2
+		elif kbps < 15:
+			return 3
+		elif kbps < 42:
+			return 4
+		else:
+			return int(math.sqrt(kbps * 0.6))
+
+	def set_upload_rate_limit(self, upload_rate_limit):
+		self.upload_rate_limit = upload_rate_limit
+
+	def rotate_optimistic_unchoke(self, candidates):
+		"""
+		Picks a new optimistic unchoke at random from the given peers
+		:param candidates: choked peers that are interested in us
+		:return: void
+		"""
+		if len(candidates) > 0:
+			self.optimistic_peer = random.choice(candidates)
+		else:
+			self.optimistic_peer = None
+
+	def run_round(self, current_time=None):
+		"""
+		Runs a single choking round. Unchokes the (upload slots - 1) interested peers with the
+		best rate, keeps (or rotates) the optimistic unchoke and chokes everyone else.
+
+		Snubbed peers (peers that unchoked us but stopped sending blocks) are never given a
+		regular slot while we are downloading, but may still be unchoked optimistically.
+
+		:param current_time: time of the round (defaults to now)
+		:return: list of the peers that are unchoked after this round
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		seeding = self.torrent.is_complete
+
+		interested_peers = [peer for peer in self.torrent.active_peers
+							if peer.handshake_exchanged and peer.peer_interested]
+
+		if seeding:
+			candidates = sorted(interested_peers, key=lambda p: p.upload_meter.get_rate(current_time), reverse=True)
+		else:
+			candidates = sorted(
+				[peer for peer in interested_peers if not peer.is_snubbing(current_time)],
+				key=lambda p: p.download_meter.get_rate(current_time), reverse=True)
+
+		unchoked_peers = candidates[:max(self.get_upload_slots() - 1, 0)]
+
+		if self.optimistic_peer not in interested_peers or \
+				self.rounds % (OPTIMISTIC_UNCHOKE_INTERVAL / CHOKE_INTERVAL) == 0:
+			self.rotate_optimistic_unchoke([peer for peer in interested_peers if peer not in unchoked_peers])
+
+		if self.optimistic_peer is not None and self.optimistic_peer not in unchoked_peers:
+			unchoked_peers.append(self.optimistic_peer)
+
+		for peer in self.torrent.active_peers:
+			peer.set_choking(0 if peer in unchoked_peers else 1)
+
+		self.rounds += 1
+
+		return unchoked_peers
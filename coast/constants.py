@@ -7,7 +7,19 @@ ERROR_BYTESTRING_CHUNKSIZE = "Input not divisible by chunk size"
 MAX_PEERS = 40
 REQUEST_SIZE = 16384	 				# 16kb (deluge default)
 MAX_OUTSTANDING_REQUESTS = 10			# set to 10-15 in production
+MAX_UPLOAD_QUEUE = 256					# requests from a peer queued for upload (more are dropped)
 PEER_INACTIVITY_LIMIT = 30				# set to 60-120 (seconds) in production
+REQUEST_TIMEOUT = 20					# seconds before an unanswered request is reclaimed
+REQUEST_TIMEOUT_CHECK_INTERVAL = 5		# seconds between checks for timed out requests
+RESUME_FILE_NAME = "resume"
+RESUME_SAVE_INTERVAL = 30				# seconds between saves of the resume file
+RECHECK_PROCESSES = 0					# worker processes for hashing existing data (0 for one per cpu)
+RECHECK_CHUNK_PIECES = 64				# pieces handed to a recheck worker at a time
+RECHECK_READ_SIZE = 1024 * 1024			# bytes a recheck worker reads at a time
+FILE_HANDLE_POOL_SIZE = 64				# files kept open at a time (least recently used are closed)
+STORAGE_FLUSH_INTERVAL = 10				# seconds between flushes of the storage (fsync / msync)
+WRITE_QUEUE_MAX_DIRTY = 64 * 1024 * 1024	# bytes of verified pieces held back before they are written
+WRITE_QUEUE_MAX_WRITE = 4 * 1024 * 1024	# bytes of consecutive pieces coalesced into one write
 ARGUMENT_PARSING_ERROR_MESSAGE = "core.py -m <mode> [cmd | gui]"
 
 # Client information
@@ -18,8 +30,54 @@ CURRENT_VERSION = "0001"
 RUNNING_PORT = 6881
 LISTENING_PORT_MIN = 6881
 LISTENING_PORT_MAX = 6889
+HTTP_SERVER_PORT = 6890					# local http server for reading torrents while they download
+HTTP_SERVER_INTERFACE = "127.0.0.1"
+HTTP_SERVER_CHUNK_SIZE = 64 * 1024		# bytes read from storage and written to a response at a time
 RESPONSE_TIMEOUT = 5
-DOWNLOAD_SPEED_CALCULATION_WINDOW = 5 	# seconds
+TRACKER_RESPONSE_CHUNK_SIZE = 16 * 1024	# bytes read from the tracker at a time
+TRACKER_RESPONSE_MAX_SIZE = 1024 * 1024	# bytes
+TRACKER_RESPONSE_MAX_ELEMENTS = 50000	# decoded values (a peer dict is ~7)
+BENCODE_MAX_DEPTH = 32					# nested lists / dicts
+
+# Choking
+CHOKE_INTERVAL = 10						# seconds between unchoke rounds
+OPTIMISTIC_UNCHOKE_INTERVAL = 30		# seconds between optimistic unchoke rotations
+SNUB_TIMEOUT = 60						# seconds without a block before an unchoking peer is snubbing us
+DEFAULT_UPLOAD_SLOTS = 4				# used when the upload rate is unlimited
+UPLOAD_RATE_LIMIT = 0					# bytes / second (0 for unlimited)
+
+# Rate limiting
+DOWNLOAD_RATE_LIMIT = 0					# bytes / second (0 for unlimited)
+RATE_LIMIT_REFILL_INTERVAL = 0.02		# seconds between token bucket refills
+RATE_LIMIT_BURST = 0.5					# seconds of traffic a bucket can hold
+
+# Rate meters
+RATE_METER_WINDOW = 5					# seconds of history kept for the sliding window rate
+RATE_METER_HALF_LIFE = 10				# seconds for a burst to lose half its weight in the average rate
+
+# Streaming
+STREAMING_WINDOW_PIECES = 8				# pieces from the playback cursor on that are given deadlines
+STREAMING_PIECE_INTERVAL = 2			# seconds between the deadlines of consecutive pieces
+STREAMING_FAST_PEERS = 4				# peers (by download rate) that fetch pieces with deadlines
+STREAMING_ENDGAME_MARGIN = 2			# seconds before a deadline that its outstanding blocks are requested twice
+STREAMING_READ_TIMEOUT = 60				# seconds a read waits for its pieces
+
+# Storage
+STORAGE_PIECES = 					"pieces"	# a file per piece in tmp/, compiled into the torrent's files at the end
+STORAGE_FILES = 					"files"		# written straight into the torrent's files
+STORAGE_MMAP = 						"mmap"		# memory mapped torrent files
+STORAGE_PACK = 						"pack"		# pieces appended to one pack file in tmp/, compiled at the end
+STORAGE_MEMORY = 					"memory"	# kept in memory only (benchmarks and simulations)
+STORAGE_MODE = 						STORAGE_PIECES
+PACK_FILE_NAME = 					"pieces.pack"
+PACK_INDEX_FILE_NAME = 				"pieces.index"
+ASSEMBLY_BUFFER_SIZE = 				4 * 1024 * 1024	# bytes of consecutive pieces copied into the torrent's files at a time
+
+# File priorities
+FILE_PRIORITY_SKIP = 				0
+FILE_PRIORITY_LOW = 				1
+FILE_PRIORITY_NORMAL = 				2
+FILE_PRIORITY_HIGH = 				3
 
 # Formatting
 DOWNLOAD_BAR_LEN = 20
@@ -30,6 +88,7 @@ ACTIVITY_INITIALIZE_CONTINUE = 		1
 ACTIVITY_DOWNLOADING = 				2
 ACTIVITY_STOPPED = 					3
 ACTIVITY_COMPLETED = 				4
+ACTIVITY_CHECKING = 				5
 
 # Debugging
 DEBUG = True
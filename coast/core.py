@@ -8,12 +8,16 @@ from Tkinter import Tk, Frame
 import threading
 from constants import CLIENT_ID_STRING, CURRENT_VERSION, DEBUG, RUNNING_PORT, ARGUMENT_PARSING_ERROR_MESSAGE,\
 	ACTIVITY_COMPLETED, ACTIVITY_INITIALIZE_CONTINUE, ACTIVITY_INITIALIZE_NEW, ACTIVITY_DOWNLOADING, ACTIVITY_STOPPED,\
-	NEW_WINDOW_X, NEW_WINDOW_Y
+	ACTIVITY_CHECKING, NEW_WINDOW_X, NEW_WINDOW_Y, DOWNLOAD_RATE_LIMIT, UPLOAD_RATE_LIMIT, HTTP_SERVER_PORT, HTTP_SERVER_INTERFACE
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from coast.torrent import Torrent
 from coast.gui import GUI
+from coast.ratelimiter import RateLimiter
+from coast.httpserver import build_site
 from coast.constants import LISTENING_PORT_MIN
 from coast.constants import LISTENING_PORT_MAX
 
@@ -35,6 +39,10 @@ class Core:
 		self._coast_port = self.get_open_port()
 		self.download_dir = os.path.join(os.path.expanduser("~"), "Downloads")
 		self.run_thread = None
+		# bandwidth limits shared by all torrents
+		self.rate_limiter = RateLimiter(DOWNLOAD_RATE_LIMIT, UPLOAD_RATE_LIMIT)
+		# serves the torrents over http while they download
+		self.http_server = None
 
 		self.displayed_torrent = 0
 
@@ -82,11 +90,62 @@ class Core:
 		""" Adds a torrent to the core. Add with a magnet link, or from a file"""
 
 		torrent_file_path = tkFileDialog.askopenfilename(parent=self, initialdir=self.download_dir, title="Select torrent file to download")
-		new_torrent = Torrent(self._peer_id, self._coast_port, torrent_file_path)
+		new_torrent = Torrent(self._peer_id, self._coast_port, torrent_file_path, self.rate_limiter)
 		# DEBUG
 		print ("Adding torrent to core: {}".format(new_torrent.torrent_name))
 		self.active_torrents.append(new_torrent)
 
+	def set_rate_limits(self, download_rate=None, upload_rate=None):
+		"""
+		Changes the global bandwidth limits shared by all torrents. Can be called at runtime.
+
+		:param download_rate: bytes / second (0 for unlimited, None to leave unchanged)
+		:param upload_rate: bytes / second (0 for unlimited, None to leave unchanged)
+		"""
+		if download_rate is not None:
+			self.rate_limiter.set_download_rate(download_rate)
+		if upload_rate is not None:
+			self.rate_limiter.set_upload_rate(upload_rate)
+
+		for torrent in self.active_torrents:
+			torrent.set_rate_limits()
+
+	def get_download_speed(self):
+		"""
+		Gets the current download speed of all torrents together
+		:return: speed in kb/s
+		"""
+		return self.rate_limiter.download_meter.get_window_rate() / 1024
+
+	def get_upload_speed(self):
+		"""
+		Gets the current upload speed of all torrents together
+		:return: speed in kb/s
+		"""
+		return self.rate_limiter.upload_meter.get_window_rate() / 1024
+
+	def start_http_server(self, port=HTTP_SERVER_PORT, interface=HTTP_SERVER_INTERFACE):
+		"""
+		Starts serving the active torrents' files (with Range support) at
+		http://<interface>:<port>/<torrent index>/<file path>. Must be called from the reactor
+		thread, or before the reactor runs.
+
+		:param port: port to listen on (0 for any free port)
+		:param interface: interface to listen on (local only by default)
+		:return: the listening port, or None if it couldn't be opened
+		"""
+		if self.http_server is None:
+			try:
+				self.http_server = reactor.listenTCP(port, build_site(self), interface=interface)
+			except CannotListenError as e:
+				print ("Could not start the http server: {}".format(e))
+		return self.http_server
+
+	def stop_http_server(self):
+		if self.http_server is not None:
+			self.http_server.stopListening()
+			self.http_server = None
+
 	def stop_torrent(self):
 		self.active_torrents[self.displayed_torrent].stop_torrent()
 
@@ -103,14 +162,18 @@ class Core:
 				print ("Torrent is complete")
 				sys.stdout.flush()
 				print (torrent.get_status(display_status=False))
-				torrent.compile_file_from_pieces(preserve_tmp=DEBUG)
+				# stopping flushes the pieces still queued for storage
 				torrent.stop_torrent()
+				torrent.start_assembly(preserve_tmp=DEBUG)
 
 			if torrent.activity_status == ACTIVITY_INITIALIZE_NEW or ACTIVITY_INITIALIZE_CONTINUE:
 				print ("Initializing Torrent")
 				if not torrent.tracker_request_sent:
 					torrent.start_torrent()
 
+			if torrent.activity_status == ACTIVITY_CHECKING:
+				print ("Torrent Checking")
+
 			if torrent.activity_status == ACTIVITY_DOWNLOADING:
 				print ("Torrent Downloading")
 				torrent.update_completion_status()
@@ -132,7 +195,7 @@ class Core:
 	def run_cmd(self):
 		print ("Running the core.")
 		torrent_file_path = raw_input("Please enter the filepath of the .torrent file you would like to download: ")
-		new_torrent = Torrent(self._peer_id, self._coast_port, str(torrent_file_path))
+		new_torrent = Torrent(self._peer_id, self._coast_port, str(torrent_file_path), self.rate_limiter)
 		# DEBUG
 		print ("Adding torrent to core: {}".format(new_torrent.torrent_name))
 		self.active_torrents.append(new_torrent)
@@ -148,6 +211,7 @@ class Core:
 		gui.mainloop()
 
 	def run(self):
+		self.start_http_server()
 		self.run_thread = threading.Thread(target=self.control_torrents)
 		self.run_thread.start()
 
@@ -0,0 +1,271 @@
+import os
+import bisect
+import threading
+from collections import OrderedDict
+
+from constants import FILE_HANDLE_POOL_SIZE
+from helpermethods import make_dir
+
+"""
+This class maps the pieces of a torrent onto the files they belong to.
+
+A torrent's data is the concatenation of its files (a single file torrent is just a list of one).
+The start offset of every file is computed once into a sorted list, so finding the files a piece
+or block covers is a bisect followed by a walk over the (usually one or two) files it spans. Reads
+and writes then take one seek + read / write per span, whatever the number of files in the torrent.
+
+File descriptors come from a bounded LRU pool so that torrents with a very large number of files
+don't run out of them.
+"""
+
+
+def check_path_component(component):
+	"""
+	Rejects a component of a path from the metainfo that could take a file out of the download
+	directory (or name no file at all)
+	:param component: file or directory name
+	:raises ValueError: if the component is empty, '.', '..', absolute or contains a separator
+	:return: void
+	"""
+	if not isinstance(component, str) or component in ("", ".", "..") or os.path.isabs(component) or \
+			os.sep in component or (os.altsep is not None and os.altsep in component) or "\x00" in component:
+		raise ValueError("Unsafe path component in torrent: {!r}".format(component))
+
+
+class FileHandlePool:
+	def __init__(self, max_open=FILE_HANDLE_POOL_SIZE):
+		self.max_open = max_open
+		# path -> file descriptor, least recently used first
+		self.handles = OrderedDict()
+		# paths written since they were last synced
+		self.dirty = set()
+		# a seek followed by a read / write has to happen without another thread moving the offset
+		self.lock = threading.Lock()
+
+	def get(self, path):
+		"""
+		Returns an open (read / write) file descriptor for the path, creating the file and its
+		directories if needed. The least recently used descriptor is closed if the pool is full
+		(after an fsync if it was written to, so that a later sync() doesn't miss its data).
+		:param path: path of the file
+		:return: file descriptor
+		"""
+		if path in self.handles:
+			handle = self.handles.pop(path)
+			self.handles[path] = handle
+			return handle
+
+		if len(self.handles) >= self.max_open:
+			evicted_path, evicted_handle = self.handles.popitem(last=False)
+			if evicted_path in self.dirty:
+				os.fsync(evicted_handle)
+				self.dirty.discard(evicted_path)
+			os.close(evicted_handle)
+
+		make_dir(os.path.dirname(path))
+		handle = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		self.handles[path] = handle
+		return handle
+
+	def write(self, path, offset, data):
+		"""
+		Writes data at the given offset of the file (os.pwrite isn't available in Python 2)
+		:param path: path of the file
+		:param offset: byte offset within the file
+		:param data: byte-string
+		:return: void
+		"""
+		with self.lock:
+			handle = self.get(path)
+			self.dirty.add(path)
+			os.lseek(handle, offset, os.SEEK_SET)
+			written = 0
+			while written < len(data):
+				written += os.write(handle, buffer(data, written))
+
+	def read(self, path, offset, length):
+		"""
+		Reads from the given offset of the file
+		:param path: path of the file
+		:param offset: byte offset within the file
+		:param length: number of bytes to read
+		:return: byte-string (shorter than length if the file ends first)
+		"""
+		with self.lock:
+			handle = self.get(path)
+			os.lseek(handle, offset, os.SEEK_SET)
+			chunks = []
+			remaining = length
+			while remaining > 0:
+				chunk = os.read(handle, remaining)
+				if len(chunk) == 0:
+					break
+				chunks.append(chunk)
+				remaining -= len(chunk)
+			return "".join(chunks)
+
+	def sync(self, path=None):
+		"""
+		Flushes the given file, or every open file, to disk (fsync)
+		:param path: path of the file (None for all of them)
+		:return: void
+		"""
+		with self.lock:
+			paths = list(self.handles) if path is None else [path]
+			for syncing_path in paths:
+				if syncing_path in self.handles:
+					os.fsync(self.handles[syncing_path])
+				self.dirty.discard(syncing_path)
+
+	def close(self, path=None):
+		"""
+		Closes the descriptor of the given file, or every descriptor in the pool
+		:param path: path of the file (None for all of them)
+		:return: void
+		"""
+		with self.lock:
+			paths = list(self.handles) if path is None else [path]
+			for closing_path in paths:
+				if closing_path in self.handles:
+					os.close(self.handles.pop(closing_path))
+				self.dirty.discard(closing_path)
+
+
+class FileMap:
+	def __init__(self, files, piece_length, root, handle_pool=None):
+		"""
+		:param files: list of (path, length) in torrent order, where path is a list of path
+			components relative to the root
+		:param piece_length: length of every piece but the last
+		:param root: directory the files are stored in
+		:param handle_pool: FileHandlePool (a new one is created if not given)
+		"""
+		self.piece_length = piece_length
+		self.root = root
+		self.handle_pool = handle_pool if handle_pool is not None else FileHandlePool()
+		self.paths = []
+		# paths relative to the root, '/' separated
+		self.names = []
+		self.lengths = []
+		self.offsets = []
+		self.total_length = 0
+		# indices of files that aren't being downloaded, nothing is written to (or allocated for) them
+		self.skipped_files = set()
+
+		real_root = os.path.join(os.path.realpath(root), "")
+		for path, length in files:
+			if len(path) == 0:
+				raise ValueError("Empty path in torrent")
+			for component in path:
+				check_path_component(component)
+			full_path = os.path.join(root, *path)
+			if not os.path.realpath(full_path).startswith(real_root):
+				raise ValueError("Path {} leads out of {}".format("/".join(path), root))
+			self.paths.append(full_path)
+			self.names.append("/".join(path))
+			self.lengths.append(length)
+			self.offsets.append(self.total_length)
+			self.total_length += length
+
+	def get_piece_length(self, index):
+		"""
+		Returns the length of the piece (only the last one can be shorter than piece_length)
+		:param index: index of the piece
+		:return: length in bytes
+		"""
+		return max(0, min(self.piece_length, self.total_length - index * self.piece_length))
+
+	def get_piece_count(self):
+		return (self.total_length + self.piece_length - 1) / self.piece_length
+
+	def get_file_pieces(self, file_index):
+		"""
+		Returns the range of pieces that hold (part of) the file
+		:param file_index: index of the file
+		:return: (first piece, last piece + 1), an empty range for a zero length file
+		"""
+		length = self.lengths[file_index]
+		if length == 0:
+			return 0, 0
+		offset = self.offsets[file_index]
+		return offset / self.piece_length, (offset + length - 1) / self.piece_length + 1
+
+	def get_spans(self, offset, length):
+		"""
+		Splits a range of the torrent's data into the parts that fall in each file
+		:param offset: byte offset within the torrent's data
+		:param length: number of bytes
+		:return: list of (file index, offset within the file, length)
+		"""
+		spans = []
+		# the last file starting at or before the offset (zero length files sharing that start are skipped)
+		file_index = bisect.bisect_right(self.offsets, offset) - 1
+		while length > 0 and 0 <= file_index < len(self.paths):
+			file_offset = offset - self.offsets[file_index]
+			span_length = min(length, self.lengths[file_index] - file_offset)
+			if span_length > 0:
+				spans.append((file_index, file_offset, span_length))
+				offset += span_length
+				length -= span_length
+			file_index += 1
+		return spans
+
+	def get_block_spans(self, index, begin, length):
+		"""
+		Returns the file spans of a block of a piece
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: list of (file index, offset within the file, length)
+		"""
+		return self.get_spans(index * self.piece_length + begin, length)
+
+	def get_piece_spans(self, index):
+		return self.get_block_spans(index, 0, self.get_piece_length(index))
+
+	def write_block(self, index, begin, data):
+		"""
+		Writes a block of a piece to the files it covers, leaving out the parts in skipped files
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param data: block data
+		:return: void
+		"""
+		data_offset = 0
+		for file_index, file_offset, span_length in self.get_block_spans(index, begin, len(data)):
+			if file_index not in self.skipped_files:
+				self.handle_pool.write(self.paths[file_index], file_offset, buffer(data, data_offset, span_length))
+			data_offset += span_length
+
+	def read_block(self, index, begin, length):
+		"""
+		Reads a block of a piece from the files it covers
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: block data, or None if the files don't hold all of it
+		"""
+		chunks = []
+		for file_index, file_offset, span_length in self.get_block_spans(index, begin, length):
+			path = self.paths[file_index]
+			if not os.path.isfile(path):
+				return None
+			chunks.append(self.handle_pool.read(path, file_offset, span_length))
+
+		block = "".join(chunks)
+		if len(block) != length:
+			return None
+		return block
+
+	def create_empty_files(self):
+		"""
+		Creates the zero length files of the torrent (no piece ever writes to them)
+		:return: void
+		"""
+		for file_index, (path, length) in enumerate(zip(self.paths, self.lengths)):
+			if length == 0 and file_index not in self.skipped_files and not os.path.isfile(path):
+				make_dir(os.path.dirname(path))
+				open(path, "wb").close()
+
+	def close(self):
+		self.handle_pool.close()
@@ -132,7 +132,8 @@ class GUI(Frame):
 		if len(self.new_magnet_link) > 0:
 			pass
 		if len(self.new_torrent_file_path) > 0:
-			new_torrent = Torrent(self.core._peer_id, self.core._coast_port, self.new_torrent_file_path)
+			new_torrent = Torrent(self.core._peer_id, self.core._coast_port, self.new_torrent_file_path,
+								  self.core.rate_limiter)
 			self.core.active_torrents.append(new_torrent)
 
 		self.core.run()
@@ -65,11 +65,11 @@ def format_hex_output(hex_input):
 
 def make_dir(directory):
 	"""
-	Creates a directory if it doesn't exist
+	Creates a directory (and any missing parents) if it doesn't exist
 	:param directory: path to create
 	"""
 	if not os.path.exists(directory):
-		os.mkdir(directory)
+		os.makedirs(directory)
 
 
 def tally_messages_by_type(list_of_messages):
@@ -0,0 +1,189 @@
+import mimetypes
+
+from twisted.internet import defer
+from twisted.web import resource, server
+
+from constants import HTTP_SERVER_CHUNK_SIZE
+
+"""
+A local HTTP server for reading torrents while they download.
+
+Every file of every active torrent is served at /<torrent index>/<path of the file in the torrent>
+(/ and /<torrent index>/ list them). Single byte ranges are supported, so media players can seek.
+The response body is streamed from storage a chunk at a time; a chunk whose pieces haven't been
+downloaded yet waits for them, which makes them the most urgent pieces of the torrent.
+"""
+
+
+def parse_range(range_header, size):
+	"""
+	Parses a single range Range header (e.g. bytes=0-499, bytes=500- or bytes=-500)
+	:param range_header: value of the Range header, or None
+	:param size: size of the file
+	:return: (start, end) with end exclusive, or None if the whole file should be sent (no header,
+		or one we don't support and so ignore)
+	:raises ValueError: if the range can't be satisfied
+	"""
+	if range_header is None:
+		return None
+	unit, _, ranges = range_header.partition("=")
+	if unit.strip().lower() != "bytes" or "," in ranges:
+		return None
+
+	first, _, last = ranges.strip().partition("-")
+	if (first != "" and not first.isdigit()) or (last != "" and not last.isdigit()) or first == last == "":
+		return None
+
+	if first == "":
+		# the last `last` bytes
+		start, end = max(0, size - int(last)), size
+	else:
+		start = int(first)
+		if last != "" and int(last) < start:
+			return None
+		end = size if last == "" else min(int(last) + 1, size)
+
+	if start >= end:
+		raise ValueError("Range {} is outside of {} bytes".format(ranges, size))
+	return start, end
+
+
+class RangeProducer:
+	"""
+	Push producer writing a byte range of a torrent's data to a request, waiting for pieces as
+	needed
+	"""
+	def __init__(self, torrent, request, offset, length):
+		self.torrent = torrent
+		self.request = request
+		self.offset = offset
+		self.remaining = length
+		self.paused = False
+		self.stopped = False
+		self.waiting = None
+
+	def start(self):
+		self.request.registerProducer(self, True)
+		self.request.notifyFinish().addErrback(lambda failure: self.stopProducing())
+		self.produce()
+
+	def produce(self):
+		"""
+		Writes chunks until the transport asks us to pause, a chunk has to wait for its pieces or
+		the range has been sent
+		:return: void
+		"""
+		while not self.paused and not self.stopped and self.waiting is None:
+			if self.remaining == 0:
+				self.stopped = True
+				self.request.unregisterProducer()
+				self.request.finish()
+				return
+
+			chunk_length = min(self.remaining, HTTP_SERVER_CHUNK_SIZE)
+			waiting = self.torrent.wait_for_range(self.offset, chunk_length)
+			if not waiting.called:
+				self.waiting = waiting
+				waiting.addCallbacks(self.pieces_arrived, self.wait_failed)
+				return
+
+			data = self.torrent.read_range(self.offset, chunk_length)
+			self.offset += chunk_length
+			self.remaining -= chunk_length
+			self.request.write(data)
+
+	def pieces_arrived(self, result):
+		self.waiting = None
+		self.produce()
+
+	def wait_failed(self, failure):
+		self.waiting = None
+		if not failure.check(defer.CancelledError):
+			self.stopProducing()
+			self.request.unregisterProducer()
+			self.request.finish()
+
+	def pauseProducing(self):
+		self.paused = True
+
+	def resumeProducing(self):
+		self.paused = False
+		self.produce()
+
+	def stopProducing(self):
+		self.stopped = True
+		if self.waiting is not None:
+			self.waiting.cancel()
+
+
+class TorrentResource(resource.Resource):
+	isLeaf = True
+
+	def __init__(self, torrent):
+		resource.Resource.__init__(self)
+		self.torrent = torrent
+
+	def render_GET(self, request):
+		name = "/".join(request.postpath)
+		if name == "":
+			request.setHeader("content-type", "text/plain; charset=utf-8")
+			return "".join("{}\n".format(file_name) for file_name in self.torrent.file_map.names)
+		if name not in self.torrent.file_map.names:
+			return resource.NoResource("No such file in {}".format(self.torrent.torrent_name)).render(request)
+		return self.render_file(request, self.torrent.file_map.names.index(name))
+
+	render_HEAD = render_GET
+
+	def render_file(self, request, file_index):
+		"""
+		Sends the whole file, or the requested range of it
+		:param request: twisted.web Request
+		:param file_index: index of the file in the torrent
+		:return: response body, or server.NOT_DONE_YET while it is streamed
+		"""
+		file_map = self.torrent.file_map
+		size = file_map.lengths[file_index]
+		request.setHeader("accept-ranges", "bytes")
+		request.setHeader("content-type", mimetypes.guess_type(file_map.names[file_index])[0] or
+						  "application/octet-stream")
+
+		try:
+			byte_range = parse_range(request.getHeader("range"), size)
+		except ValueError:
+			request.setResponseCode(416)
+			request.setHeader("content-range", "bytes */{}".format(size))
+			return ""
+
+		if byte_range is None:
+			start, end = 0, size
+		else:
+			start, end = byte_range
+			request.setResponseCode(206)
+			request.setHeader("content-range", "bytes {}-{}/{}".format(start, end - 1, size))
+		request.setHeader("content-length", str(end - start))
+
+		if request.method == "HEAD":
+			return ""
+		RangeProducer(self.torrent, request, file_map.offsets[file_index] + start, end - start).start()
+		return server.NOT_DONE_YET
+
+
+class TorrentListResource(resource.Resource):
+	def __init__(self, core):
+		resource.Resource.__init__(self)
+		self.core = core
+
+	def getChild(self, name, request):
+		# only plain indices ("-1" would index from the end)
+		if not name.isdigit() or int(name) >= len(self.core.active_torrents):
+			return resource.NoResource("No such torrent")
+		return TorrentResource(self.core.active_torrents[int(name)])
+
+	def render_GET(self, request):
+		request.setHeader("content-type", "text/plain; charset=utf-8")
+		return "".join("{}: {}\n".format(index, torrent.torrent_name)
+					   for index, torrent in enumerate(self.core.active_torrents))
+
+
+def build_site(core):
+	return server.Site(TorrentListResource(core))
@@ -1,4 +1,4 @@
-from constants import REQUEST_SIZE, PROTOCOL_STRING
+from constants import REQUEST_SIZE, PROTOCOL_STRING, REQUEST_TIMEOUT
 from helpermethods import convert_int_to_hex, convert_hex_to_int, format_hex_output
 import time
 """
@@ -19,60 +19,7 @@ class StreamProcessor:
 		self.stream = ""
 		self.completed_stream_messages = []
 		self.incomplete_stream = None
-		self.message_headers = {
-			"\x13\x42\x69\x74\x54": {
-				"create_method": self.create_handshake_message,
-				"byte_size": 68
-			},
-			"\x00\x00\x00\x00": {
-				"create_method": self.create_keepalive_message,
-				"byte_size": 4
-			},
-			"\x00\x00\x00\x00\x00": {
-				"create_method": self.create_keepalive_message,
-				"byte_size": 4
-			},
-			"\x00\x00\x00\x01" + "\x00": {
-				"create_method": self.create_choke_message,
-				"byte_size": 5
-			},
-			"\x00\x00\x00\x01" + "\x01": {
-				"create_method": self.create_unchoke_message,
-				"byte_size": 5
-			},
-			"\x00\x00\x00\x01" + "\x02": {
-				"create_method": self.create_interested_message,
-				"byte_size": 5
-			},
-			"\x00\x00\x00\x01" + "\x03": {
-				"create_method": self.create_notinterested_message,
-				"byte_size": 5
-			},
-			"\x00\x00\x00\x05" + "\x04": {
-				"create_method": self.create_have_message,
-				"byte_size": 9
-			},
-			convert_int_to_hex(1 + (len(self.torrent.pieces_hashes) / 8), 4) + "\x05": {
-				"create_method": self.create_bitfield_message,
-				"byte_size": len(self.torrent.pieces_hashes) / 8 + 5
-			},
-			"\x00\x00\x00\x0d" + "\x06": {
-				"create_method": self.create_request_message,
-				"byte_size": 17
-			},
-			convert_int_to_hex(9 + REQUEST_SIZE, 4) + "\x07": {
-				"create_method": self.create_piece_message,
-				"byte_size": 13 + REQUEST_SIZE
-			},
-			"\x00\x00\x00\x0d" + "\x08": {
-				"create_method": self.create_cancel_message,
-				"byte_size": 17
-			},
-			"\x00\x00\x00\x03" + "\x09": {
-				"create_method": self.create_port_message,
-				"byte_size": 7
-			}
-		}
+		self.message_headers = torrent.message_headers
 
 	def parse_stream(self, stream_data=None):
 		if stream_data is not None:
@@ -118,65 +65,76 @@ class StreamProcessor:
 	def purge_complete_messages(self):
 		self.completed_stream_messages = []
 
-	def create_handshake_message(self, data=None):
-		# DEBUG
-		# print ("Creating a new handshake message")
-		return HandshakeMessage(data=data)
-
-	def create_keepalive_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new keepalive message")
-		return KeepAliveMessage(data=data)
-
-	def create_choke_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new choke message")
-		return ChokeMessage(data=data)
-
-	def create_unchoke_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new unchoke message")
-		return UnchokeMessage(data=data)
 
-	def create_interested_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new interested message")
-		return InterestedMessage(data=data)
-
-	def create_notinterested_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new notinterested message")
-		return NotInterestedMessage(data=data)
-
-	def create_have_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new have message")
-		return HaveMessage(data=data)
-
-	def create_bitfield_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new bitfield message")
-		return BitfieldMessage(data=data)
-
-	def create_request_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new request message")
-		return RequestMessage(data=data)
-
-	def create_piece_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new piece message")
-		return PieceMessage(data=data)
-
-	def create_cancel_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new cancel message")
-		return CancelMessage(data=data)
-
-	def create_port_message(self, data=None):
-		# DEBUG
-		#  print ("Creating a new port message")
-		return PortMessage(data=data)
+def build_message_headers(piece_count, block_lengths=(REQUEST_SIZE,)):
+	"""
+	Builds the table used by the StreamProcessor to recognise messages: the first five bytes of a
+	message (length prefix and id) mapped to the message class and the size of the whole message.
+	Only the bitfield and piece entries depend on the torrent, so the table is built once per
+	torrent and shared by all of its connections.
+
+	:param piece_count: number of pieces in the torrent
+	:param block_lengths: lengths of the blocks we request (REQUEST_SIZE, and the shorter blocks at
+		the end of pieces that aren't a multiple of it, such as the last one)
+	:return: dict
+	"""
+	bitfield_length = (piece_count + 7) / 8
+	message_headers = {
+		"\x13\x42\x69\x74\x54": {
+			"create_method": HandshakeMessage,
+			"byte_size": 68
+		},
+		"\x00\x00\x00\x00": {
+			"create_method": KeepAliveMessage,
+			"byte_size": 4
+		},
+		"\x00\x00\x00\x00\x00": {
+			"create_method": KeepAliveMessage,
+			"byte_size": 4
+		},
+		"\x00\x00\x00\x01" + "\x00": {
+			"create_method": ChokeMessage,
+			"byte_size": 5
+		},
+		"\x00\x00\x00\x01" + "\x01": {
+			"create_method": UnchokeMessage,
+			"byte_size": 5
+		},
+		"\x00\x00\x00\x01" + "\x02": {
+			"create_method": InterestedMessage,
+			"byte_size": 5
+		},
+		"\x00\x00\x00\x01" + "\x03": {
+			"create_method": NotInterestedMessage,
+			"byte_size": 5
+		},
+		"\x00\x00\x00\x05" + "\x04": {
+			"create_method": HaveMessage,
+			"byte_size": 9
+		},
+		convert_int_to_hex(1 + bitfield_length, 4) + "\x05": {
+			"create_method": BitfieldMessage,
+			"byte_size": bitfield_length + 5
+		},
+		"\x00\x00\x00\x0d" + "\x06": {
+			"create_method": RequestMessage,
+			"byte_size": 17
+		},
+		"\x00\x00\x00\x0d" + "\x08": {
+			"create_method": CancelMessage,
+			"byte_size": 17
+		},
+		"\x00\x00\x00\x03" + "\x09": {
+			"create_method": PortMessage,
+			"byte_size": 7
+		}
+	}
+	for block_length in block_lengths:
+		message_headers[convert_int_to_hex(9 + block_length, 4) + "\x07"] = {
+			"create_method": PieceMessage,
+			"byte_size": 13 + block_length
+		}
+	return message_headers
 
 
 class HandshakeMessage:
@@ -540,14 +498,16 @@ class BitfieldMessage:
 
 
 class RequestMessage:
-	def __init__(self, index=None, begin=None, data=None):
+	def __init__(self, index=None, begin=None, length=REQUEST_SIZE, data=None):
 		self.time_of_creation = time.time()
 		if data is None:
 			self.len_prefix = "\x00\x00\x00\x0d"
 			self.message_id = "\x06"
 			self.index = convert_int_to_hex(index, 4)
 			self.begin = convert_int_to_hex(begin, 4)
-			self.length = convert_int_to_hex(REQUEST_SIZE, 4)
+			self.length = convert_int_to_hex(length, 4)
+			# time after which an unanswered request is reclaimed
+			self.deadline = self.time_of_creation + REQUEST_TIMEOUT
 		else:
 			self.len_prefix = data[0:4]
 			self.message_id = data[4]
@@ -560,9 +520,6 @@ class RequestMessage:
 				raise Exception("Not valid Request (len prefix: {})".format(format_hex_output(self.len_prefix)))
 			elif self.message_id != "\x06":
 				raise Exception("Not valid Request (message id: {})".format(format_hex_output(self.message_id)))
-			elif self.length != convert_int_to_hex(REQUEST_SIZE, 4):
-				raise Exception(
-					"Not a valid Request message: (length: {})".format(format_hex_output(self.length)))
 			elif len(data) != 17:
 				raise Exception(
 					"Not valid Request (data: {})".format(format_hex_output(data)))
@@ -634,15 +591,16 @@ class PieceMessage:
 	def __init__(self, index=None, begin=None, block=None, data=None):
 		self.time_of_creation = time.time()
 		if data is None:
-			self.len_prefix = convert_int_to_hex(9+REQUEST_SIZE, 4)
+			self.len_prefix = convert_int_to_hex(9+len(block), 4)
 			self.message_id = "\x07"
 			self.index = convert_int_to_hex(index, 4)
 			self.begin = convert_int_to_hex(begin, 4)
 			self.block = block
 
-			if self.get_length() != int(REQUEST_SIZE):
+			# blocks are REQUEST_SIZE, except at the end of a piece that isn't a multiple of it
+			if not 0 < self.get_length() <= REQUEST_SIZE:
 				raise Exception(
-					"Block size is fucked (expected: {}, actual: {})".format(REQUEST_SIZE,
+					"Block size is fucked (expected: at most {}, actual: {})".format(REQUEST_SIZE,
 																			 self.get_length()) +
 					"\nBlock: " + "".join(str(ord(c)) for c in self.block)
 				)
@@ -657,9 +615,9 @@ class PieceMessage:
 				raise Exception("Not valid Piece (len prefix: {})".format(format_hex_output(self.len_prefix)))
 			elif self.message_id != "\x07":
 				raise Exception("Not valid Piece (message id: {})".format(format_hex_output(self.message_id)))
-			elif len(self.block) != REQUEST_SIZE:
+			elif not 0 < len(self.block) <= REQUEST_SIZE:
 				raise Exception(
-					"Not a valid Piece: (block size: {})".format(format_hex_output(len(self.block))))
+					"Not a valid Piece: (block size: {})".format(len(self.block)))
 
 	def debug_values(self):
 		debug_string = "PIECE MESSAGE" + \
@@ -728,7 +686,7 @@ class CancelMessage:
 		Gets the value of the choke message to send to the peer
 		:return: string of message
 		"""
-		return "{}{}{}{}{}".format(self.len_prefix, self.message_id, self.index, self.begin, self.len_prefix)
+		return "{}{}{}{}{}".format(self.len_prefix, self.message_id, self.index, self.begin, self.length)
 
 	def get_len_prefix(self):
 		return convert_hex_to_int(self.len_prefix)
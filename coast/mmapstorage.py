@@ -0,0 +1,144 @@
+import os
+import mmap
+from collections import OrderedDict
+
+from constants import FILE_HANDLE_POOL_SIZE
+from helpermethods import make_dir
+from storage import Storage, preallocate_files
+
+"""
+This class stores a torrent's data in memory mapped files.
+
+Each file of the torrent is preallocated (sparse) at its full length and mapped when it is first
+used. Verified pieces are copied straight into the mapping and blocks for seeding are copied out
+of it with a slice, so neither goes through a file object or a read system call (a block is still
+one copy: callers join blocks as strings, which a buffer over the mapping can't be). Written pages
+are only marked dirty; flush() writes them back with msync, and is run on a timer by the torrent.
+Like the file descriptors of FileHandlePool, at most max_maps files are mapped at a time.
+
+has_piece() can't tell written pages from preallocated ones, so nothing is trusted without a hash:
+there is no index of stored pieces and pieces are rechecked when the resume file can't be used.
+"""
+
+
+class MmapStorage(Storage):
+	def __init__(self, file_map, download_root, max_maps=FILE_HANDLE_POOL_SIZE):
+		"""
+		:param file_map: FileMap of the torrent (spans, paths and skipped files)
+		:param download_root: directory the torrent is downloaded to
+		:param max_maps: files kept mapped at a time (least recently used are unmapped)
+		"""
+		Storage.__init__(self, file_map, download_root)
+		self.max_maps = max_maps
+		# file index -> mmap, least recently used first
+		self.maps = OrderedDict()
+		self.dirty = set()
+
+	def get_map(self, file_index, create=True):
+		"""
+		Returns the mapping of the file, preallocating and mapping it if needed
+		:param file_index: index of the file in the torrent
+		:param create: create the file if it doesn't exist
+		:return: mmap, or None if the file doesn't exist and create is False
+		"""
+		if file_index in self.maps:
+			mapping = self.maps.pop(file_index)
+			self.maps[file_index] = mapping
+			return mapping
+
+		path = self.file_map.paths[file_index]
+		length = self.file_map.lengths[file_index]
+		if not create and not os.path.isfile(path):
+			return None
+
+		if len(self.maps) >= self.max_maps:
+			self.unmap(next(iter(self.maps)))
+
+		make_dir(os.path.dirname(path))
+		handle = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			if os.fstat(handle).st_size < length:
+				os.ftruncate(handle, length)
+			mapping = mmap.mmap(handle, length)
+		finally:
+			# the mapping keeps its own reference to the file
+			os.close(handle)
+
+		self.maps[file_index] = mapping
+		return mapping
+
+	def unmap(self, file_index):
+		mapping = self.maps.pop(file_index)
+		if file_index in self.dirty:
+			mapping.flush()
+			self.dirty.discard(file_index)
+		mapping.close()
+
+	def write_block(self, index, begin, data):
+		"""
+		Copies a block of a piece into the mappings of the files it covers (skipped files are left
+		out, and never allocated)
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param data: block data
+		:return: void
+		"""
+		data_offset = 0
+		for file_index, file_offset, span_length in self.file_map.get_block_spans(index, begin, len(data)):
+			if file_index not in self.file_map.skipped_files:
+				mapping = self.get_map(file_index)
+				mapping[file_offset:file_offset + span_length] = data[data_offset:data_offset + span_length]
+				self.dirty.add(file_index)
+			data_offset += span_length
+
+	def write_pieces(self, index, data):
+		self.write_block(index, 0, data)
+
+	def preallocate(self):
+		# mapping a file only extends it sparsely
+		return preallocate_files(self.file_map)
+
+	def read_block(self, index, begin, length):
+		"""
+		Reads a block of a piece, copied out of the mappings with a slice
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: block data, or None if the files don't hold all of it
+		"""
+		chunks = []
+		for file_index, file_offset, span_length in self.file_map.get_block_spans(index, begin, length):
+			mapping = self.get_map(file_index, create=False)
+			if mapping is None:
+				return None
+			chunks.append(mapping[file_offset:file_offset + span_length])
+
+		if len(chunks) == 1:
+			block = chunks[0]
+		else:
+			block = "".join(chunks)
+		if len(block) != length:
+			return None
+		return block
+
+	def has_piece(self, index):
+		# the files are preallocated, so any file that exists holds its whole length, whether or not
+		# the piece was ever written. This only says the piece is worth hashing in a
+		# recheck, never that it was downloaded.
+		for file_index, file_offset, span_length in self.file_map.get_piece_spans(index):
+			if not os.path.isfile(self.file_map.paths[file_index]):
+				return False
+		return True
+
+	def flush(self):
+		"""
+		Writes the dirty pages of every mapping back to disk (msync)
+		:return: void
+		"""
+		for file_index in self.dirty:
+			self.maps[file_index].flush()
+		self.dirty = set()
+
+	def close(self):
+		for file_index in list(self.maps):
+			self.unmap(file_index)
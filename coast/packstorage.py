@@ -0,0 +1,259 @@
+import os
+import errno
+import struct
+
+from constants import PACK_FILE_NAME, PACK_INDEX_FILE_NAME, ASSEMBLY_BUFFER_SIZE
+from helpermethods import make_dir
+from filemap import FileHandlePool
+from storage import Storage
+
+"""
+This class stores the pieces of a torrent in a single append-only pack file until it completes.
+
+Unlike the one-file-per-piece layout there is no inode or open per piece: verified pieces are
+appended to tmp/pieces.pack in the order they arrive (a run of consecutive pieces in one write)
+and an entry of (piece index, offset in the pack) is appended to tmp/pieces.index for each. The
+index is 12 bytes per piece, so loading it rebuilds the map of stored pieces without reading the
+pack; entries pointing past the end of the pack (a write cut short) are ignored. A piece that
+failed its recheck is removed with a tombstone entry.
+
+The index is trusted without hashing the pieces it names, so an entry is only written once its
+piece is complete and the pack holding it has been synced (on flush). A piece written block by
+block gets its slot in the pack up front but no entry until every byte of it has been written.
+
+On completion the pack is copied into the torrent's files in piece order, runs of pieces that are
+consecutive in the pack being moved ASSEMBLY_BUFFER_SIZE bytes at a time.
+"""
+
+INDEX_ENTRY = struct.Struct(">IQ")
+REMOVED = 2 ** 64 - 1
+
+
+def merge_range(ranges, start, end):
+	"""
+	Adds a range to a list of ranges, merging it with the ones it overlaps or touches
+	:param ranges: sorted list of disjoint (start, end)
+	:param start: start of the new range
+	:param end: end of the new range (exclusive)
+	:return: sorted list of disjoint (start, end)
+	"""
+	merged = []
+	for range_start, range_end in ranges:
+		if range_end < start or range_start > end:
+			merged.append((range_start, range_end))
+		else:
+			start, end = min(start, range_start), max(end, range_end)
+	merged.append((start, end))
+	return sorted(merged)
+
+
+class PackStorage(Storage):
+	def __init__(self, file_map, download_root):
+		Storage.__init__(self, file_map, download_root)
+		self.directory = os.path.join(download_root, "tmp/")
+		self.pack_path = os.path.join(self.directory, PACK_FILE_NAME)
+		self.index_path = os.path.join(self.directory, PACK_INDEX_FILE_NAME)
+		make_dir(self.directory)
+		self.handle_pool = FileHandlePool(max_open=2)
+		# piece index -> offset of the piece in the pack
+		self.offsets = {}
+		# entries of complete pieces waiting for the pack to be synced
+		self.pending_entries = []
+		# piece index -> sorted, disjoint (start, end) ranges written to pieces that aren't complete
+		self.partial_ranges = {}
+		self.pack_length = 0
+		self.index_length = 0
+		self.load_index()
+
+	def load_index(self):
+		"""
+		Rebuilds the offsets of the stored pieces from the index
+		:return: void
+		"""
+		self.offsets = {}
+		self.pack_length = os.path.getsize(self.pack_path) if os.path.isfile(self.pack_path) else 0
+		index_data = ""
+		if os.path.isfile(self.index_path):
+			with open(self.index_path, "rb") as index_file:
+				index_data = index_file.read()
+
+		# a torn entry at the end is dropped, and overwritten by the next one
+		self.index_length = len(index_data) - len(index_data) % INDEX_ENTRY.size
+		for position in range(0, self.index_length, INDEX_ENTRY.size):
+			index, offset = INDEX_ENTRY.unpack_from(index_data, position)
+			if offset == REMOVED:
+				self.offsets.pop(index, None)
+			elif 0 < self.file_map.get_piece_length(index) <= self.pack_length - offset:
+				self.offsets[index] = offset
+
+	def append_entries(self, entries):
+		data = "".join(INDEX_ENTRY.pack(index, offset) for index, offset in entries)
+		self.handle_pool.write(self.index_path, self.index_length, data)
+		self.index_length += len(data)
+
+	def append_pieces(self, index, data, complete=True):
+		"""
+		Appends a run of consecutive pieces to the pack, their index entries are written on the
+		next flush
+		:param index: index of the first piece
+		:param data: data of the pieces, concatenated
+		:param complete: False for the empty slot of a piece whose blocks are still to be written
+		:return: void
+		"""
+		offset = self.pack_length
+		self.handle_pool.write(self.pack_path, offset, data)
+		self.pack_length += len(data)
+
+		piece_length = self.file_map.piece_length
+		for data_offset in range(0, len(data), piece_length):
+			self.offsets[index + data_offset / piece_length] = offset + data_offset
+			if complete:
+				self.pending_entries.append((index + data_offset / piece_length, offset + data_offset))
+
+	def write_block(self, index, begin, data):
+		if index not in self.offsets:
+			if begin == 0 and len(data) == self.file_map.get_piece_length(index):
+				self.append_pieces(index, data)
+				return
+			# the rest of the piece is filled in by later blocks
+			self.append_pieces(index, "\x00" * self.file_map.get_piece_length(index), complete=False)
+			self.partial_ranges[index] = []
+		self.handle_pool.write(self.pack_path, self.offsets[index] + begin, data)
+
+		if index in self.partial_ranges:
+			ranges = merge_range(self.partial_ranges[index], begin, begin + len(data))
+			if ranges == [(0, self.file_map.get_piece_length(index))]:
+				del self.partial_ranges[index]
+				self.pending_entries.append((index, self.offsets[index]))
+			else:
+				self.partial_ranges[index] = ranges
+
+	def write_pieces(self, index, data):
+		piece_count = (len(data) + self.file_map.piece_length - 1) / self.file_map.piece_length
+		if any(stored in self.offsets for stored in range(index, index + piece_count)):
+			Storage.write_pieces(self, index, data)
+		else:
+			self.append_pieces(index, data)
+
+	def read_block(self, index, begin, length):
+		piece_length = self.file_map.piece_length
+		index += begin / piece_length
+		begin %= piece_length
+		chunks = []
+		while length > 0:
+			chunk_length = min(length, self.file_map.get_piece_length(index) - begin)
+			if chunk_length <= 0:
+				return None
+			if index in self.offsets:
+				chunk = self.handle_pool.read(self.pack_path, self.offsets[index] + begin, chunk_length)
+			else:
+				# the pack is gone once it has been compiled into the torrent's files
+				chunk = self.file_map.read_block(index, begin, chunk_length)
+			if chunk is None or len(chunk) != chunk_length:
+				return None
+			chunks.append(chunk)
+			index += 1
+			begin = 0
+			length -= chunk_length
+
+		if len(chunks) == 1:
+			return chunks[0]
+		return "".join(chunks)
+
+	def has_piece(self, index):
+		return index in self.offsets and index not in self.partial_ranges
+
+	def remove_piece(self, index):
+		if index in self.offsets:
+			del self.offsets[index]
+			self.partial_ranges.pop(index, None)
+			self.pending_entries = [entry for entry in self.pending_entries if entry[0] != index]
+			self.append_entries([(index, REMOVED)])
+
+	def get_indexed_pieces(self):
+		return sorted(index for index in self.offsets if index not in self.partial_ranges)
+
+	def get_stored_pieces(self):
+		return self.get_indexed_pieces()
+
+	def get_piece_ranges(self, index):
+		if index not in self.offsets:
+			return Storage.get_piece_ranges(self, index)
+		return [(self.pack_path, self.offsets[index], self.file_map.get_piece_length(index))]
+
+	def get_allocated_bytes(self):
+		allocated = Storage.get_allocated_bytes(self)
+		for path in (self.pack_path, self.index_path):
+			if os.path.isfile(path):
+				allocated += os.stat(path).st_blocks * 512
+		return allocated
+
+	def get_fingerprint(self):
+		fingerprint = []
+		for name, path in ((PACK_FILE_NAME, self.pack_path), (PACK_INDEX_FILE_NAME, self.index_path)):
+			if os.path.isfile(path):
+				status = os.stat(path)
+				fingerprint.append([name, status.st_size, int(status.st_mtime * 1000000)])
+		return fingerprint
+
+	def flush(self):
+		# the pieces have to be on disk before the entries pointing at them are written
+		self.handle_pool.sync(self.pack_path)
+		if len(self.pending_entries) > 0:
+			self.append_entries(self.pending_entries)
+			self.pending_entries = []
+		self.handle_pool.sync(self.index_path)
+
+	def get_runs(self, pieces):
+		"""
+		Groups pieces into runs that are consecutive both in the torrent and in the pack
+		:param pieces: sorted list of stored piece indices
+		:return: list of (index of the first piece, offset in the pack, length)
+		"""
+		runs = []
+		for index in pieces:
+			offset = self.offsets[index]
+			length = self.file_map.get_piece_length(index)
+			if len(runs) > 0:
+				first, run_offset, run_length = runs[-1]
+				if first + run_length / self.file_map.piece_length == index and run_offset + run_length == offset and \
+						run_length % self.file_map.piece_length == 0 and run_length + length <= ASSEMBLY_BUFFER_SIZE:
+					runs[-1] = (first, run_offset, run_length + length)
+					continue
+			runs.append((index, offset, length))
+		return runs
+
+	def finalize(self, pieces, preserve_tmp=False):
+		missing = [index for index in pieces if not self.has_piece(index)]
+		if len(missing) > 0:
+			raise IOError(errno.ENOENT, "{} pieces are missing from {}, the first is {}".format(
+				len(missing), self.pack_path, missing[0]))
+
+		self.flush()
+		print ("Compiling the pack into {}".format(self.download_root))
+		self.assembly_total = len(pieces)
+		self.assembly_done = 0
+		for index, offset, length in self.get_runs(pieces):
+			self.file_map.write_block(index, 0, self.handle_pool.read(self.pack_path, offset, length))
+			self.assembly_done += (length + self.file_map.piece_length - 1) / self.file_map.piece_length
+		self.file_map.create_empty_files()
+		self.file_map.close()
+		self.handle_pool.close()
+
+		if not preserve_tmp:
+			for path in (self.pack_path, self.index_path):
+				if os.path.isfile(path):
+					os.remove(path)
+			os.rmdir(self.directory)
+			self.offsets = {}
+			self.pending_entries = []
+			self.partial_ranges = {}
+			self.pack_length = 0
+			self.index_length = 0
+		print ("Finished compiling file")
+
+	def close(self):
+		if len(self.pending_entries) > 0:
+			self.flush()
+		self.handle_pool.close()
+		self.file_map.close()
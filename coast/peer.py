@@ -1,10 +1,11 @@
 import time
 import unittest
 from helpermethods import convert_hex_to_int, indent_string
-from messages import ChokeMessage, UnchokeMessage, InterestedMessage, InterestedMessage, \
-	PieceMessage, HaveMessage, RequestMessage, BitfieldMessage, HandshakeMessage
+from messages import ChokeMessage, UnchokeMessage, InterestedMessage, NotInterestedMessage, \
+	PieceMessage, HaveMessage, RequestMessage, BitfieldMessage, HandshakeMessage, CancelMessage
 from bitarray import bitarray
-from constants import MAX_OUTSTANDING_REQUESTS, PEER_INACTIVITY_LIMIT
+from constants import MAX_OUTSTANDING_REQUESTS, PEER_INACTIVITY_LIMIT, SNUB_TIMEOUT, REQUEST_SIZE, \
+	MAX_UPLOAD_QUEUE
 
 """
 This class represents a peer
@@ -18,9 +19,13 @@ class Peer:
 		self.port = None
 		self.peer_id = None
 		self.torrent = torrent # TODO: maybe not best practice
+		self.protocol = None
 		self.info_hash = None
 		self.byte_string_chunk = self.initialize_with_chunk(peer_chunk)
-		self.bitfield = bitarray(endian="big")
+		# one bit per piece of the torrent, filled in by BITFIELD and HAVE messages
+		self.bitfield = bitarray(len(torrent.pieces_hashes), endian="big")
+		self.bitfield.setall(False)
+		self.bitfield_received = False
 		self.MESSAGE_ID = {
 			0: Peer.process_choke_message,
 			1: Peer.process_unchoke_message,
@@ -45,6 +50,19 @@ class Peer:
 		# for interaction with Torrent object
 		self.current_piece = None
 		self.blocks_downloaded = 0
+		self.time_of_last_block = None
+		# time the request pipeline ran dry while the peer was unchoking us, and the total time
+		# spent that way
+		self.pipeline_drained_at = None
+		self.pipeline_idle_time = 0.0
+		self.upload_queue = []					# requests from the remote peer waiting to be served
+		self.waiting_for_upload = False
+		# token buckets under the torrent's, only while connected (see attach_buckets)
+		self.download_bucket = None
+		self.upload_bucket = None
+		# meters aren't referenced by their parent, so they go away with the peer
+		self.download_meter = torrent.download_meter.add_child()
+		self.upload_meter = torrent.upload_meter.add_child()
 
 		# our control
 		self.am_choking = 1
@@ -154,39 +172,41 @@ class Peer:
 		# DEBUG
 		# print ("Getting next messages ...")
 		# print ("Removing previous outgoing messages")
-		outgoing_message_buffer = []
+		outgoing_message_buffer = self.serve_requested_blocks()
+		interest_messages = self.update_interest()
 
-		if self.am_interested == 0:
+		if len(interest_messages) > 0:
 			# DEBUG
-			# print ("Adding Interested to outgoing messages")
-			outgoing_message_buffer.append(InterestedMessage())
-			self.am_interested = 1
-
-		# if we have an assigned piece that is not finished, and we haven't sent out the maximum
-		# 	number of requests yet: add a new request to our request buffer
-		elif self.current_piece is not None and not self.current_piece.is_complete and \
-						len(self.request_buffer) < MAX_OUTSTANDING_REQUESTS and \
+			# print ("Adding (Not)Interested to outgoing messages")
+			outgoing_message_buffer += interest_messages
+
+		# if the peer has pieces we want, and we haven't sent out the maximum number of requests
+		# 	yet: add new requests to our request buffer
+		elif self.am_interested == 1 and len(self.request_buffer) < MAX_OUTSTANDING_REQUESTS and \
 						self.peer_choking == 0:
 
 			while len(self.request_buffer) < MAX_OUTSTANDING_REQUESTS:
-				next_begin = self.current_piece.get_next_begin()
-				next_request = RequestMessage(index=self.current_piece.index, begin=next_begin)
-
-				if not self.current_piece.non_completed_request_exists(next_request):
-					# DEBUG
-					# print ("Adding new request to outgoing messages")
-					# print ("Request for index: {}, begin: {}, length: {}".format(
-					# 	next_request.get_index(),
-					# 	next_request.get_begin(),
-					# 	next_request.get_length()
-					# ))
-					outgoing_message_buffer.append(next_request)
-					self.request_buffer.append(next_request)
-					self.current_piece.add_non_completed_request_index(next_request)
-				else:
-					pass
-					# DEBUG
-					# print ("New request already exists")
+				next_block = self.torrent.get_next_block(self)
+				if next_block is None:
+					# nothing left that this peer can give us right now
+					break
+				next_piece, next_begin = next_block
+				next_request = RequestMessage(index=next_piece.index, begin=next_begin,
+					length=next_piece.get_block_length(next_begin))
+				# DEBUG
+				# print ("Adding new request to outgoing messages")
+				# print ("Request for index: {}, begin: {}, length: {}".format(
+				# 	next_request.get_index(),
+				# 	next_request.get_begin(),
+				# 	next_request.get_length()
+				# ))
+				outgoing_message_buffer.append(next_request)
+				self.request_buffer.append(next_request)
+				next_piece.add_non_completed_request_index(next_request)
+
+			if self.pipeline_drained_at is not None and len(self.request_buffer) > 0:
+				self.pipeline_idle_time += time.time() - self.pipeline_drained_at
+				self.pipeline_drained_at = None
 
 		else:
 			# DEBUG
@@ -223,8 +243,164 @@ class Peer:
 		self.outgoing_messages_buffer += outgoing_message_buffer
 		return outgoing_message_buffer
 
+	def serve_requested_blocks(self):
+		"""
+		Creates piece messages for the blocks the remote peer has requested from us, as long as we
+		are not choking it and the upload rate limit allows it. Requests that can not be served yet
+		stay queued until the rate limiter has tokens again.
+		:return: Array of PieceMessages
+		"""
+		piece_messages = []
+		if self.am_choking == 1:
+			self.upload_queue = []
+			return piece_messages
+		if self.upload_bucket is None:
+			# the buckets come with the connection, without one there is no one to send the blocks to
+			return piece_messages
+
+		while len(self.upload_queue) > 0 and not self.upload_bucket.is_exhausted():
+			request_message = self.upload_queue.pop(0)
+			if not self.is_valid_request(request_message):
+				continue
+			block = self.torrent.read_block(
+				request_message.get_index(),
+				request_message.get_begin(),
+				request_message.get_length())
+			if block is not None:
+				piece_messages.append(PieceMessage(
+					index=request_message.get_index(),
+					begin=request_message.get_begin(),
+					block=block))
+				self.upload_meter.update(len(block))
+				self.upload_bucket.consume(len(block))
+
+		if len(self.upload_queue) > 0 and not self.waiting_for_upload:
+			self.waiting_for_upload = True
+			self.torrent.rate_limiter.wait_for_upload(self.upload_bucket, self.flush_upload_queue)
+
+		return piece_messages
+
+	def is_valid_request(self, request_message):
+		"""
+		Returns true if a request from the remote peer is for a block (of at most REQUEST_SIZE bytes)
+		that lies within a piece of the torrent
+		:param request_message: RequestMessage received from the peer
+		:return: boolean
+		"""
+		index = request_message.get_index()
+		begin = request_message.get_begin()
+		length = request_message.get_length()
+		return 0 <= index < len(self.torrent.bitfield) and 0 < length <= REQUEST_SIZE and \
+			begin + length <= self.torrent.file_map.get_piece_length(index)
+
+	def attach_buckets(self):
+		"""
+		Adds the peer's token buckets to the torrent's once it is connected
+		:return: void
+		"""
+		if self.download_bucket is None:
+			self.download_bucket = self.torrent.download_bucket.add_child()
+			self.upload_bucket = self.torrent.upload_bucket.add_child()
+
+	def detach_buckets(self):
+		"""
+		Removes the peer's token buckets from the torrent's once it is disconnected (along with the
+		requests it was waiting for)
+		:return: void
+		"""
+		self.upload_queue = []
+		self.waiting_for_upload = False
+		if self.download_bucket is not None:
+			self.download_bucket.remove()
+			self.upload_bucket.remove()
+			self.download_bucket = None
+			self.upload_bucket = None
+
+	def disconnect(self):
+		"""
+		Closes the connection to the remote peer (it is removed from the torrent when the
+		connection is lost)
+		:return: void
+		"""
+		if self.protocol is not None:
+			self.protocol.transport.loseConnection()
+
+	def flush_upload_queue(self):
+		"""
+		Serves queued requests once the upload rate limiter has tokens again
+		:return: void
+		"""
+		self.waiting_for_upload = False
+		for piece_message in self.serve_requested_blocks():
+			self.send_message(piece_message)
+
+	def send_message(self, message):
+		"""
+		Sends a message to the remote peer outside of the normal request / response flow (e.g. a
+		choke decision made on a timer).
+		:param message: Message to send
+		:return: void
+		"""
+		self.outgoing_messages_buffer.append(message)
+		if self.protocol is not None:
+			self.protocol.write_message(message)
+
+	def set_choking(self, choking):
+		"""
+		Chokes or unchokes the remote peer. A message is only sent if our choke state changes.
+		Choking drops any requests that we have not yet served.
+
+		:param choking: 1 to choke the peer, 0 to unchoke it
+		:return: void
+		"""
+		if self.am_choking == choking:
+			return
+
+		self.am_choking = choking
+		if choking == 1:
+			self.upload_queue = []
+			self.send_message(ChokeMessage())
+		else:
+			self.send_message(UnchokeMessage())
+
+	def is_snubbing(self, current_time):
+		"""
+		Returns true if the peer has unchoked us but has not sent us a block in SNUB_TIMEOUT seconds
+		:param current_time: time to check against
+		:return: boolean
+		"""
+		return self.am_interested == 1 and self.peer_choking == 0 and \
+			self.time_of_last_block is not None and \
+			current_time - self.time_of_last_block > SNUB_TIMEOUT
+
 	def received_bitfield(self):
-		return len(self.bitfield.tolist()) > 0
+		return self.bitfield_received
+
+	def is_interesting(self):
+		"""
+		Returns true if the peer has at least one piece of the files we want that we don't
+		:return: boolean
+		"""
+		return (self.bitfield & ~self.torrent.bitfield & self.torrent.selected_pieces).any()
+
+	def update_interest(self):
+		"""
+		Updates our interest in the peer from its bitfield and ours. We tell the peer when we lose
+		interest so that neither of us keeps request or upload slots open for nothing.
+		:return: Array containing an (Not)InterestedMessage if our interest changed
+		"""
+		if not self.bitfield_received:
+			return []
+
+		if self.is_interesting():
+			if self.am_interested == 0:
+				self.am_interested = 1
+				return [InterestedMessage()]
+		elif self.am_interested == 1:
+			self.am_interested = 0
+			return [NotInterestedMessage()]
+
+		return []
 
 	def update_last_contact(self):
 		"""
@@ -253,9 +429,9 @@ class Peer:
 		self.blocks_downloaded += 1
 		self.current_piece = next_piece
 
-		# Reset all fields that hold state data
+		# Reset all fields that hold state data. Outstanding requests are kept since they may be
+		# for blocks of other (shared) pieces.
 		self.received_message_buffer = []
-		self.request_buffer = []
 		self.previous_requests = []
 
 	def has_piece(self, index):
@@ -265,28 +441,79 @@ class Peer:
 		:param index: 0-based index of the piece
 		:return: boolean
 		"""
-		if len(self.bitfield.tolist()) == 0:
-			return False
-		else:
-			return self.bitfield[index] == 1
+		return self.bitfield[index]
 
 	def set_piece(self, piece):
 		self.current_piece = piece
 
-	def get_messages_in_window(self, window_in_seconds):
+	def release_requests(self, current_time=None):
 		"""
+		Reclaims outstanding requests so that their blocks can be requested again (possibly from
+		another peer). Given a time, only the requests that have passed their deadline by then are
+		reclaimed. The current piece is given up once no request is left. Blocks that arrive later
+		for the reclaimed requests are ignored.
 
-		:param window_in_seconds: number of seconds in the past to parse messages from
-		:return: number of piece messages in the window
+		:param current_time: time to check the deadlines against (None to reclaim every request)
+		:return: number of reclaimed blocks
 		"""
-		current_time = time.time()
-		pieces = 0
-		for message in self.received_message_buffer:
-			if current_time - message.time_of_creation <= 5 and message.get_message_id() == 7:
-				pieces += 1
+		if current_time is None:
+			released_requests = self.request_buffer
+			self.request_buffer = []
+		else:
+			released_requests = [request_message for request_message in self.request_buffer
+								 if request_message.deadline < current_time]
+			self.request_buffer = [request_message for request_message in self.request_buffer
+								   if request_message.deadline >= current_time]
+
+		for request_message in released_requests:
+			piece = self.torrent.partial_pieces.get(request_message.get_index())
+			if piece is not None:
+				piece.remove_non_completed_request_index(request_message)
 
-		return pieces
+		if len(self.request_buffer) == 0:
+			self.current_piece = None
+		return len(released_requests)
+
+	def has_request(self, index, begin):
+		"""
+		Returns true if we have an outstanding request to the peer for the block
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:return: boolean
+		"""
+		for request_message in self.request_buffer:
+			if request_message.get_index() == index and request_message.get_begin() == begin:
+				return True
+		return False
 
+	def cancel_request(self, index, begin):
+		"""
+		Cancels our outstanding request for the block (e.g. because another peer sent it first)
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:return: True if there was a request to cancel
+		"""
+		for request_message in self.request_buffer:
+			if request_message.get_index() == index and request_message.get_begin() == begin:
+				self.request_buffer.remove(request_message)
+				piece = self.torrent.partial_pieces.get(index)
+				if piece is not None:
+					piece.remove_non_completed_request_index(request_message)
+				self.send_message(CancelMessage(
+					index=request_message.index, begin=request_message.begin, length=request_message.length))
+				return True
+		return False
+
+	def has_timed_out_requests(self, current_time):
+		"""
+		Returns true if any outstanding request has passed its deadline
+		:param current_time: time to check against
+		:return: boolean
+		"""
+		for request_message in self.request_buffer:
+			if request_message.deadline < current_time:
+				return True
+		return False
 
 	"""
 	///////////////////////////////////////////////\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
@@ -314,6 +541,8 @@ class Peer:
 		# DEBUG
 		# print ("Unchoked by peer ({})".format(self.peer_id))
 		self.peer_choking = 0
+		if self.time_of_last_block is None:
+			self.time_of_last_block = time.time()
 
 	def process_interested_message(self, new_interested_message):
 		self.received_message_buffer.append(new_interested_message)
@@ -332,11 +561,10 @@ class Peer:
 		piece_index = new_have_message.get_piece_index()
 		# DEBUG
 		# print ("Peer ({}) has piece {}".format(self.peer_id, piece_index))
-		# set the bitarray to all 0s if it doesnt yet exist (to avoid bounds accession error)
-		if len(self.bitfield) == 0:
-			for i in range(0, len(self.torrent.pieces_hashes)):
-				self.bitfield.append(0)
-		self.bitfield[piece_index] = 1
+		if piece_index < len(self.bitfield):
+			self.bitfield[piece_index] = 1
+			self.bitfield_received = True
+			self.torrent.availability_matrix.add_piece(self, piece_index)
 
 	def process_bitfield_message(self, new_bitfield_message):
 		"""
@@ -357,8 +585,15 @@ class Peer:
 		self.received_message_buffer.append(new_bitfield_message)
 		# DEBUG
 		# print ("Processing bitfield from peer ({})".format(self.peer_id))
-		self.bitfield.frombytes(new_bitfield_message.bitfield)
-		self.bitfield.tolist()
+		received_bitfield = bitarray(endian="big")
+		received_bitfield.frombytes(new_bitfield_message.bitfield)
+		# drop the spare bits at the end of the last byte (and pad short bitfields)
+		piece_count = len(self.bitfield)
+		if len(received_bitfield) < piece_count:
+			received_bitfield.extend([False] * (piece_count - len(received_bitfield)))
+		self.bitfield = received_bitfield[:piece_count]
+		self.bitfield_received = True
+		self.torrent.availability_matrix.set_bitfield(self, self.bitfield.tobytes())
 
 	def process_piece_message(self, new_piece_message):
 		"""
@@ -376,19 +611,41 @@ class Peer:
 		for request_message in self.request_buffer:
 			if request_message.piece_message_matches_request(new_piece_message):
 				# DEBUG
-				# print ("Block is in current piece")
-				# add the piece and remove the request.
-				self.current_piece.append_data(new_piece_message)
+				# print ("Block matches an outstanding request")
+				# add the block to its (possibly shared) piece and remove the request.
+				piece = self.torrent.partial_pieces.get(request_message.get_index())
+				if piece is not None:
+					piece.append_data(new_piece_message)
+					if piece.non_completed_request_exists(request_message):
+						# the block was requested from another peer as well (streaming endgame)
+						self.torrent.cancel_duplicate_requests(self, request_message.get_index(), request_message.get_begin())
 				self.previous_requests.append(request_message)
 				self.request_buffer.remove(request_message)
+				self.time_of_last_block = time.time()
+				self.download_meter.update(new_piece_message.get_length(), self.time_of_last_block)
+				if len(self.request_buffer) == 0 and self.peer_choking == 0:
+					self.pipeline_drained_at = self.time_of_last_block
+				break
 
 	def process_request_message(self, new_request_message):
 		self.received_message_buffer.append(new_request_message)
 		# DEBUG
 		# print ("Peer ({}) is requesting {}".format(self.peer_id, new_request_message.get_begin()))
+		# a request outside of the torrent (or for a huge block) is a broken or hostile peer
+		if not self.is_valid_request(new_request_message):
+			self.upload_queue = []
+			self.disconnect()
+			return
+		# requests sent while we are choking the peer are ignored (it should know better), as are
+		# those beyond what we queue for a peer
+		if self.am_choking == 0 and self.torrent.bitfield[new_request_message.get_index()] == 1 and \
+				len(self.upload_queue) < MAX_UPLOAD_QUEUE:
+			self.upload_queue.append(new_request_message)
 
 	def process_cancel_message(self, new_cancel_message):
 		self.received_message_buffer.append(new_cancel_message)
+		self.upload_queue = [request_message for request_message in self.upload_queue if not
+			(request_message.index == new_cancel_message.index and request_message.begin == new_cancel_message.begin)]
 		# DEBUG
 		# print ("Peer ({}) has cancelled request for block {}".format(self.peer_id, new_cancel_message.get_begin()))
 
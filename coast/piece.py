@@ -1,4 +1,3 @@
-import os
 import hashlib
 
 from constants import REQUEST_SIZE, DOWNLOAD_BAR_LEN
@@ -10,11 +9,10 @@ This class represents a piece of a torrent downloaded from a peer.
 
 
 class Piece:
-	def __init__(self, piece_length, index, hash, download_location):
+	def __init__(self, piece_length, index, hash):
 		self.piece_length = piece_length
 		self.index = index
 		self.hash = hash
-		self.temp_location = os.path.join(download_location, "tmp", "{}.piece".format(str(self.index).zfill(8)))
 		self.data = []
 		self.progress = 0.0
 		self.is_complete = False
@@ -32,7 +30,6 @@ class Piece:
 			"\npiece_len: {}".format(self.piece_length) + \
 			"\nindex: {}".format(self.index) + \
 			"\nhash (bytes = {}): {}".format(len(self.hash), self.hash) + \
-			"\ntemp_location = {}".format(self.temp_location) + \
 			"\nprogress = {}".format(self.progress) + \
 			"\ndownloaded data: (bytes = {})".format(len([val for val in self.data if val != 0]))
 
@@ -40,21 +37,24 @@ class Piece:
 
 	def get_next_begin(self):
 		"""
-		Gets the next index for a request to be sent to a remote peer for download
-		:return: int representing index to be requested
+		Gets the next index for a request to be sent to a remote peer for download. Blocks whose
+		requests were reclaimed are handed out again.
+		:return: int representing index to be requested, or None if every block has been received
+			or requested
 		"""
-		# TODO: does assume sequential download of blocks
-		# 		i.e. all blocks before the next have all been downloaded or requested for
-		if len(self.non_completed_request_indices + self.completed_request_indices) > 0:
-			return max(self.non_completed_request_indices + self.completed_request_indices) + REQUEST_SIZE
-		else:
-			return 0
-
-	def write_to_temporary_storage(self):
-		if self.is_complete:
-			with open(self.temp_location, "w") as temp_file:
-				for datum in self.data:
-					temp_file.write(datum)
+		for begin in range(0, self.piece_length, REQUEST_SIZE):
+			if begin not in self.completed_request_indices and begin not in self.non_completed_request_indices:
+				return begin
+		return None
+
+	def get_block_length(self, begin):
+		"""
+		Returns the length of the block starting at begin (the last block of a piece that isn't a
+		multiple of REQUEST_SIZE, such as the last piece of the torrent, is shorter)
+		:param begin: offset of the block in the piece
+		:return: int
+		"""
+		return min(REQUEST_SIZE, self.piece_length - begin)
 
 	def update_progress(self):
 		self.progress = ((len(self.data) - self.data.count(0)) / float(len(self.data))) * 100
@@ -65,6 +65,15 @@ class Piece:
 	def add_non_completed_request_index(self, request_message):
 		self.non_completed_request_indices.append(int(request_message.get_begin()))
 
+	def remove_non_completed_request_index(self, request_message):
+		"""
+		Returns the block of an outstanding request to the piece so that it can be requested again
+		:param request_message: reclaimed request
+		:return: void
+		"""
+		if request_message.get_begin() in self.non_completed_request_indices:
+			self.non_completed_request_indices.remove(request_message.get_begin())
+
 	def append_data(self, piece_message):
 		# DEBUG
 
@@ -73,6 +82,11 @@ class Piece:
 		# print ("completed indices: {}".format(",".join(str(a) for a in self.completed_request_indices)))
 		# print ("non-completed indices: {}".format(",".join(str(a) for a in self.non_completed_request_indices)))
 
+		if piece_message.get_begin() in self.completed_request_indices:
+			# a duplicate of a block that another peer already sent
+			self.remove_non_completed_request_index(piece_message)
+			return
+
 		for x in range(0, len(piece_message.block)):
 			self.data[piece_message.get_begin() + x] = piece_message.block[x]
 
@@ -84,11 +98,31 @@ class Piece:
 		# print ("completed indices: {}".format(",".join(str(a) for a in self.completed_request_indices)))
 		# print ("non-completed indices: {}".format(",".join(str(a) for a in self.non_completed_request_indices)))
 
+	def get_completed_blocks(self):
+		"""
+		Returns the blocks received so far (for saving an unfinished piece)
+		:return: list of (begin, block data)
+		"""
+		return [(begin, "".join(self.data[begin:begin + REQUEST_SIZE])) for begin in sorted(self.completed_request_indices)]
+
+	def restore_block(self, begin, block):
+		"""
+		Puts back a block received in an earlier session
+		:param begin: offset of the block in the piece
+		:param block: block data
+		:return: void
+		"""
+		self.data[begin:begin + len(block)] = list(block)
+		if begin not in self.completed_request_indices:
+			self.completed_request_indices.append(begin)
+		self.update_progress()
+
 	def non_completed_request_exists(self, request_message):
 		return request_message.get_begin() in self.non_completed_request_indices
 
 	def data_matches_hash(self):
-		current_hash = hashlib.sha1("".join(byte for byte in self.data)).digest()
+		# the data is exactly piece_length long, so a short last piece is hashed without padding
+		current_hash = hashlib.sha1("".join(self.data[:self.piece_length])).digest()
 		# DEBUG
 		# print ("Comparing hashes for completed piece")
 		# print ("Current hash: {}".format(format_hex_output(current_hash)))
@@ -104,8 +138,35 @@ class Piece:
 		return self.index
 
 	def reset(self):
-		self.data = []
+		self.data = [0] * self.piece_length
 		self.progress = 0.0
 		self.is_complete = False
 		self.completed_request_indices = []
 		self.non_completed_request_indices = []
+
+
+class PieceHashes:
+	"""
+	The SHA1 hashes of a torrent's pieces, kept as the single contiguous `pieces` string from the
+	metainfo. Hashes are sliced out of it on access instead of being split into a list of
+	1M small strings up front.
+	"""
+	def __init__(self, pieces, hash_length=20):
+		"""
+		:param pieces: concatenated piece hashes (string or buffer)
+		:param hash_length: bytes per hash
+		"""
+		if len(pieces) % hash_length != 0:
+			raise ValueError("pieces length ({}) is not a multiple of {}".format(len(pieces), hash_length))
+		self.view = memoryview(pieces)
+		self.hash_length = hash_length
+
+	def __len__(self):
+		return len(self.view) / self.hash_length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("piece index out of range")
+		return self.view[index * self.hash_length:(index + 1) * self.hash_length].tobytes()
@@ -1,6 +1,6 @@
 from twisted.internet.protocol import Protocol, ClientFactory
 import time
-from messages import StreamProcessor
+from messages import StreamProcessor, BitfieldMessage
 from constants import PEER_INACTIVITY_LIMIT
 from helpermethods import format_hex_output
 
@@ -20,20 +20,53 @@ class PeerProtocol(Protocol):
 		self.handshake_exchanged = False
 		self.stream_processor = StreamProcessor(self.factory.torrent)
 		self.outgoing_messages = []
+		self.inactivity_check = None
 
 	def connectionMade(self):
 		# DEBUG
 		# print ("Connection made to peer ({}:{})".format(self.peer.ip, self.peer.port))
 		# print ("Sending handshake: {}".format(self.factory.torrent.get_handshake()))
 
+		self.peer.protocol = self
+		self.peer.attach_buckets()
 		self.transport.write(self.factory.torrent.get_handshake())
+		# the bitfield may only be sent as the first message after the handshake, so it goes out
+		# straight away (and not at all if we have nothing yet)
+		bitfield = self.factory.torrent.bitfield
+		if bitfield.any():
+			self.write_message(BitfieldMessage(bitfield=bitfield.tobytes()))
+
+	def connectionLost(self, reason):
+		self.factory.torrent.rate_limiter.forget(self.transport, self.peer.upload_bucket)
+		if self.peer.protocol is self:
+			self.peer.protocol = None
+			self.peer.detach_buckets()
+		if self.inactivity_check is not None and self.inactivity_check.active():
+			self.inactivity_check.cancel()
+
+	def write_message(self, message):
+		"""
+		Writes a single message to the peer immediately (used for messages generated outside of
+		`dataReceived`, such as choke decisions)
+		:param message: Message to write
+		:return: void
+		"""
+		self.transport.write(message.message())
+		self.peer.update_last_contact()
 
 	def dataReceived(self, data):
 		self.process_stream(data)
 		self.send_next_messages()
 
-		# adds the deferred for killing the connection due to inactivity
-		self.reactor.callLater(PEER_INACTIVITY_LIMIT, self.disconnect_with_inactivity)
+		# stop reading from the socket if we are over the download limit
+		self.factory.torrent.rate_limiter.throttle_download(self.transport, self.peer.download_bucket, len(data))
+
+		# (re)schedules the deferred for killing the connection due to inactivity. A single call is
+		# pushed back on every read rather than adding a new one each time.
+		if self.inactivity_check is not None and self.inactivity_check.active():
+			self.inactivity_check.reset(PEER_INACTIVITY_LIMIT)
+		else:
+			self.inactivity_check = self.reactor.callLater(PEER_INACTIVITY_LIMIT, self.disconnect_with_inactivity)
 		# DEBUG
 		# print ("ADDED THE CALLBACK")
 
@@ -43,6 +76,12 @@ class PeerProtocol(Protocol):
 		self.stream_processor.parse_stream(stream_data=data)
 		self.peer.received_messages(self.stream_processor.get_complete_messages())
 
+		# the handshake is checked against the torrent once, when it arrives
+		if not self.handshake_exchanged and self.peer.handshake_exchanged:
+			self.handshake_exchanged = True
+			if self.peer.info_hash != self.factory.torrent.info_hash:
+				self.transport.loseConnection()
+
 		# DEBUG
 		# print ("Complete messages:")
 		# print ("".join(str(a) for a in self.stream_processor.get_complete_messages()))
@@ -59,14 +98,6 @@ class PeerProtocol(Protocol):
 		following client execution of peer messages that are found in the actions queue
 		`self.client_responses`. This action queue is populated by ..."""
 
-		"""
-		If handshaking has occurred, check to see if the given matches the torrent. If not,
-		terminate the connection
-		"""
-		if self.handshake_exchanged:
-			if self.peer.info_hash != self.factory.torrent.generate_hex_info_hash():
-				self.transport.loseConnection()
-
 		# DEBUG
 		# print ("Checking on Torrent to see how to proceed")
 		self.factory.torrent.process_next_round(self.peer)
@@ -84,6 +115,10 @@ class PeerProtocol(Protocol):
 
 		self.outgoing_messages = []
 
+		# hash-check and save finished pieces only after the next requests are on the wire, so the
+		# peer keeps sending while we verify
+		self.factory.torrent.verify_completed_pieces()
+
 		#self.factory.torrent.print_status()
 
 	def disconnect_with_inactivity(self):
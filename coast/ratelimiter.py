@@ -0,0 +1,268 @@
+from twisted.internet import reactor, task
+
+from ratemeter import RateMeter
+from constants import RATE_LIMIT_REFILL_INTERVAL, RATE_LIMIT_BURST
+
+"""
+Token bucket rate limiting for download and upload bandwidth.
+
+Buckets form a tree: one global bucket per direction (owned by the Core), one child per torrent and
+one grandchild per peer. Traffic is charged to a bucket and all of its ancestors. When any bucket in
+the chain runs dry the peer's transport is paused (instead of sleeping), and it is resumed on the
+next refill that leaves the whole chain with tokens.
+
+Peer buckets only exist while the peer is connected. The refills only run while some bucket has a
+limit, an unlimited client doesn't wake up every RATE_LIMIT_REFILL_INTERVAL for nothing.
+"""
+
+
+class TokenBucket:
+	def __init__(self, rate=0, parent=None):
+		"""
+		:param rate: bytes / second (0 for unlimited)
+		:param parent: TokenBucket this bucket draws from as well
+		"""
+		self.rate = rate
+		self.parent = parent
+		self.children = []
+		self.tokens = self.get_capacity()
+		# tokens this bucket may still take from its parent before the next refill (None if unbounded)
+		self.share = None
+		self.active = False
+
+		if parent is not None:
+			parent.children.append(self)
+
+	def add_child(self, rate=0):
+		return TokenBucket(rate, parent=self)
+
+	def remove(self):
+		"""
+		Detaches the bucket from its parent
+		:return: void
+		"""
+		if self.parent is not None and self in self.parent.children:
+			self.parent.children.remove(self)
+
+	def is_limited(self):
+		return self.rate > 0
+
+	def has_limits(self):
+		"""
+		Returns true if this bucket or any of its descendants has a limit
+		:return: boolean
+		"""
+		return self.is_limited() or any(child.has_limits() for child in self.children)
+
+	def get_capacity(self):
+		return self.rate * RATE_LIMIT_BURST
+
+	def get_effective_rate(self):
+		"""
+		Returns the tightest limit along the chain of buckets up to the root
+		:return: bytes / second (0 for unlimited)
+		"""
+		rates = []
+		bucket = self
+		while bucket is not None:
+			if bucket.is_limited():
+				rates.append(bucket.rate)
+			bucket = bucket.parent
+
+		if len(rates) == 0:
+			return 0
+		return min(rates)
+
+	def set_rate(self, rate):
+		"""
+		Changes the rate of the bucket. Takes effect at the next refill.
+		:param rate: bytes / second (0 for unlimited)
+		:return: void
+		"""
+		self.rate = rate
+		self.tokens = min(self.tokens, self.get_capacity())
+
+	def get_available(self):
+		"""
+		Returns the number of tokens this bucket can hand out right now
+		:return: tokens, or None if unbounded
+		"""
+		available = None
+		if self.is_limited():
+			available = self.tokens
+		if self.share is not None:
+			available = self.share if available is None else min(available, self.share)
+		return available
+
+	def consume(self, amount):
+		"""
+		Charges the given number of bytes to this bucket and all of its ancestors. Buckets may go
+		into debt since data that has already been read can not be refused.
+		:param amount: number of bytes
+		:return: void
+		"""
+		self.active = True
+		if self.is_limited():
+			self.tokens -= amount
+		if self.share is not None:
+			self.share -= amount
+		if self.parent is not None:
+			self.parent.consume(amount)
+
+	def is_exhausted(self):
+		"""
+		Returns true if this bucket or any of its ancestors has run out of tokens
+		:return: boolean
+		"""
+		available = self.get_available()
+		if available is not None and available <= 0:
+			return True
+		if self.parent is not None:
+			return self.parent.is_exhausted()
+		return False
+
+	def refill(self, elapsed):
+		"""
+		Adds the tokens earned over the elapsed time and splits what this bucket can give out among
+		its busy children, so a single fast torrent or peer can not starve the others.
+
+		:param elapsed: seconds since the previous refill
+		:return: void
+		"""
+		if self.is_limited():
+			self.tokens = min(self.get_capacity(), self.tokens + self.rate * elapsed)
+
+		available = self.get_available()
+		busy_children = len([child for child in self.children if child.active])
+		for child in self.children:
+			if available is None:
+				child.share = None
+			else:
+				child.share = max(available, 0) / float(max(busy_children, 1))
+			child.active = False
+			child.refill(elapsed)
+
+
+class RateLimiter:
+	def __init__(self, download_rate=0, upload_rate=0, clock=reactor):
+		"""
+		:param download_rate: global download limit in bytes / second (0 for unlimited)
+		:param upload_rate: global upload limit in bytes / second (0 for unlimited)
+		:param clock: IReactorTime provider
+		"""
+		self.download = TokenBucket(download_rate)
+		self.upload = TokenBucket(upload_rate)
+		# client-wide traffic meters (torrents and peers record on children of these)
+		self.download_meter = RateMeter()
+		self.upload_meter = RateMeter()
+		self.clock = clock
+		self.paused_transports = []
+		self.upload_waiters = []
+		self.looping_call = None
+		self.last_refill = None
+		self.started = False
+
+	def start(self):
+		self.started = True
+		self.update_refills()
+
+	def stop(self):
+		self.started = False
+		if self.looping_call is not None and self.looping_call.running:
+			self.looping_call.stop()
+		self.looping_call = None
+
+	def update_refills(self):
+		"""
+		Runs the refills while the limiter is started and a limit is set anywhere in the trees, and
+		stops them otherwise (after a last refill that lifts the shares and wakes up whatever the
+		removed limits were holding back). Called whenever a rate changes.
+		:return: void
+		"""
+		limited = self.download.has_limits() or self.upload.has_limits()
+		running = self.looping_call is not None and self.looping_call.running
+		if self.started and limited and not running:
+			self.last_refill = self.clock.seconds()
+			self.looping_call = task.LoopingCall(self.refill)
+			self.looping_call.clock = self.clock
+			self.looping_call.start(RATE_LIMIT_REFILL_INTERVAL, now=False)
+		elif running and not limited:
+			self.looping_call.stop()
+			self.looping_call = None
+			self.refill()
+
+	def set_download_rate(self, rate):
+		self.download.set_rate(rate)
+		self.update_refills()
+
+	def set_upload_rate(self, rate):
+		self.upload.set_rate(rate)
+		self.update_refills()
+
+	def throttle_download(self, transport, bucket, amount):
+		"""
+		Charges received bytes to the given bucket, pausing the transport if the bucket (or one of
+		its ancestors) has run out of tokens.
+
+		:param transport: transport the data was read from
+		:param bucket: the peer's download bucket
+		:param amount: number of bytes received
+		:return: void
+		"""
+		bucket.consume(amount)
+		if bucket.is_exhausted() and not self.is_paused(transport):
+			transport.pauseProducing()
+			self.paused_transports.append((transport, bucket))
+
+	def wait_for_upload(self, bucket, callback):
+		"""
+		Calls the callback on the first refill that leaves the given upload bucket with tokens
+		:param bucket: the peer's upload bucket
+		:param callback: callable taking no arguments
+		:return: void
+		"""
+		self.upload_waiters.append((bucket, callback))
+
+	def is_paused(self, transport):
+		return transport in [paused_transport for paused_transport, bucket in self.paused_transports]
+
+	def forget(self, transport, upload_bucket=None):
+		"""
+		Stops tracking a transport (e.g. after its connection is lost)
+		:param transport: transport to forget
+		:param upload_bucket: upload bucket of the peer, whose waiting uploads are dropped
+		:return: void
+		"""
+		self.paused_transports = [(paused_transport, bucket) for paused_transport, bucket in
+								  self.paused_transports if paused_transport is not transport]
+		if upload_bucket is not None:
+			self.upload_waiters = [(bucket, callback) for bucket, callback in self.upload_waiters
+								   if bucket is not upload_bucket]
+
+	def refill(self):
+		"""
+		Refills every bucket and resumes the transports and uploads that can run again
+		:return: void
+		"""
+		current_time = self.clock.seconds()
+		elapsed = current_time - self.last_refill if self.last_refill is not None else 0
+		self.last_refill = current_time
+
+		self.download.refill(elapsed)
+		self.upload.refill(elapsed)
+
+		still_paused = []
+		for transport, bucket in self.paused_transports:
+			if bucket.is_exhausted():
+				still_paused.append((transport, bucket))
+			else:
+				transport.resumeProducing()
+		self.paused_transports = still_paused
+
+		waiters = self.upload_waiters
+		self.upload_waiters = []
+		for bucket, callback in waiters:
+			if bucket.is_exhausted():
+				self.upload_waiters.append((bucket, callback))
+			else:
+				callback()
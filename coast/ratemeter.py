@@ -0,0 +1,102 @@
+import time
+
+from constants import RATE_METER_WINDOW, RATE_METER_HALF_LIFE
+
+"""
+Transfer rate meters.
+
+Meters form a tree like the token buckets: one global meter per direction (owned by the
+RateLimiter), one child per torrent and one grandchild per peer. Bytes recorded on a meter are
+recorded on all of its ancestors as well, so reading the rate of a peer, a torrent or the whole
+client never has to look at individual messages.
+
+Traffic is counted in one second slots. Each meter keeps an exponentially weighted moving average
+of the slots (smooth, used for choking) and a short ring of the most recent slots (responsive,
+used for display). Recording and reading are both constant time.
+"""
+
+DECAY = 0.5 ** (1.0 / RATE_METER_HALF_LIFE)
+
+
+class RateMeter:
+	def __init__(self, parent=None):
+		"""
+		:param parent: RateMeter that sees all of this meter's traffic as well
+		"""
+		self.parent = parent
+		self.total = 0
+		self.average = 0.0
+		self.history = [0] * RATE_METER_WINDOW
+		self.history_total = 0
+		self.current_second = None
+
+	def add_child(self):
+		return RateMeter(parent=self)
+
+	def advance(self, current_time):
+		"""
+		Closes the slots that have ended by the given time, folding them into the average and
+		clearing their place in the ring
+		:param current_time: seconds
+		:return: void
+		"""
+		second = int(current_time)
+		if self.current_second is None:
+			self.current_second = second
+			return
+
+		elapsed = second - self.current_second
+		if elapsed <= 0:
+			return
+
+		# fold the closed slot into the average, then decay it once for every empty slot after it
+		closed = self.history[self.current_second % RATE_METER_WINDOW]
+		self.average = (self.average * DECAY + closed * (1 - DECAY)) * DECAY ** (elapsed - 1)
+
+		for skipped in range(1, min(elapsed, RATE_METER_WINDOW) + 1):
+			slot = (self.current_second + skipped) % RATE_METER_WINDOW
+			self.history_total -= self.history[slot]
+			self.history[slot] = 0
+		self.current_second = second
+
+	def update(self, amount, current_time=None):
+		"""
+		Records transferred bytes on this meter and all of its ancestors
+		:param amount: number of bytes
+		:param current_time: time of the transfer (defaults to now)
+		:return: void
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		self.advance(current_time)
+		self.total += amount
+		self.history[self.current_second % RATE_METER_WINDOW] += amount
+		self.history_total += amount
+
+		if self.parent is not None:
+			self.parent.update(amount, current_time)
+
+	def get_rate(self, current_time=None):
+		"""
+		Returns the moving average rate (only counts whole seconds)
+		:param current_time: defaults to now
+		:return: bytes / second
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		self.advance(current_time)
+		return self.average
+
+	def get_window_rate(self, current_time=None):
+		"""
+		Returns the average rate over the last RATE_METER_WINDOW seconds (including the current one)
+		:param current_time: defaults to now
+		:return: bytes / second
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		self.advance(current_time)
+		return float(self.history_total) / RATE_METER_WINDOW
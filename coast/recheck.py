@@ -0,0 +1,130 @@
+import os
+import hashlib
+import threading
+import multiprocessing
+
+from constants import RECHECK_PROCESSES, RECHECK_CHUNK_PIECES, RECHECK_READ_SIZE
+
+"""
+This class hashes a torrent's downloaded pieces against the metainfo, spread over a pool of
+processes.
+
+The pieces found in storage are split into chunks of consecutive indices. The storage says which
+byte ranges of which files hold each piece (piece files, the torrent's files through the FileMap or
+the pack), so the workers read them straight from disk whatever the backend. Each worker hashes a
+chunk and sends back the indices that matched and the ones that didn't, and the torrent's
+bitfield is updated as every chunk comes in, so progress is visible (and usable) while the
+recheck is still running. A recheck can be cancelled from another thread, which stops the pool.
+"""
+
+
+def hash_range(piece_hash, handle, offset, length):
+	"""
+	Feeds a byte range of an open file to a hash
+	:return: True if the whole range could be read
+	"""
+	os.lseek(handle, offset, os.SEEK_SET)
+	while length > 0:
+		data = os.read(handle, min(length, RECHECK_READ_SIZE))
+		if len(data) == 0:
+			return False
+		piece_hash.update(data)
+		length -= len(data)
+	return True
+
+
+def hash_pieces(pieces):
+	"""
+	Hashes a chunk of pieces (runs in a worker process). A piece that can't be read in full counts
+	as not matching, as if it were missing.
+	:param pieces: list of (index, expected hash, list of (path, offset, length) holding the piece)
+	:return: (list of matching indices, list of non-matching indices)
+	"""
+	valid = []
+	invalid = []
+	# consecutive pieces mostly lie in the same files
+	handles = {}
+	try:
+		for index, expected_hash, ranges in pieces:
+			piece_hash = hashlib.sha1()
+			try:
+				for path, offset, length in ranges:
+					if path not in handles:
+						handles[path] = os.open(path, os.O_RDONLY)
+					if not hash_range(piece_hash, handles[path], offset, length):
+						break
+				else:
+					if piece_hash.digest() == expected_hash:
+						valid.append(index)
+						continue
+			except (IOError, OSError):
+				pass
+			invalid.append(index)
+	finally:
+		for handle in handles.values():
+			os.close(handle)
+	return valid, invalid
+
+
+class Recheck:
+	def __init__(self, torrent, processes=RECHECK_PROCESSES, chunk_pieces=RECHECK_CHUNK_PIECES):
+		"""
+		:param torrent: Torrent to recheck
+		:param processes: worker processes (0 for one per cpu, 1 to hash in this process)
+		:param chunk_pieces: pieces handed to a worker at a time
+		"""
+		self.torrent = torrent
+		self.processes = processes if processes > 0 else multiprocessing.cpu_count()
+		self.chunk_pieces = chunk_pieces
+		self.cancelled = threading.Event()
+		self.pieces_total = 0
+		self.pieces_checked = 0
+
+	def get_progress(self):
+		if self.pieces_total == 0:
+			return 100.0
+		return float(self.pieces_checked) / self.pieces_total * 100
+
+	def cancel(self):
+		self.cancelled.set()
+
+	def run(self, progress_callback=None):
+		"""
+		Rechecks every stored piece, setting the torrent's bitfield for the ones that match and
+		removing the ones that don't from storage.
+
+		:param progress_callback: called with (pieces checked, pieces total) after every chunk
+		:return: True if the recheck finished, False if it was cancelled
+		"""
+		storage = self.torrent.storage
+		indices = storage.get_stored_pieces()
+		self.pieces_total = len(indices)
+		self.pieces_checked = 0
+		chunks = [[(index, self.torrent.pieces_hashes[index], storage.get_piece_ranges(index))
+				   for index in indices[start:start + self.chunk_pieces]]
+				  for start in range(0, len(indices), self.chunk_pieces)]
+
+		pool = None
+		if self.processes > 1 and len(chunks) > 1:
+			pool = multiprocessing.Pool(self.processes)
+			results = pool.imap_unordered(hash_pieces, chunks)
+		else:
+			results = (hash_pieces(chunk) for chunk in chunks)
+
+		try:
+			for valid, invalid in results:
+				for index in valid:
+					self.torrent.bitfield[index] = 1
+				for index in invalid:
+					storage.remove_piece(index)
+				self.pieces_checked += len(valid) + len(invalid)
+				if progress_callback is not None:
+					progress_callback(self.pieces_checked, self.pieces_total)
+				if self.cancelled.is_set():
+					return False
+		finally:
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+
+		return True
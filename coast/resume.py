@@ -0,0 +1,57 @@
+import os
+
+import bencode
+
+"""
+This class reads and writes a torrent's fast-resume file.
+
+The resume file holds everything needed to pick a download back up without looking at the
+downloaded data: the bitfield, the blocks received for pieces that weren't finished and a
+fingerprint (sizes and modification times) of the storage. It is bencoded, and written to a
+temporary file that is then renamed over the old one, so a crash mid-write never leaves a
+half-written resume file behind.
+"""
+
+
+class ResumeFile:
+	def __init__(self, path):
+		self.path = path
+
+	def save(self, resume_data):
+		"""
+		Atomically replaces the resume file
+		:param resume_data: dict of bencodable values
+		:return: void
+		"""
+		temporary_path = self.path + ".part"
+		with open(temporary_path, "wb") as temporary_file:
+			bencode.BEncoder(sink=temporary_file).encode(resume_data)
+			temporary_file.flush()
+			os.fsync(temporary_file.fileno())
+		os.rename(temporary_path, self.path)
+		# the rename is only durable once the directory holding it is synced
+		handle = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+		try:
+			os.fsync(handle)
+		finally:
+			os.close(handle)
+
+	def load(self):
+		"""
+		Reads the resume file
+		:return: dict, or None if there is no (readable) resume file
+		"""
+		if not os.path.isfile(self.path):
+			return None
+		try:
+			with open(self.path, "rb") as resume_file:
+				resume_data = bencode.bdecode(resume_file.read())
+		except (IOError, bencode.BTFailure):
+			return None
+		if not isinstance(resume_data, dict):
+			return None
+		return resume_data
+
+	def remove(self):
+		if os.path.isfile(self.path):
+			os.remove(self.path)
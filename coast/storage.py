@@ -0,0 +1,440 @@
+import os
+import errno
+
+from constants import ASSEMBLY_BUFFER_SIZE
+from helpermethods import make_dir
+from allocation import preallocate, get_allocated_bytes
+
+"""
+The storage backends a torrent keeps its downloaded pieces in.
+
+Every backend implements the Storage interface: verified pieces (or blocks of them) are written,
+blocks are read back for seeding and streaming, flush() makes what was written durable and
+finalize() leaves the torrent's files in place once the download is complete. Pieces are
+addressed by index and byte offset, the FileMap of the torrent says where they live in its files.
+
+	PieceDirStorage		a file per piece in tmp/, compiled into the torrent's files at the end
+	FileStorage			written straight into the torrent's files
+	MmapStorage			memory mapped torrent files (see mmapstorage.py)
+	PackStorage			a single append-only pack file in tmp/ (see packstorage.py)
+	MemoryStorage		kept in memory only, so that benchmarks and simulations measure the network
+						and the cpu without the disk
+"""
+
+
+def get_files_fingerprint(file_map):
+	"""
+	Returns the size and modification time of every file of the torrent that exists
+	:param file_map: FileMap of the torrent
+	:return: list of [name, size, mtime in microseconds]
+	"""
+	fingerprint = []
+	for name, path in zip(file_map.names, file_map.paths):
+		if os.path.isfile(path):
+			status = os.stat(path)
+			fingerprint.append([name, status.st_size, int(status.st_mtime * 1000000)])
+	return fingerprint
+
+
+def preallocate_files(file_map):
+	"""
+	Allocates the files of the torrent that aren't skipped at their full length
+	:param file_map: FileMap of the torrent
+	:return: number of files that were (further) allocated
+	"""
+	allocated = 0
+	for file_index, path in enumerate(file_map.paths):
+		length = file_map.lengths[file_index]
+		if file_index in file_map.skipped_files or length == 0 or get_allocated_bytes(path) >= length:
+			continue
+		make_dir(os.path.dirname(path))
+		handle = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			preallocate(handle, length)
+		finally:
+			os.close(handle)
+		allocated += 1
+	return allocated
+
+
+def get_wanted_bytes(file_map):
+	return sum(length for file_index, length in enumerate(file_map.lengths) if file_index not in file_map.skipped_files)
+
+
+class Storage:
+	# whether the data outlives the process (a resume file is only worth keeping if it does)
+	persistent = True
+
+	def __init__(self, file_map, download_root):
+		"""
+		:param file_map: FileMap of the torrent (spans, paths and skipped files)
+		:param download_root: directory the torrent is downloaded to
+		"""
+		self.file_map = file_map
+		self.download_root = download_root
+		# pieces being / already moved into the torrent's files by finalize()
+		self.assembly_total = 0
+		self.assembly_done = 0
+
+	def write_block(self, index, begin, data):
+		"""
+		Stores a block of a piece
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param data: block data
+		:return: void
+		"""
+		raise NotImplementedError
+
+	def write_piece(self, index, data):
+		self.write_block(index, 0, data)
+
+	def write_pieces(self, index, data):
+		"""
+		Stores a run of consecutive pieces (each but the last a full piece)
+		:param index: index of the first piece
+		:param data: data of the pieces, concatenated
+		:return: void
+		"""
+		piece_length = self.file_map.piece_length
+		for data_offset in range(0, len(data), piece_length):
+			self.write_piece(index + data_offset / piece_length, data[data_offset:data_offset + piece_length])
+
+	def read_block(self, index, begin, length):
+		"""
+		Reads a block of a piece
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: block data, or None if the storage doesn't hold all of it
+		"""
+		raise NotImplementedError
+
+	def read_piece(self, index):
+		return self.read_block(index, 0, self.file_map.get_piece_length(index))
+
+	def has_piece(self, index):
+		"""
+		Returns True if the storage holds data for the whole piece (it is not hashed)
+		:param index: index of the piece
+		:return: boolean
+		"""
+		raise NotImplementedError
+
+	def remove_piece(self, index):
+		"""
+		Discards a piece that failed its hash check, where the backend can
+		:param index: index of the piece
+		:return: void
+		"""
+		pass
+
+	def get_stored_pieces(self):
+		"""
+		Returns the pieces worth hashing in a recheck (see has_piece)
+		:return: sorted list of piece indices
+		"""
+		return [index for index in range(self.file_map.get_piece_count()) if self.has_piece(index)]
+
+	def get_piece_ranges(self, index):
+		"""
+		Returns where the data of a piece lies on disk, for a recheck to read it without the storage
+		(the torrent's files, through the FileMap, by default)
+		:param index: index of the piece
+		:return: list of (path, offset within the file, length)
+		"""
+		return [(self.file_map.paths[file_index], file_offset, span_length)
+				for file_index, file_offset, span_length in self.file_map.get_piece_spans(index)]
+
+	def get_indexed_pieces(self):
+		"""
+		Returns the pieces the storage recorded as written, for backends that keep such a record
+		(only verified pieces are written, so these don't have to be rechecked)
+		:return: sorted list of piece indices, or None
+		"""
+		return None
+
+	def get_fingerprint(self):
+		"""
+		Returns what the resume file checks to tell whether the storage changed behind its back
+		:return: list of [name, size, mtime in microseconds]
+		"""
+		return get_files_fingerprint(self.file_map)
+
+	def preallocate(self):
+		"""
+		Allocates the space the wanted files will take, for backends that write into them
+		:return: number of files that were allocated
+		"""
+		return 0
+
+	def get_allocated_bytes(self):
+		"""
+		Returns the disk space the storage takes now
+		:return: bytes
+		"""
+		return sum(get_allocated_bytes(path) for path in self.file_map.paths)
+
+	def get_required_bytes(self):
+		"""
+		Returns the disk space the storage still needs to hold the wanted files
+		:return: bytes
+		"""
+		return max(0, get_wanted_bytes(self.file_map) - self.get_allocated_bytes())
+
+	def flush(self):
+		pass
+
+	def finalize(self, pieces, preserve_tmp=False):
+		"""
+		Leaves the completed torrent in its files (skipped files aside)
+		:param pieces: sorted indices of the downloaded pieces (by the bitfield)
+		:param preserve_tmp: keep temporary data afterwards
+		:raises IOError: if a downloaded piece is missing from storage
+		:return: void
+		"""
+		self.flush()
+		self.file_map.create_empty_files()
+
+	def get_assembly_progress(self):
+		"""
+		Returns how far finalize() has got
+		:return: percentage
+		"""
+		if self.assembly_total == 0:
+			return 100.0
+		return 100.0 * self.assembly_done / self.assembly_total
+
+	def close(self):
+		pass
+
+
+class PieceDirStorage(Storage):
+	def __init__(self, file_map, download_root):
+		Storage.__init__(self, file_map, download_root)
+		self.directory = os.path.join(download_root, "tmp/")
+		make_dir(self.directory)
+		# pieces written since the last flush
+		self.unsynced_pieces = set()
+
+	def get_piece_path(self, index):
+		return os.path.join(self.directory, "{}.piece".format(str(index).zfill(8)))
+
+	def write_block(self, index, begin, data):
+		piece_path = self.get_piece_path(index)
+		with open(piece_path, "r+b" if os.path.isfile(piece_path) else "wb") as piece_file:
+			piece_file.seek(begin)
+			piece_file.write(data)
+		self.unsynced_pieces.add(index)
+
+	def write_piece(self, index, data):
+		with open(self.get_piece_path(index), "wb") as piece_file:
+			piece_file.write(data)
+		self.unsynced_pieces.add(index)
+
+	def read_block(self, index, begin, length):
+		try:
+			with open(self.get_piece_path(index), "rb") as piece_file:
+				piece_file.seek(begin)
+				block = piece_file.read(length)
+		except IOError:
+			# the piece files are gone once they have been compiled into the torrent's files
+			return self.file_map.read_block(index, begin, length)
+
+		if len(block) != length:
+			return None
+		return block
+
+	def has_piece(self, index):
+		piece_path = self.get_piece_path(index)
+		return os.path.isfile(piece_path) and os.path.getsize(piece_path) >= self.file_map.get_piece_length(index)
+
+	def remove_piece(self, index):
+		if os.path.isfile(self.get_piece_path(index)):
+			os.remove(self.get_piece_path(index))
+
+	def get_stored_pieces(self):
+		# one listing of tmp/ instead of a stat per piece
+		if not os.path.isdir(self.directory):
+			return Storage.get_stored_pieces(self)
+		piece_count = self.file_map.get_piece_count()
+		indices = []
+		for file_name in os.listdir(self.directory):
+			if not file_name.endswith(".piece"):
+				continue
+			try:
+				index = int(file_name.split(".")[0])
+			except ValueError:
+				continue
+			if index < piece_count:
+				indices.append(index)
+		return sorted(indices)
+
+	def get_piece_ranges(self, index):
+		if not os.path.isdir(self.directory):
+			return Storage.get_piece_ranges(self, index)
+		return [(self.get_piece_path(index), 0, self.file_map.get_piece_length(index))]
+
+	def flush(self):
+		"""
+		Syncs the piece files written since the last flush, then tmp/ itself so that the new files
+		can be found after a crash
+		"""
+		if len(self.unsynced_pieces) == 0 or not os.path.isdir(self.directory):
+			return
+		for index in sorted(self.unsynced_pieces):
+			piece_path = self.get_piece_path(index)
+			if os.path.isfile(piece_path):
+				handle = os.open(piece_path, os.O_RDONLY)
+				try:
+					os.fsync(handle)
+				finally:
+					os.close(handle)
+		handle = os.open(self.directory, os.O_RDONLY)
+		try:
+			os.fsync(handle)
+		finally:
+			os.close(handle)
+		self.unsynced_pieces = set()
+
+	def get_allocated_bytes(self):
+		# the torrent's files only take space once the pieces have been compiled into them
+		allocated = Storage.get_allocated_bytes(self)
+		if os.path.isdir(self.directory):
+			for file_name in os.listdir(self.directory):
+				allocated += get_allocated_bytes(os.path.join(self.directory, file_name))
+		return allocated
+
+	def get_fingerprint(self):
+		# once the pieces have been compiled (and tmp/ removed) the data is in the torrent's files
+		if not os.path.isdir(self.directory):
+			return Storage.get_fingerprint(self)
+		# every piece file, a piece rewritten in place doesn't change tmp/ itself
+		fingerprint = []
+		for file_name in sorted(os.listdir(self.directory)):
+			path = os.path.join(self.directory, file_name)
+			if os.path.isfile(path):
+				status = os.stat(path)
+				fingerprint.append(["tmp/" + file_name, status.st_size, int(status.st_mtime * 1000000)])
+		return fingerprint
+
+	def finalize(self, pieces, preserve_tmp=False):
+		"""
+		Streams the piece files into the torrent's files through one fixed buffer: consecutive
+		pieces are read into it back to back and written out together whenever it is full or the
+		run breaks, and their piece files are removed as soon as they have been written
+		"""
+		missing = [index for index in pieces if not self.has_piece(index)]
+		if len(missing) > 0:
+			raise IOError(errno.ENOENT, "{} piece files are missing from {}, the first is {}".format(
+				len(missing), self.directory, missing[0]))
+
+		print ("Compiling {} pieces into {}".format(len(pieces), self.download_root))
+		self.assembly_total = len(pieces)
+		self.assembly_done = 0
+		assembly_buffer = bytearray(max(ASSEMBLY_BUFFER_SIZE, self.file_map.piece_length))
+		buffer_view = memoryview(assembly_buffer)
+		# pieces in the buffer
+		run = []
+		filled = 0
+		for index in pieces:
+			length = self.file_map.get_piece_length(index)
+			if len(run) > 0 and (index != run[-1] + 1 or filled + length > len(assembly_buffer)):
+				self.write_run(run, buffer(assembly_buffer, 0, filled), preserve_tmp)
+				run = []
+				filled = 0
+
+			with open(self.get_piece_path(index), "rb") as piece_file:
+				if piece_file.readinto(buffer_view[filled:filled + length]) != length:
+					raise IOError(errno.EIO, "Piece file {} is short".format(self.get_piece_path(index)))
+			run.append(index)
+			filled += length
+		if len(run) > 0:
+			self.write_run(run, buffer(assembly_buffer, 0, filled), preserve_tmp)
+
+		if not preserve_tmp:
+			# piece files of pieces we don't have (left behind by an earlier session) go too
+			for file_name in os.listdir(self.directory):
+				os.remove(os.path.join(self.directory, file_name))
+			os.rmdir(self.directory)
+		self.file_map.create_empty_files()
+		self.file_map.close()
+		print ("Finished compiling file")
+
+	def write_run(self, run, data, preserve_tmp):
+		self.file_map.write_block(run[0], 0, data)
+		if not preserve_tmp:
+			for index in run:
+				os.remove(self.get_piece_path(index))
+		self.assembly_done += len(run)
+
+	def close(self):
+		self.file_map.close()
+
+
+class FileStorage(Storage):
+	def write_block(self, index, begin, data):
+		self.file_map.write_block(index, begin, data)
+
+	def write_pieces(self, index, data):
+		# the pieces are contiguous in the files, so the run is one write per file it covers
+		self.file_map.write_block(index, 0, data)
+
+	def read_block(self, index, begin, length):
+		return self.file_map.read_block(index, begin, length)
+
+	def preallocate(self):
+		return preallocate_files(self.file_map)
+
+	def has_piece(self, index):
+		for file_index, file_offset, span_length in self.file_map.get_piece_spans(index):
+			path = self.file_map.paths[file_index]
+			if not os.path.isfile(path) or os.path.getsize(path) < file_offset + span_length:
+				return False
+		return True
+
+	def flush(self):
+		self.file_map.handle_pool.sync()
+
+	def close(self):
+		self.file_map.close()
+
+
+class MemoryStorage(Storage):
+	persistent = False
+
+	def __init__(self, file_map, download_root):
+		Storage.__init__(self, file_map, download_root)
+		# piece index -> bytearray
+		self.pieces = {}
+
+	def write_block(self, index, begin, data):
+		if index not in self.pieces:
+			self.pieces[index] = bytearray(self.file_map.get_piece_length(index))
+		self.pieces[index][begin:begin + len(data)] = data
+
+	def read_block(self, index, begin, length):
+		if index not in self.pieces or begin + length > len(self.pieces[index]):
+			return None
+		return str(self.pieces[index][begin:begin + length])
+
+	def has_piece(self, index):
+		return index in self.pieces
+
+	def remove_piece(self, index):
+		self.pieces.pop(index, None)
+
+	def get_allocated_bytes(self):
+		return sum(len(piece) for piece in self.pieces.values())
+
+	def get_required_bytes(self):
+		return 0
+
+	def get_fingerprint(self):
+		return []
+
+	def finalize(self, pieces, preserve_tmp=False):
+		pass
+
+	def close(self):
+		self.pieces = {}
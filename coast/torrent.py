@@ -1,22 +1,43 @@
 from __future__ import print_function
 import os
 import sys
+import errno
 import time
 import urllib
 import bencode
 import hashlib
 import requests
 import traceback
-from twisted.internet import reactor, task
+import threading
+import numpy
+from bitarray import bitarray
+from twisted.internet import reactor, task, defer, threads
+from twisted.python import threadable
 
 from constants import MAX_PEERS, ERROR_BYTESTRING_CHUNKSIZE, DEBUG, \
 	ACTIVITY_INITIALIZE_NEW, ACTIVITY_INITIALIZE_CONTINUE, ACTIVITY_DOWNLOADING, ACTIVITY_STOPPED, ACTIVITY_COMPLETED, \
-	RESPONSE_TIMEOUT, DOWNLOAD_SPEED_CALCULATION_WINDOW, REQUEST_SIZE
+	ACTIVITY_CHECKING, RESPONSE_TIMEOUT, REQUEST_TIMEOUT_CHECK_INTERVAL, TRACKER_RESPONSE_CHUNK_SIZE, TRACKER_RESPONSE_MAX_SIZE, \
+	TRACKER_RESPONSE_MAX_ELEMENTS, BENCODE_MAX_DEPTH, REQUEST_SIZE, RESUME_FILE_NAME, RESUME_SAVE_INTERVAL, \
+	FILE_PRIORITY_SKIP, FILE_PRIORITY_LOW, FILE_PRIORITY_NORMAL, FILE_PRIORITY_HIGH, STREAMING_WINDOW_PIECES, \
+	STREAMING_PIECE_INTERVAL, STREAMING_FAST_PEERS, STREAMING_ENDGAME_MARGIN, STREAMING_READ_TIMEOUT, \
+	STORAGE_MODE, STORAGE_PIECES, STORAGE_FILES, STORAGE_MMAP, STORAGE_PACK, STORAGE_MEMORY, \
+	STORAGE_FLUSH_INTERVAL
 from peer import Peer
-from piece import Piece
-from messages import HandshakeMessage
+from piece import Piece, PieceHashes
+from choker import Choker
+from ratelimiter import RateLimiter
+from availability import AvailabilityMatrix
+from resume import ResumeFile
+from recheck import Recheck
+from filemap import FileMap, check_path_component
+from storage import PieceDirStorage, FileStorage, MemoryStorage
+from mmapstorage import MmapStorage
+from packstorage import PackStorage
+from writequeue import WriteQueue
+from allocation import get_free_bytes
+from messages import HandshakeMessage, HaveMessage, build_message_headers
 from protocols import PeerFactory
-from helpermethods import one_directory_back, make_dir, tally_messages_by_type
+from helpermethods import make_dir, tally_messages_by_type, convert_int_to_hex
 
 # Error messages
 
@@ -27,18 +48,45 @@ This class represents a torrent. It holds information (metadata) about the torre
 as parsed from the .torrent file.
 """
 
+STORAGE_BACKENDS = {
+	STORAGE_PIECES: PieceDirStorage,
+	STORAGE_FILES: FileStorage,
+	STORAGE_MMAP: MmapStorage,
+	STORAGE_PACK: PackStorage,
+	STORAGE_MEMORY: MemoryStorage
+}
+
+
+def off_reactor_thread():
+	"""
+	Returns true if the reactor is running in another thread, in which case anything touching the
+	torrent's peers or write queue has to be handed to it (blockingCallFromThread)
+	:return: boolean
+	"""
+	return reactor.running and not threadable.isInIOThread()
+
 
 class Torrent:
-	def __init__(self, peer_id, port, torrent_file_path):
+	def __init__(self, peer_id, port, torrent_file_path, rate_limiter=None, storage_mode=STORAGE_MODE):
 		""" initializes the torrent
 
 		:param peer_id -> the peer id of the client
 		:param port -> the port over which connections about the torrent are
 			made
+		:param rate_limiter -> RateLimiter shared between all torrents of the
+			client (an unlimited one is created if not given)
+		:param storage_mode -> STORAGE_PIECES, STORAGE_FILES, STORAGE_MMAP,
+			STORAGE_PACK or STORAGE_MEMORY
 		"""
 		self.peer_id = peer_id
+		self.storage_mode = storage_mode
 		self.port = port
 		self.torrent_file_path = torrent_file_path
+		self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+		self.download_bucket = self.rate_limiter.download.add_child()
+		self.upload_bucket = self.rate_limiter.upload.add_child()
+		self.download_meter = self.rate_limiter.download_meter.add_child()
+		self.upload_meter = self.rate_limiter.upload_meter.add_child()
 		self.torrent_name = None
 		self._announce = None
 
@@ -97,30 +145,72 @@ class Torrent:
 		self.connected_peers = 0
 		self.active_peers = []
 		self.active_peer_indices = []
-		self.assigned_pieces = []
+		# pieces that have been started but not yet verified, keyed by index. Blocks of these pieces
+		# can be requested from any peer that has them.
+		self.partial_pieces = {}
+		self.reclaimed_blocks = {
+			"choke": 0,
+			"timeout": 0,
+			"disconnect": 0
+		}
+		self.request_timeout_check = None
+		self.resume_save = None
+		self.recheck = None
+		# the stored pieces have to be hashed before anything is downloaded, see start_checking()
+		self.recheck_needed = False
+		# thread compiling the pieces into the torrent's files
+		self.assembly = None
+		# streaming: the pieces from the playback cursor on, and those that reads are waiting for,
+		# get deadlines (index -> time) and are fetched from the fastest peers first
+		self.streaming = False
+		self.playback_cursor = 0
+		self.piece_deadlines = {}
+		self.range_waiters = []
+		self.fast_peers = []
+		self.fast_peers_updated = None
+		self.choker = Choker(self, upload_rate_limit=self.upload_bucket.get_effective_rate())
 
 		# Data fields
 		self.download_root = os.path.join(os.path.expanduser("~"), "Downloads/")
 		self.temporary_download_location = None
 		self.peers = []
-		self.bitfield = []
-		self.pieces_hashes = []
+		self.bitfield = bitarray(endian="big")
+		self.pieces_hashes = PieceHashes("")
+		self.file_map = None
+		self.storage = None
+		# verified pieces on their way to storage
+		self.write_queue = None
+		self.storage_flush = None
+		self.piece_lengths = numpy.zeros(0, dtype=numpy.int64)
+		# a piece gets the highest priority of the files it overlaps
+		self.file_priorities = []
+		self.piece_priorities = numpy.zeros(0, dtype=numpy.int8)
+		self.selected_pieces = bitarray(endian="big")
+		self.availability_matrix = AvailabilityMatrix(0)
+		# computed once from the metadata, these are needed on every connection
+		self.info_hash = None
+		self.handshake = None
+		self.message_headers = {}
 
 		try:
 			self.initialize_metadata_from_file()
 		except Exception as e:
 			raise Exception("Problem processing .torrent file\n{}".format(e.message))
 
+		self.handshake = HandshakeMessage(info_hash=self.info_hash, peer_id=self.peer_id).message()
+		self.message_headers = build_message_headers(len(self.pieces_hashes), self.get_block_lengths())
+
 		# Initialize the tracker request fields
 		self.tracker_request["peer_id"] = peer_id
 		self.tracker_request["port"] = port
 		self.tracker_request["info_hash"] = self.generate_info_hash()
-		self.tracker_request["left"] = self.metadata["info"]["length"]
+		self.tracker_request["left"] = self.file_map.total_length
 
 		# Make the temp dir for piece downloading
 		make_dir(os.path.join(self.download_root))
 
 		# establish existing progress from earlier session
+		self.resume_file = ResumeFile(os.path.join(self.download_root, RESUME_FILE_NAME))
 		self.initialize_previously_downloaded_progress()
 
 	def initialize_metadata_from_file(self):
@@ -134,7 +224,11 @@ class Torrent:
 			try:
 				with open(self.torrent_file_path, "r") as metadata_file:
 					metadata = metadata_file.read()
-					decoded_data = bencode.bdecode(metadata)
+					decoded_data, spans = bencode.bdecode_spans(metadata)
+
+					# the info hash is taken over the info dict exactly as it appears in the file
+					info_start, info_end = spans[("info",)]
+					self.info_hash = hashlib.sha1(memoryview(metadata)[info_start:info_end]).digest()
 
 					# fill in our essential fields
 					self._announce = decoded_data["announce"]
@@ -142,11 +236,13 @@ class Torrent:
 					self.metadata["piece_length"] = decoded_data["info"]["piece length"]
 					self.metadata["pieces"] = decoded_data["info"]["pieces"]
 					self.torrent_name = self.metadata["info"]["name"]
+					check_path_component(self.torrent_name)
 					# set the download location to dir + name
 					self.download_root = os.path.join(self.download_root, self.torrent_name)
 
 					# initialize our pieces dict from the pieces string
 					self.initialize_pieces()
+					self.initialize_file_map()
 
 					# fill in our optional fields if they exist
 					meta_keys = decoded_data.keys()
@@ -172,36 +268,216 @@ class Torrent:
 
 	def initialize_pieces(self):
 		"""
-		Initializes the pieces array from the .torrent file metadata. Slices the pieces string
-		into 20-byte segments that represent the SHA1-hash of the piece's data
+		Initializes the pieces hashes from the .torrent file metadata. The pieces string is kept
+		whole, 20-byte segments (the SHA1-hash of each piece's data) are read out of it by index
 
 		Also sets self.bitfield as a bitfield array for tracking download progress
 		"""
-		self.pieces_hashes = [self.metadata["pieces"][x:x+20] for x in range(0, len(self.metadata["pieces"]), 20)]
+		self.pieces_hashes = PieceHashes(self.metadata["pieces"])
 
-		for x in range(0, (len(self.metadata["info"]["pieces"]) / 20)):
-			self.bitfield.append(0)
+		self.bitfield = bitarray(len(self.pieces_hashes), endian="big")
+		self.bitfield.setall(False)
+		self.availability_matrix = AvailabilityMatrix(len(self.pieces_hashes))
 
 		# DEBUG
 		# print ("Initialization"+("-"*20))
 		# print ("Pieces: {}, Bitfield_len: {}".format(len(self.pieces_hashes), len(self.bitfield)))
 
-	def initialize_previously_downloaded_progress(self):
+	def initialize_file_map(self):
+		"""
+		Builds the map from pieces to the files they are stored in. In multiple file mode the files
+		are laid out under the download root by their paths, a single file torrent is stored as
+		download root / name.
+		"""
+		info = self.metadata["info"]
+		if "files" in info:
+			files = [(file_info["path"], file_info["length"]) for file_info in info["files"]]
+		else:
+			files = [([self.torrent_name], info["length"])]
+
+		self.file_map = FileMap(files, self.metadata["piece_length"], self.download_root)
+		self.storage = STORAGE_BACKENDS[self.storage_mode](self.file_map, self.download_root)
+		self.write_queue = WriteQueue(self.storage)
+		if self.storage_mode == STORAGE_PIECES:
+			self.temporary_download_location = self.storage.directory
+		# every piece but the last is piece_length long
+		self.piece_lengths = numpy.full(len(self.pieces_hashes), self.metadata["piece_length"], dtype=numpy.int64)
+		if len(self.piece_lengths) > 0:
+			self.piece_lengths[-1] = self.file_map.get_piece_length(len(self.pieces_hashes) - 1)
+		self.set_file_priorities([FILE_PRIORITY_NORMAL] * len(files))
+
+	def set_file_priority(self, file_index, priority):
 		"""
-		from os import listdir
-		from os.path import isfile, join
-		onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
+		Changes the priority of one file
+		:param file_index: index of the file in the torrent
+		:param priority: FILE_PRIORITY_SKIP, _LOW, _NORMAL or _HIGH
+		:return: void
 		"""
-		self.temporary_download_location = os.path.join(self.download_root, "tmp/")
-		make_dir(os.path.join(self.temporary_download_location))
+		file_priorities = list(self.file_priorities)
+		file_priorities[file_index] = priority
+		self.set_file_priorities(file_priorities)
 
-		piece_files = [f for f in os.listdir(self.temporary_download_location) if
-					   os.path.isfile(os.path.join(self.temporary_download_location, f))]
+	def set_file_priorities(self, file_priorities):
+		"""
+		Sets the priority of every file and maps them onto the pieces. Pieces wholly inside skipped
+		files are never requested, and nothing is written to skipped files.
 
-		if len(piece_files) > 0:
+		:param file_priorities: list with one priority per file
+		:return: void
+		"""
+		if len(file_priorities) != len(self.file_map.paths):
+			raise ValueError("Expected {} file priorities, got {}".format(len(self.file_map.paths), len(file_priorities)))
+
+		piece_priorities = numpy.zeros(len(self.pieces_hashes), dtype=numpy.int8)
+		for file_index, priority in enumerate(file_priorities):
+			first, last = self.file_map.get_file_pieces(file_index)
+			piece_priorities[first:last] = numpy.maximum(piece_priorities[first:last], priority)
+
+		self.file_priorities = list(file_priorities)
+		self.piece_priorities = piece_priorities
+		self.selected_pieces = bitarray(endian="big")
+		self.selected_pieces.pack((piece_priorities > FILE_PRIORITY_SKIP).tobytes())
+		self.file_map.skipped_files = set(
+			file_index for file_index, priority in enumerate(file_priorities) if priority == FILE_PRIORITY_SKIP)
+
+		# skipping the files we were still waiting on can finish the torrent or leave peers uninteresting
+		self.update_completion_status()
+		for peer in self.active_peers:
+			for interest_message in peer.update_interest():
+				peer.send_message(interest_message)
+
+	def initialize_previously_downloaded_progress(self):
+		"""
+		Restores the progress of an earlier session from the resume file. If there is no resume file,
+		or the storage has changed since it was written, the pieces are taken from the storage's
+		index where it keeps one, and rechecked otherwise.
+		"""
+		if not self.storage.persistent:
+			return
+
+		resume_data = self.resume_file.load()
+		if resume_data is None or not self.restore_resume_data(resume_data):
+			indexed_pieces = self.storage.get_indexed_pieces()
+			if indexed_pieces is not None:
+				self.bitfield.setall(False)
+				for index in indexed_pieces:
+					self.bitfield[index] = 1
+				self.save_resume_data()
+			else:
+				# hashing them can take long, it is done once the torrent is started
+				self.recheck_needed = True
+
+		if self.bitfield.any() or len(self.partial_pieces) > 0:
 			self.activity_status = ACTIVITY_INITIALIZE_CONTINUE
-		for file_name in piece_files:
-			self.bitfield[int(file_name.split(".")[0])] = 1
+
+	def allocate_storage(self):
+		"""
+		Checks that the wanted files fit on the disk, failing before anything is downloaded if they
+		don't, then preallocates them (for the backends that write into them). Done when the torrent
+		is started, so that a torrent can be added (and looked at) without taking the space.
+		:raises IOError: ENOSPC if there isn't enough free space
+		:return: void
+		"""
+		required_bytes = self.storage.get_required_bytes()
+		free_bytes = get_free_bytes(self.download_root)
+		if required_bytes > free_bytes:
+			raise IOError(errno.ENOSPC, "{} needs {} more bytes but only {} are free in {}".format(
+				self.torrent_name, required_bytes, free_bytes, self.download_root))
+
+		if self.storage.preallocate() > 0 and not self.recheck_needed:
+			# the fingerprint in the resume file no longer matches the files (a recheck saves anyway,
+			# and an empty bitfield mustn't be saved before it)
+			self.save_resume_data()
+
+	def get_disk_usage(self):
+		"""
+		Returns the disk space the storage takes against the bytes of verified pieces written to it
+		:return: (allocated bytes, written bytes)
+		"""
+		written_bytes = int(self.piece_lengths[self.get_have_pieces()].sum()) - self.write_queue.dirty_bytes
+		return self.storage.get_allocated_bytes(), written_bytes
+
+	def get_resume_data(self):
+		"""
+		Collects the progress to save in the resume file
+		:return: dict
+		"""
+		partial_pieces = []
+		for index, piece in sorted(self.partial_pieces.items()):
+			blocks = piece.get_completed_blocks()
+			if len(blocks) > 0 and not piece.is_complete:
+				partial_pieces.append({
+					"index": index,
+					"blocks": [begin for begin, block in blocks],
+					"data": "".join(block for begin, block in blocks)
+				})
+
+		return {
+			"info hash": self.info_hash,
+			"piece count": len(self.pieces_hashes),
+			"bitfield": self.bitfield.tobytes(),
+			"file priorities": self.file_priorities,
+			"partial pieces": partial_pieces,
+			"fingerprint": self.storage.get_fingerprint()
+		}
+
+	def save_resume_data(self):
+		if not self.storage.persistent:
+			return
+		# the fingerprint has to match what is on disk
+		self.write_queue.flush()
+		self.resume_file.save(self.get_resume_data())
+
+	def restore_resume_data(self, resume_data):
+		"""
+		Restores the bitfield and unfinished pieces from resume data, if it belongs to this torrent
+		and the storage hasn't changed since it was written.
+
+		:param resume_data: dict read from the resume file
+		:return: True if the progress was restored
+		"""
+		try:
+			if resume_data["info hash"] != self.info_hash or \
+					resume_data["piece count"] != len(self.pieces_hashes) or \
+					resume_data["fingerprint"] != self.storage.get_fingerprint():
+				return False
+
+			bitfield = bitarray(endian="big")
+			bitfield.frombytes(resume_data["bitfield"])
+			self.bitfield = bitfield[:len(self.pieces_hashes)]
+			if "file priorities" in resume_data:
+				self.set_file_priorities(resume_data["file priorities"])
+
+			for partial_piece in resume_data["partial pieces"]:
+				index = partial_piece["index"]
+				piece = Piece(self.file_map.get_piece_length(index), index, self.pieces_hashes[index])
+				for position, begin in enumerate(partial_piece["blocks"]):
+					piece.restore_block(begin, partial_piece["data"][position * REQUEST_SIZE:(position + 1) * REQUEST_SIZE])
+				self.partial_pieces[index] = piece
+		except (KeyError, TypeError, IndexError, ValueError):
+			self.bitfield.setall(False)
+			self.partial_pieces = {}
+			return False
+
+		return True
+
+	def recheck_existing_pieces(self, recheck=None):
+		"""
+		Hashes every piece the storage holds (in parallel), marking the ones that match as
+		downloaded and removing the rest. The recheck can be cancelled with self.recheck.cancel().
+		:param recheck: Recheck to run (a new one if not given)
+		:return: True if the recheck finished
+		"""
+		self.bitfield.setall(False)
+		self.recheck = recheck if recheck is not None else Recheck(self)
+		try:
+			finished = self.recheck.run()
+		finally:
+			self.recheck = None
+
+		if finished:
+			self.recheck_needed = False
+		return finished
 
 	def can_request(self):
 		"""
@@ -234,15 +510,13 @@ class Torrent:
 		"""
 		Generates an ascii hash of the bencoded info dict
 		"""
-		bencoded_info_dict = bencode.bencode(self.metadata["info"])
-		return hashlib.sha1(bencoded_info_dict).hexdigest()
+		return self.info_hash.encode("hex")
 
 	def generate_hex_info_hash(self):
 		"""
 		Generates a hex hash of the bencoded info dict
 		"""
-		bencoded_info_dict = bencode.bencode(self.metadata["info"])
-		return hashlib.sha1(bencoded_info_dict).digest()
+		return self.info_hash
 
 	def generate_info_hash(self):
 		"""
@@ -286,8 +560,14 @@ class Torrent:
 		Updates the torrent based on a response from the tracker
 		"""
 		self.last_response_object = tracker_response
-		response_text = tracker_response.text
-		decoded_response = bencode.bdecode(response_text)
+		# decode the (binary) body as it streams in, within limits
+		decoder = bencode.BDecoder(
+			max_size=TRACKER_RESPONSE_MAX_SIZE,
+			max_depth=BENCODE_MAX_DEPTH,
+			max_elements=TRACKER_RESPONSE_MAX_ELEMENTS)
+		for chunk in tracker_response.iter_content(TRACKER_RESPONSE_CHUNK_SIZE):
+			decoder.feed(chunk)
+		decoded_response = decoder.result()
 
 		for response_field in decoded_response.keys():
 			self.tracker_response[response_field] = decoded_response[response_field]
@@ -337,18 +617,27 @@ class Torrent:
 			:info_hash -> SHA1 of the info key
 			:peer_id -> client peer_id
 		"""
-		info_hash = self.generate_hex_info_hash()
-		peer_id = self.peer_id
+		return self.handshake
 
-		handshake_message = HandshakeMessage(info_hash=info_hash, peer_id=peer_id).message()
-		return handshake_message
+	def get_block_lengths(self):
+		"""
+		Returns the lengths of the blocks requested for this torrent: REQUEST_SIZE, plus the shorter
+		blocks that end pieces which aren't a multiple of it (at least the last piece, usually)
+		:return: set of lengths
+		"""
+		block_lengths = {REQUEST_SIZE}
+		for piece_length in (self.metadata["piece_length"], self.file_map.get_piece_length(len(self.pieces_hashes) - 1)):
+			block_lengths.add(min(REQUEST_SIZE, piece_length))
+			if piece_length % REQUEST_SIZE != 0:
+				block_lengths.add(piece_length % REQUEST_SIZE)
+		return block_lengths
 
 	def send_tracker_request(self):
 		""" Sends the request to the tracker for the given torrent. Re-sends if no response in RESPONSE_TIMEOUT secs"""
 		self.tracker_request_sent = True
 		torrent_request = self.get_tracker_request()
 		try:
-			response = requests.get(torrent_request, timeout=RESPONSE_TIMEOUT)
+			response = requests.get(torrent_request, timeout=RESPONSE_TIMEOUT, stream=True)
 			self.process_tracker_response(response)
 
 		except requests.exceptions.Timeout:
@@ -378,12 +667,52 @@ class Torrent:
 				break
 
 	def start_torrent(self):
-		""" Starts the torrent by connecting to the peers and running the twisted reactor"""
+		""" Starts the torrent (once its stored pieces are checked) and runs the twisted reactor"""
 		print ("Starting torrent: {}".format(self.torrent_name))
+		self.allocate_storage()
+		reactor.addSystemEventTrigger("before", "shutdown", self.write_queue.flush)
+		if self.recheck_needed:
+			self.start_checking()
+		else:
+			self.start_downloading()
+		reactor.run(installSignalHandlers=False)
+
+	def start_checking(self):
+		"""
+		Rechecks the stored pieces on a thread. The torrent stays in the checking state until the
+		recheck is over, stopping it cancels the recheck.
+		:return: Deferred firing once downloading has started (or the recheck was cancelled)
+		"""
+		print ("Checking torrent: {}".format(self.torrent_name))
+		self.activity_status = ACTIVITY_CHECKING
+		# created here so that a stop right away can already cancel it
+		self.recheck = Recheck(self)
+		d = threads.deferToThread(self.recheck_existing_pieces, self.recheck)
+		d.addCallbacks(self.finish_checking, self.fail_checking)
+		return d
+
+	def finish_checking(self, finished):
+		if not finished or self.activity_status != ACTIVITY_CHECKING:
+			# cancelled by stop_torrent
+			return
+		self.save_resume_data()
+		self.start_downloading()
+
+	def fail_checking(self, failure):
+		print ("Checking torrent {} failed: {}".format(self.torrent_name, failure.getErrorMessage()))
+		self.recheck = None
+		self.activity_status = ACTIVITY_STOPPED
+
+	def start_downloading(self):
+		""" Starts downloading by announcing to the tracker and connecting to the peers"""
 		self.activity_status = ACTIVITY_DOWNLOADING
 		self.send_tracker_request()
 		self.connect_to_peers()
-		reactor.run(installSignalHandlers=False)
+		self.choker.start()
+		self.rate_limiter.start()
+		self.start_request_timeout_check()
+		self.start_resume_save()
+		self.start_storage_flush()
 
 	def stop_torrent(self):
 		"""
@@ -392,29 +721,115 @@ class Torrent:
 		Stops the reactor
 		Removes the active
 		Changes activity state
+
+		Can be called from any thread, the torrent is stopped on the reactor's.
 		"""
+		if off_reactor_thread():
+			return threads.blockingCallFromThread(reactor, self.stop_torrent)
 		# TODO Torrent is still downloading when stopped (around half normal speed)
 		# TODO lots of 'remove active peer' errors after a stop-start cycleAnti
 		print ("Stopping torrent: {}".format(self.torrent_name))
 		self.activity_status = ACTIVITY_STOPPED
+		if self.recheck is not None:
+			self.recheck.cancel()
+		self.choker.stop()
+		self.stop_request_timeout_check()
+		self.stop_resume_save()
+		self.stop_storage_flush()
+		self.save_resume_data()
 		self.connected_peers = 0
 		self.active_peers = []
 		self.active_peer_indices = []
-		self.assigned_pieces = []
+		self.partial_pieces = {}
 
 	def resume_torrent(self):
+		if off_reactor_thread():
+			return threads.blockingCallFromThread(reactor, self.resume_torrent)
 		print ("Resuming torrent: {}".format(self.torrent_name))
+		if self.recheck_needed:
+			# the recheck was cancelled, it starts over
+			return self.start_checking()
 		self.activity_status = ACTIVITY_DOWNLOADING
 		self.connect_to_peers()
+		self.choker.start()
+		self.start_request_timeout_check()
+		self.start_resume_save()
+		self.start_storage_flush()
+
+	def start_request_timeout_check(self):
+		if self.request_timeout_check is None:
+			self.request_timeout_check = task.LoopingCall(self.reclaim_timed_out_requests)
+			self.request_timeout_check.start(REQUEST_TIMEOUT_CHECK_INTERVAL, now=False)
+
+	def stop_request_timeout_check(self):
+		if self.request_timeout_check is not None and self.request_timeout_check.running:
+			self.request_timeout_check.stop()
+		self.request_timeout_check = None
+
+	def start_resume_save(self):
+		if self.resume_save is None:
+			self.resume_save = task.LoopingCall(self.save_resume_data)
+			self.resume_save.start(RESUME_SAVE_INTERVAL, now=False)
+
+	def stop_resume_save(self):
+		if self.resume_save is not None and self.resume_save.running:
+			self.resume_save.stop()
+		self.resume_save = None
+
+	def start_storage_flush(self):
+		if self.storage_flush is None:
+			self.storage_flush = task.LoopingCall(self.write_queue.flush)
+			self.storage_flush.start(STORAGE_FLUSH_INTERVAL, now=False)
+
+	def stop_storage_flush(self):
+		if self.storage_flush is not None and self.storage_flush.running:
+			self.storage_flush.stop()
+		self.storage_flush = None
+
+	def set_rate_limits(self, download_rate=None, upload_rate=None):
+		"""
+		Changes the torrent's bandwidth limits. Can be called while the torrent is running.
+
+		:param download_rate: bytes / second (0 for unlimited, None to leave unchanged)
+		:param upload_rate: bytes / second (0 for unlimited, None to leave unchanged)
+		:return: void
+		"""
+		if download_rate is not None:
+			self.download_bucket.set_rate(download_rate)
+		if upload_rate is not None:
+			self.upload_bucket.set_rate(upload_rate)
+		self.rate_limiter.update_refills()
+
+		# the number of upload slots follows the tightest upload limit
+		self.choker.set_upload_rate_limit(self.upload_bucket.get_effective_rate())
+
+	def get_have_pieces(self):
+		"""
+		Returns the pieces we have
+		:return: numpy bool array (one entry per piece)
+		"""
+		have = numpy.unpackbits(numpy.frombuffer(self.bitfield.tobytes(), dtype=numpy.uint8))[:len(self.bitfield)]
+		return have.astype(bool)
 
 	def get_progress(self):
-		pieces_finished = self.bitfield.count(1)
-		return float(pieces_finished) / len(self.bitfield) * 100
+		"""
+		Returns the share of the wanted (not skipped) bytes that have been downloaded
+		:return: percentage
+		"""
+		selected = self.piece_priorities > FILE_PRIORITY_SKIP
+		wanted_bytes = self.piece_lengths[selected].sum()
+		if wanted_bytes == 0:
+			return 100.0
+		finished_bytes = self.piece_lengths[selected & self.get_have_pieces()].sum()
+		return float(finished_bytes) / wanted_bytes * 100
 
 	def get_status(self, display_status=True):
 		sys.stdout.flush()
 		status_string = "Torrent Progress\n" + \
 				u"{}% {}\n".format("{0:.2f}".format(self.get_progress()).rjust(6), int(self.get_progress()) * u'\u2588')
+		allocated_bytes, written_bytes = self.get_disk_usage()
+		status_string += "Disk: {0:.1f}mb allocated, {1:.1f}mb written\n".format(
+			allocated_bytes / (1024.0 * 1024), written_bytes / (1024.0 * 1024))
 		if DEBUG:
 			status_string += "ACTIVE PEERS\n"
 			for peer in self.active_peers:
@@ -423,7 +838,7 @@ class Torrent:
 					status_string += u"Peer: {} ".format(str(peer.ip).rjust(15)) + \
 							u" Recv: {}".format(str(len(peer.received_message_buffer)).rjust(4)) + \
 							u" Sent: {}".format(str(len(peer.outgoing_messages_buffer)).rjust(4)) + \
-							u" Total: {}mb ".format(str(float(peer.blocks_downloaded) / 2).rjust(7)) + \
+							u" Total: {}mb ".format(str(float(peer.download_meter.total) / (1024 * 1024)).rjust(7)) + \
 							u" Block {}: {}\n".format(str(peer.current_piece.get_index()).rjust(4), peer.current_piece.progress_string())
 				else:
 					status_string += u"Peer: {} ".format(str(peer.ip).rjust(15)) + \
@@ -431,6 +846,20 @@ class Torrent:
 						   u" Sent: {}".format(str(0).rjust(4)) + \
 						   u" Total: {}mb ".format(str(float(0)).rjust(7)) + \
 						   u" Block {}: {}\n".format("None".rjust(4), "0.0%".rjust(6))
+			if self.recheck is not None:
+				status_string += "Rechecking: {0:.1f}%\n".format(self.recheck.get_progress())
+			if self.assembly is not None and self.assembly.is_alive():
+				status_string += "Assembling: {0:.1f}%\n".format(self.storage.get_assembly_progress())
+			status_string += "Partial pieces in memory: {}\n".format(len(self.partial_pieces))
+			if self.streaming:
+				status_string += "Streaming from byte {} ({} pieces with deadlines)\n".format(
+					self.playback_cursor, len(self.piece_deadlines))
+			status_string += "Distributed copies: {0:.3f}\n".format(self.availability_matrix.distributed_copies())
+			status_string += "Request pipeline idle: {0:.2f}s\n".format(self.get_pipeline_idle_time())
+			status_string += "Reclaimed blocks (choke: {}, timeout: {}, disconnect: {})\n".format(
+				self.reclaimed_blocks["choke"],
+				self.reclaimed_blocks["timeout"],
+				self.reclaimed_blocks["disconnect"])
 			if display_status:
 				print (status_string)
 			else:
@@ -451,25 +880,39 @@ class Torrent:
 		# DEBUG
 		#print ("Removing peer from active list ({})".format(peer.peer_id))
 		self.active_peers.remove(peer)
-		if peer.current_piece is not None:
-			try:
-				self.assigned_pieces.remove(peer.current_piece.get_index())
-			except Exception as e:
-				pass
-				# DEBUG
-				#error_message = "Problem removing piece" + \
-				#	"\nPiece: {}".format(peer.current_piece.get_index()) + \
-				#	"\nAssigned: {}".format(", ".join(str(c) for c in self.assigned_pieces))
-
-				# TODO: if we don't try-block wrap...why is the index being removed before this piece is done???
-				# 	or is this an index accession error because another peer is erroneously removing
-				# 	our piece? Or is this because we assigned the same piece to more than one peer?
-				#print (error_message)
+		peer.detach_buckets()
+		self.reclaim_peer_requests(peer, "disconnect")
+		self.availability_matrix.remove_peer(peer)
 
 		# DEBUG
 		#print ("Remove active peer: Adding a new peer")
 		self.connect_to_peers()
 
+	def reclaim_peer_requests(self, peer, reason, current_time=None):
+		"""
+		Returns the blocks of the peer's outstanding requests to their pieces so that any other
+		peer can fetch them. The pieces stay in the pool of partial pieces.
+
+		:param peer: Peer giving up its requests
+		:param reason: "choke", "timeout" or "disconnect" (for the reclaimed block counters)
+		:param current_time: only reclaim the requests past their deadline at this time (None for all)
+		:return: void
+		"""
+		self.reclaimed_blocks[reason] += peer.release_requests(current_time)
+
+	def reclaim_timed_out_requests(self, current_time=None):
+		"""
+		Reclaims the requests that have passed their deadline, the peers keep the others
+		:param current_time: time to check against (defaults to now)
+		:return: void
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		for peer in self.active_peers:
+			if peer.has_timed_out_requests(current_time):
+				self.reclaim_peer_requests(peer, "timeout", current_time)
+
 	def process_next_round(self, peer):
 		"""
 		The main processing step after a peer has performed some actions. Need to check and see
@@ -478,33 +921,304 @@ class Torrent:
 
 		:return:
 		"""
-		if peer.current_piece is not None and peer.current_piece.is_complete:
-			# DEBUG
-			#print ("Peer has completed downloading piece... Assigning a new piece")
-			# self.save_completed_peer_piece_to_disk(peer.set_next_piece(self.get_next_piece_for_download(peer)))
-			piece_to_save = peer.current_piece
-			if piece_to_save.data_matches_hash():
-				self.exchange_completed_piece_for_new_piece(peer)
+		if len(peer.request_buffer) > 0 and peer.peer_choking == 1:
+			# the peer will not answer our requests any more, let another peer fetch the blocks
+			self.reclaim_peer_requests(peer, "choke")
+
+	def verify_completed_pieces(self):
+		"""
+		Hash-checks every piece in the pool whose blocks have all arrived. Pieces that match are
+		saved, pieces that don't are reset and stay in the pool to be downloaded again.
+		:return: void
+		"""
+		for index, piece in self.partial_pieces.items():
+			if not piece.is_complete:
+				continue
+
+			for peer in self.active_peers:
+				if peer.current_piece is piece:
+					peer.set_next_piece(None)
+
+			if piece.data_matches_hash():
+				del self.partial_pieces[index]
+				self.save_completed_peer_piece_to_disk(piece)
 			else:
 				# DEBUG
 				#print ("Piece was corrupted... Trying again")
-				peer.set_next_piece(piece_to_save.reset())
+				piece.reset()
 
 			self.update_completion_status()
 
-		elif peer.current_piece is None and peer.received_bitfield():
-			# DEBUG
-			#print ("Peer has bitfield but no piece... Assigning a piece")
-			peer.set_piece(self.get_next_piece_for_download(peer))
+	def get_next_block(self, peer):
+		"""
+		Picks the next 16kb block to request from the peer. In order of preference:
+			- a block of a piece with a deadline (see get_deadline_block)
+			- the next block of the peer's current piece
+			- a block of a piece that has already been started (by any peer), the most complete
+			  first, so that fast peers help finish the pieces of slow ones
+			- the first block of a new piece, which becomes the peer's current piece
+		A new piece is opened as soon as every block of the current piece has been requested, so
+		the peer's request pipeline runs on into the next piece while the last blocks of the
+		current one are still in flight (or being verified) instead of draining at every piece
+		boundary.
+
+		:param peer: Peer to request from
+		:return: tuple of (Piece, begin), or None if there is nothing to request from the peer
+		"""
+		if len(self.piece_deadlines) > 0:
+			deadline_block = self.get_deadline_block(peer)
+			if deadline_block is not None:
+				if peer.current_piece is None:
+					peer.set_piece(deadline_block[0])
+				return deadline_block
 
-		elif not peer.received_bitfield():
-			pass
-			# DEBUG
-			#print ("Peer has no bitfield... Waiting for bitfield to give piece assignment")
-		else:
-			pass
-			# DEBUG
-			#print ("Proceeding as usual... No update from torrent")
+		if peer.current_piece is not None:
+			next_begin = peer.current_piece.get_next_begin()
+			if next_begin is not None:
+				return peer.current_piece, next_begin
+
+		started_piece = self.get_most_complete_partial_piece(peer)
+		if started_piece is not None:
+			if peer.current_piece is None:
+				peer.set_piece(started_piece)
+			return started_piece, started_piece.get_next_begin()
+
+		new_piece = self.get_next_piece_for_download(peer)
+		if new_piece is not None:
+			peer.set_piece(new_piece)
+			return new_piece, new_piece.get_next_begin()
+
+		return None
+
+	def get_fast_peers(self, current_time):
+		"""
+		Returns the unchoking peers we download from the fastest (recomputed at most once a second)
+		:param current_time: time to measure the rates at
+		:return: list of Peers
+		"""
+		if self.fast_peers_updated is None or not 0 <= current_time - self.fast_peers_updated < 1:
+			unchoking_peers = [peer for peer in self.active_peers if peer.peer_choking == 0]
+			unchoking_peers.sort(key=lambda peer: peer.download_meter.get_rate(current_time), reverse=True)
+			self.fast_peers = unchoking_peers[:STREAMING_FAST_PEERS]
+			self.fast_peers_updated = current_time
+		return self.fast_peers
+
+	def get_deadline_block(self, peer, current_time=None):
+		"""
+		Picks a block of the piece with the earliest deadline that the peer has. Only the fastest
+		peers are given pieces whose deadline hasn't passed yet. When every block of a piece has
+		been requested and its deadline is close, a fast peer requests a block that another peer
+		still owes us a second time (the first copy to arrive wins, the other request is
+		cancelled).
+
+		:param peer: Peer to request from
+		:param current_time: time to check the deadlines against (defaults to now)
+		:return: tuple of (Piece, begin), or None
+		"""
+		if current_time is None:
+			current_time = time.time()
+
+		fast = peer in self.get_fast_peers(current_time)
+		for deadline, index in sorted((deadline, index) for index, deadline in self.piece_deadlines.items()):
+			if self.bitfield[index] or not peer.has_piece(index) or (not fast and deadline > current_time):
+				continue
+
+			piece = self.partial_pieces.get(index)
+			if piece is None:
+				piece = self.start_piece(index)
+			next_begin = piece.get_next_begin()
+			if next_begin is not None:
+				return piece, next_begin
+
+			if fast and deadline - current_time < STREAMING_ENDGAME_MARGIN:
+				for begin in sorted(set(piece.non_completed_request_indices)):
+					if piece.non_completed_request_indices.count(begin) == 1 and not peer.has_request(index, begin):
+						return piece, begin
+		return None
+
+	def cancel_duplicate_requests(self, receiving_peer, index, begin):
+		"""
+		Cancels the requests other peers still have open for a block that has just arrived
+		:param receiving_peer: Peer that sent the block
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:return: void
+		"""
+		for peer in self.active_peers:
+			if peer is not receiving_peer:
+				peer.cancel_request(index, begin)
+
+	def set_streaming(self, streaming, playback_cursor=0):
+		"""
+		Turns streaming mode on or off
+		:param streaming: boolean
+		:param playback_cursor: byte offset playback starts from
+		:return: void
+		"""
+		self.streaming = streaming
+		self.set_playback_cursor(playback_cursor)
+
+	def set_playback_cursor(self, offset, current_time=None):
+		"""
+		Moves the playback cursor. In streaming mode the next STREAMING_WINDOW_PIECES missing pieces
+		from the cursor on get deadlines STREAMING_PIECE_INTERVAL seconds apart, the nearest first.
+		Pieces that already had a deadline keep it if it is earlier, and the pieces reads are
+		waiting for are due straight away.
+
+		:param offset: byte offset within the torrent's data
+		:param current_time: time the deadlines count from (defaults to now)
+		:return: void
+		"""
+		if current_time is None:
+			current_time = time.time()
+		self.playback_cursor = offset
+
+		piece_deadlines = {}
+		if self.streaming:
+			index = offset / self.metadata["piece_length"]
+			while len(piece_deadlines) < STREAMING_WINDOW_PIECES and index < len(self.pieces_hashes):
+				if not self.bitfield[index] and self.piece_priorities[index] > FILE_PRIORITY_SKIP:
+					deadline = current_time + STREAMING_PIECE_INTERVAL * (len(piece_deadlines) + 1)
+					piece_deadlines[index] = min(deadline, self.piece_deadlines.get(index, deadline))
+				index += 1
+
+		for waiter in self.range_waiters:
+			for index in waiter["missing"]:
+				piece_deadlines[index] = min(waiter["deadline"], piece_deadlines.get(index, waiter["deadline"]))
+		self.piece_deadlines = piece_deadlines
+
+	def get_range_pieces(self, offset, length):
+		"""
+		Returns the indices of the pieces that hold a byte range of the torrent's data
+		:param offset: byte offset within the torrent's data
+		:param length: number of bytes
+		:return: list of piece indices
+		"""
+		if length <= 0:
+			return []
+		piece_length = self.metadata["piece_length"]
+		return range(offset / piece_length, (offset + length - 1) / piece_length + 1)
+
+	def wait_for_range(self, offset, length, current_time=None):
+		"""
+		Waits for every piece of a byte range to be downloaded, giving the missing ones the highest
+		priority and the earliest deadline and moving the playback cursor to the start of the range.
+		Must be called from the reactor thread.
+
+		:param offset: byte offset within the torrent's data
+		:param length: number of bytes
+		:param current_time: time the wait starts (defaults to now)
+		:return: Deferred that fires (with None) once the pieces are there
+		"""
+		if offset < 0 or length < 0 or offset + length > self.file_map.total_length:
+			raise ValueError("Range {}+{} is outside of the torrent's data".format(offset, length))
+		if current_time is None:
+			current_time = time.time()
+
+		missing = set(index for index in self.get_range_pieces(offset, length) if not self.bitfield[index])
+		if len(missing) == 0:
+			return defer.succeed(None)
+
+		self.bump_piece_priorities(missing)
+		waiter = {"missing": missing, "deadline": current_time}
+		waiter["deferred"] = defer.Deferred(lambda deferred: self.remove_range_waiter(waiter))
+		self.range_waiters.append(waiter)
+		self.set_playback_cursor(offset, current_time)
+		return waiter["deferred"]
+
+	def bump_piece_priorities(self, indices):
+		"""
+		Raises pieces to the highest priority (even if they are in skipped files), until the file
+		priorities are next changed
+		:param indices: piece indices
+		:return: void
+		"""
+		for index in indices:
+			self.piece_priorities[index] = FILE_PRIORITY_HIGH
+			self.selected_pieces[index] = True
+		for peer in self.active_peers:
+			for interest_message in peer.update_interest():
+				peer.send_message(interest_message)
+
+	def remove_range_waiter(self, waiter):
+		if waiter in self.range_waiters:
+			self.range_waiters.remove(waiter)
+			self.set_playback_cursor(self.playback_cursor)
+
+	def notify_range_waiters(self, index):
+		"""
+		Fires the waits that only needed the given (just downloaded) piece
+		:param index: index of the piece
+		:return: void
+		"""
+		finished_waiters = [waiter for waiter in self.range_waiters if waiter["missing"] == {index}]
+		for waiter in self.range_waiters:
+			waiter["missing"].discard(index)
+		self.range_waiters = [waiter for waiter in self.range_waiters if len(waiter["missing"]) > 0]
+		# the window moves on to the next missing piece
+		self.piece_deadlines.pop(index, None)
+		self.set_playback_cursor(self.playback_cursor)
+
+		for waiter in finished_waiters:
+			waiter["deferred"].callback(None)
+
+	def read_range(self, offset, length):
+		"""
+		Reads a byte range of the torrent's data from downloaded pieces
+		:param offset: byte offset within the torrent's data
+		:param length: number of bytes
+		:return: byte-string
+		"""
+		piece_length = self.metadata["piece_length"]
+		chunks = []
+		while length > 0:
+			index, begin = offset / piece_length, offset % piece_length
+			block_length = min(length, piece_length - begin)
+			block = self.read_block(index, begin, block_length)
+			if block is None:
+				raise IOError("Piece {} is not available".format(index))
+			chunks.append(block)
+			offset += block_length
+			length -= block_length
+		return "".join(chunks)
+
+	def read_at(self, offset, length, timeout=STREAMING_READ_TIMEOUT):
+		"""
+		Reads a byte range of the torrent's data, blocking until the pieces it covers (and only
+		those) have been downloaded. Must be called from a thread other than the reactor's. The read
+		itself happens on the reactor too, as the write queue it goes through is only ever touched
+		from there.
+
+		:param offset: byte offset within the torrent's data
+		:param length: number of bytes (the range is cut off at the end of the data)
+		:param timeout: seconds to wait before giving up with a defer.TimeoutError
+		:return: byte-string
+		"""
+		length = max(0, min(length, self.file_map.total_length - offset))
+		return threads.blockingCallFromThread(reactor, lambda: self.wait_for_range(offset, length).addTimeout(
+			timeout, reactor).addCallback(lambda ignored: self.read_range(offset, length)))
+
+	def get_pipeline_idle_time(self):
+		"""
+		Returns the total time that connected, unchoking peers spent with no outstanding requests
+		:return: seconds
+		"""
+		return sum(peer.pipeline_idle_time for peer in self.active_peers)
+
+	def get_most_complete_partial_piece(self, peer):
+		"""
+		Returns the started piece with unrequested blocks that the peer has and that is closest to
+		completion
+		:param peer: Peer to request from
+		:return: Piece or None
+		"""
+		most_complete_piece = None
+		for index, piece in self.partial_pieces.items():
+			if peer.has_piece(index) and piece.get_next_begin() is not None:
+				if most_complete_piece is None or \
+						len(piece.completed_request_indices) > len(most_complete_piece.completed_request_indices):
+					most_complete_piece = piece
+		return most_complete_piece
 
 	# TODO
 	def update_completion_status(self):
@@ -524,70 +1238,118 @@ class Torrent:
 		# DEBUG
 		# print ("Saving piece to disk")
 		# set the given piece of the bitarray to 1
-		piece_to_save.write_to_temporary_storage()
+		index = piece_to_save.get_index()
+		self.write_queue.put(index, "".join(piece_to_save.data[:self.file_map.get_piece_length(index)]))
 		self.bitfield[piece_to_save.get_index()] = 1
+		self.notify_range_waiters(piece_to_save.get_index())
+
+		# connected peers are told about the piece (a connection made later gets it in our bitfield),
+		# and peers that only had pieces we now have are no longer interesting
+		for peer in self.active_peers:
+			if peer.protocol is not None:
+				peer.send_message(HaveMessage(piece_index=convert_int_to_hex(index, 4)))
+			for interest_message in peer.update_interest():
+				peer.send_message(interest_message)
 		# DEBUG
 		# print ("Finished saving piece to disk")
 
-	def exchange_completed_piece_for_new_piece(self, peer):
-		# DEBUG
-		#print ("Exchanging piece for new piece")
-		#print ("Current piece: {}".format(peer.current_piece.get_index()))
-		# self.assigned_pieces.remove(peer.current_piece.get_index())
-		self.bitfield[peer.current_piece.get_index()] = 1
-		self.save_completed_peer_piece_to_disk(peer.current_piece)
-		next_piece = self.get_next_piece_for_download(peer)
-		# DEBUG
-		#print ("New piece: {}".format(next_piece.get_index()))
-		peer.set_next_piece(next_piece)
+	def read_block(self, index, begin, length):
+		"""
+		Reads a block of a completed piece from storage so that it can be uploaded to a peer or read
+		by a stream.
+
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: block data, or None if the piece is not available
+		"""
+		if self.bitfield[index] != 1:
+			return None
+		return self.write_queue.read_block(index, begin, length)
+
+	def get_wanted_pieces(self):
+		"""
+		Returns the pieces of the files we want that we still need and aren't already being downloaded
+		:return: numpy bool array (one entry per piece)
+		"""
+		wanted = ~self.get_have_pieces() & (self.piece_priorities > FILE_PRIORITY_SKIP)
+		wanted[list(self.partial_pieces)] = False
+		return wanted
 
 	def get_next_piece_for_download(self, peer):
+		"""
+		Starts the rarest piece (among connected peers) of the highest priority that the given peer
+		has and we still need
+		:param peer: Peer that will download the piece
+		:return: Piece, or None if the peer has nothing we need
+		"""
+		wanted = self.get_wanted_pieces() & self.availability_matrix.get_peer_pieces(peer)
+		rarest = []
+		for priority in (FILE_PRIORITY_HIGH, FILE_PRIORITY_NORMAL, FILE_PRIORITY_LOW):
+			rarest = self.availability_matrix.rarest_wanted(wanted & (self.piece_priorities == priority))
+			if len(rarest) > 0:
+				break
+		if len(rarest) == 0:
+			return None
+
 		# DEBUG
-		#print ("Getting peer a new piece")
-		for index, bit in enumerate(self.bitfield):
-			# DEBUG
-			#print ("current_index: {}\nassigned: {}\nbitfield at index: {}".format(index,", ".join(str(c) for c in self.assigned_pieces), self.bitfield[index]))
-			if index not in self.assigned_pieces and self.bitfield[index] == 0:
-				# DEBUG
-				#print ("Giving peer piece {} for download".format(index))
-				next_hash = self.pieces_hashes[index]
-				next_piece = Piece(self.metadata["piece_length"], index, next_hash, self.download_root)
-				self.assigned_pieces.append(index)
-				# DEBUG
-				#print ("Assigned: {}".format(",".join(str(x) for x in self.assigned_pieces)))
-				return next_piece
-		# DEBUG
-		#print ("Finished giving peer a new piece")
+		#print ("Giving peer piece {} for download".format(rarest[0]))
+		return self.start_piece(rarest[0])
+
+	def start_piece(self, index):
+		"""
+		Adds a new piece to the pool of partial pieces
+		:param index: index of the piece
+		:return: Piece
+		"""
+		piece = Piece(self.file_map.get_piece_length(index), index, self.pieces_hashes[index])
+		self.partial_pieces[index] = piece
+		return piece
 
 	def compile_file_from_pieces(self, preserve_tmp=False):
-		output_file_path = os.path.join(one_directory_back(self.temporary_download_location), self.torrent_name)
-		print ("Compiling completed pieces into {}".format(output_file_path))
-		with open(output_file_path, 'w') as output_file:
-			for piece in sorted(os.listdir(self.temporary_download_location)):
-				piece_path = os.path.join(self.temporary_download_location, piece)
-				if ".iso" not in piece:
-					print ("Compiling piece {}".format(piece))
-					with open(piece_path, "r") as piece_file:
-						output_file.write(piece_file.read())
-
-				if not preserve_tmp:
-					os.remove(piece_path)
-			if not preserve_tmp:
-				os.rmdir(self.temporary_download_location)
-		print ("Finished compiling file")
+		"""
+		Leaves the completed pieces in the torrent's files (piece files are compiled into them, the
+		other backends have written them in place already). Every piece the bitfield has is
+		written, in index order. Must be called from the reactor thread (or while it isn't running).
+		:param preserve_tmp: keep the piece files afterwards
+		:raises IOError: if a downloaded piece is missing from storage
+		:return: void
+		"""
+		self.write_queue.drain()
+		self.finalize_storage(preserve_tmp)
+
+	def finalize_storage(self, preserve_tmp=False):
+		self.storage.finalize(numpy.flatnonzero(self.get_have_pieces()).tolist(), preserve_tmp)
+
+	def start_assembly(self, preserve_tmp=False):
+		"""
+		Compiles the pieces in a thread of its own, so that neither the control loop nor the reactor
+		waits on it. Its progress is shown in the status. The write queue is drained on the reactor
+		first, the thread only touches the storage.
+		:param preserve_tmp: keep the piece files afterwards
+		:return: threading.Thread
+		"""
+		if off_reactor_thread():
+			threads.blockingCallFromThread(reactor, self.write_queue.drain)
+		else:
+			self.write_queue.drain()
+		self.assembly = threading.Thread(target=self.finalize_storage, args=(preserve_tmp,))
+		self.assembly.start()
+		return self.assembly
 
 	def get_current_download_speed(self):
 		"""
 		Gets the current download speed of the torrent
 		:return: speed in kb/s
 		"""
-		total_pieces = 0
-		for peer in self.active_peers:
-			total_pieces += peer.get_messages_in_window(DOWNLOAD_SPEED_CALCULATION_WINDOW)
-
-		kbps = (float(total_pieces) / DOWNLOAD_SPEED_CALCULATION_WINDOW) * (REQUEST_SIZE / 1024)
+		return self.download_meter.get_window_rate() / 1024
 
-		return kbps
+	def get_current_upload_speed(self):
+		"""
+		Gets the current upload speed of the torrent
+		:return: speed in kb/s
+		"""
+		return self.upload_meter.get_window_rate() / 1024
 
 
 	"""
@@ -0,0 +1,101 @@
+from constants import WRITE_QUEUE_MAX_DIRTY, WRITE_QUEUE_MAX_WRITE
+
+"""
+This class holds verified pieces back from storage and writes them behind the download.
+
+Pieces arrive rarest first, so they land all over the torrent's files. Rather than going to
+storage one at a time they are kept in memory until max_dirty bytes are pending (or the torrent
+flushes on its timer, stops or shuts down), then written in index order with runs of consecutive
+pieces coalesced into single writes of up to max_write bytes. Storage is only synced (fsync /
+msync) by flush(), never per piece. Pending pieces are still served to peers and streams from
+memory.
+"""
+
+
+class WriteQueue:
+	def __init__(self, storage, max_dirty=WRITE_QUEUE_MAX_DIRTY, max_write=WRITE_QUEUE_MAX_WRITE):
+		"""
+		:param storage: Storage the pieces are written to
+		:param max_dirty: bytes of pending pieces that trigger a drain
+		:param max_write: bytes of consecutive pieces written at a time
+		"""
+		self.storage = storage
+		self.max_dirty = max_dirty
+		self.max_write = max_write
+		# piece index -> data of verified pieces not yet written to storage
+		self.pending = {}
+		self.dirty_bytes = 0
+		# storage writes and syncs made, for benchmarks
+		self.writes = 0
+		self.syncs = 0
+
+	def put(self, index, data):
+		"""
+		Queues a verified piece, draining the queue if too much is pending
+		:param index: index of the piece
+		:param data: piece data
+		:return: void
+		"""
+		if index in self.pending:
+			self.dirty_bytes -= len(self.pending[index])
+		self.pending[index] = data
+		self.dirty_bytes += len(data)
+		if self.dirty_bytes >= self.max_dirty:
+			self.drain()
+
+	def get_runs(self):
+		"""
+		Groups the pending pieces into runs of consecutive pieces (each but the last a full piece)
+		:return: list of (index of the first piece, list of piece data)
+		"""
+		runs = []
+		run_length = 0
+		for index in sorted(self.pending):
+			data = self.pending[index]
+			if len(runs) > 0:
+				first, pieces = runs[-1]
+				if first + len(pieces) == index and len(pieces[-1]) == self.storage.file_map.piece_length and \
+						run_length + len(data) <= self.max_write:
+					pieces.append(data)
+					run_length += len(data)
+					continue
+			runs.append((index, [data]))
+			run_length = len(data)
+		return runs
+
+	def drain(self):
+		"""
+		Writes every pending piece to storage
+		:return: void
+		"""
+		for first, pieces in self.get_runs():
+			self.storage.write_pieces(first, pieces[0] if len(pieces) == 1 else "".join(pieces))
+			self.writes += 1
+		self.pending = {}
+		self.dirty_bytes = 0
+
+	def read_block(self, index, begin, length):
+		"""
+		Reads a block of a piece, from memory if the piece hasn't been written yet
+		:param index: index of the piece
+		:param begin: byte offset of the block within the piece
+		:param length: length of the block
+		:return: block data, or None if the piece is not available
+		"""
+		piece_length = self.storage.file_map.piece_length
+		if index in self.pending and begin + length <= len(self.pending[index]):
+			return self.pending[index][begin:begin + length]
+		last = (index * piece_length + begin + length - 1) / piece_length
+		if any(covered in self.pending for covered in range(index, last + 1)):
+			# a block reaching into pending pieces is read once they have been written
+			self.drain()
+		return self.storage.read_block(index, begin, length)
+
+	def flush(self):
+		"""
+		Writes every pending piece and syncs the storage
+		:return: void
+		"""
+		self.drain()
+		self.storage.flush()
+		self.syncs += 1
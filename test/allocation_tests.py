@@ -0,0 +1,34 @@
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from coast import allocation
+
+
+class AllocationTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.handle = os.open(os.path.join(self.directory, "file"), os.O_RDWR | os.O_CREAT, 0644)
+		self.posix_fallocate = allocation.posix_fallocate
+
+	def tearDown(self):
+		allocation.posix_fallocate = self.posix_fallocate
+		os.close(self.handle)
+		shutil.rmtree(self.directory)
+
+	def test_unsupported_falls_back_to_truncate(self):
+		allocation.posix_fallocate = lambda handle, offset, length: errno.EOPNOTSUPP
+		self.assertFalse(allocation.preallocate(self.handle, 4096))
+		self.assertEqual(4096, os.fstat(self.handle).st_size)
+
+	def test_no_space_is_raised(self):
+		allocation.posix_fallocate = lambda handle, offset, length: errno.ENOSPC
+		with self.assertRaises(IOError) as context:
+			allocation.preallocate(self.handle, 4096)
+		self.assertEqual(errno.ENOSPC, context.exception.errno)
+		self.assertEqual(0, os.fstat(self.handle).st_size)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import numpy
+from coast.availability import AvailabilityMatrix
+
+
+class AvailabilityMatrixTests(unittest.TestCase):
+	def test_bitfield_and_have_update_availability(self):
+		matrix = AvailabilityMatrix(10, initial_rows=1)
+		matrix.set_bitfield("first", "\xc0\x00")
+		matrix.set_bitfield("second", "\x80\xff")
+		matrix.add_piece("second", 5)
+		matrix.add_piece("second", 5)
+
+		# spare bits past the last piece are ignored
+		self.assertEqual([2, 1, 0, 0, 0, 1, 0, 0, 1, 1], matrix.availability.tolist())
+		self.assertEqual(["first", "second"], matrix.peers_with_piece(0))
+		self.assertEqual(["second"], matrix.peers_with_piece(9))
+
+		matrix.remove_peer("first")
+		self.assertEqual([1, 0, 0, 0, 0, 1, 0, 0, 1, 1], matrix.availability.tolist())
+		self.assertEqual(["second"], matrix.peers_with_piece(0))
+
+		# a new bitfield replaces the old row
+		matrix.set_bitfield("second", "\x00\x00")
+		self.assertEqual(0, matrix.availability.sum())
+
+	def test_rarest_wanted(self):
+		matrix = AvailabilityMatrix(6)
+		matrix.set_bitfield("first", "\xfc")
+		matrix.set_bitfield("second", "\xe0")
+		matrix.set_bitfield("third", "\x80")
+
+		wanted = numpy.ones(6, dtype=bool)
+		self.assertEqual([3, 4, 5, 1], matrix.rarest_wanted(wanted, count=4))
+		wanted[3] = False
+		self.assertEqual([4], matrix.rarest_wanted(wanted))
+		self.assertEqual([], matrix.rarest_wanted(numpy.zeros(6, dtype=bool)))
+
+	def test_distributed_copies(self):
+		matrix = AvailabilityMatrix(4)
+		self.assertEqual(0.0, matrix.distributed_copies())
+		matrix.set_bitfield("seed", "\xf0")
+		matrix.set_bitfield("leech", "\xc0")
+		self.assertEqual(1.5, matrix.distributed_copies())
+
+
+if __name__ == "__main__":
+	unittest.main()
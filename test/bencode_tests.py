@@ -1,5 +1,7 @@
+import io
 import unittest
-from coast.bencode import bdecode, BTFailure
+from collections import OrderedDict
+from coast.bencode import bdecode, bdecode_spans, bencode, bencached, BDecoder, BEncoder, BTFailure
 
 
 class TestBencode(unittest.TestCase):
@@ -9,16 +11,16 @@ class TestBencode(unittest.TestCase):
 		self.assertEqual(100, bdecode("i100e"))
 
 		# Error raising
-		with self.assertRaises(BTFailure) as context:
+		with self.assertRaises(BTFailure):
 			bdecode("i10ae")
 
 	def test_string(self):
 		self.assertEqual("", bdecode("0:"))
 		self.assertEqual("test", bdecode("4:test"))
 		self.assertEqual("holy guacamole", bdecode("14:holy guacamole"))
-		with self.assertRaises(BTFailure) as context:
+		with self.assertRaises(BTFailure):
 			bdecode("3:test")
-		with self.assertRaises(BTFailure) as context:
+		with self.assertRaises(BTFailure):
 			bdecode("5:test")
 
 	def test_list(self):
@@ -33,6 +35,74 @@ class TestBencode(unittest.TestCase):
 		self.assertEqual({"key": ["list"]}, bdecode("d3:keyl4:listee"))
 		self.assertEqual({"key": ["list", 1]}, bdecode("d3:keyl4:listi1eee"))
 
+	def test_spans(self):
+		encoded = "d4:infod4:name4:test6:pieces4:abcde4:listli1e2:xyee"
+		decoded, spans = bdecode_spans(encoded)
+		self.assertEqual(bdecode(encoded), decoded)
+		info_start, info_end = spans[("info",)]
+		self.assertEqual("d4:name4:test6:pieces4:abcde", encoded[info_start:info_end])
+		pieces_start, pieces_end = spans[("info", "pieces")]
+		self.assertEqual("4:abcd", encoded[pieces_start:pieces_end])
+		list_start, list_end = spans[("list", 1)]
+		self.assertEqual("2:xy", encoded[list_start:list_end])
+		self.assertEqual((0, len(encoded)), spans[()])
+		with self.assertRaises(BTFailure):
+			bdecode_spans("d4:infoi1e")
+
+	def test_incremental_decoder(self):
+		encoded = bencode({"interval": 1800, "peers": "\x00" * 60, "list": [1, "two", {"three": 3}]})
+		for chunk_size in (1, 7, len(encoded)):
+			decoder = BDecoder()
+			for start in range(0, len(encoded), chunk_size):
+				decoder.feed(encoded[start:start + chunk_size])
+			self.assertEqual(bdecode(encoded), decoder.result())
+
+		decoder = BDecoder()
+		decoder.feed(encoded[:-1])
+		with self.assertRaises(BTFailure):
+			decoder.result()
+		with self.assertRaises(BTFailure):
+			decoder.feed("ee")
+
+	def test_incremental_decoder_limits(self):
+		# the string is refused from its length prefix, before its data arrives
+		decoder = BDecoder(max_size=100)
+		with self.assertRaises(BTFailure) as context:
+			decoder.feed("d5:peers1000000:")
+		self.assertTrue("offset 8" in str(context.exception))
+
+		with self.assertRaises(BTFailure):
+			BDecoder(max_depth=3).feed("llll")
+		with self.assertRaises(BTFailure):
+			BDecoder(max_elements=3).feed("li1ei2ei3e")
+		with self.assertRaises(BTFailure):
+			BDecoder().feed("di1ei2ee")
+		with self.assertRaises(BTFailure):
+			BDecoder().feed("i01e")
+
+	def test_compact_errors(self):
+		with self.assertRaises(BTFailure) as context:
+			bdecode("l" + "x" * 10 ** 6)
+		self.assertTrue(len(str(context.exception)) < 200)
+
+	def test_buffer_encoder(self):
+		metainfo = {"announce": "http://tracker", "info": {"name": "test", "pieces": "\x01" * 100000, "length": 10 ** 12},
+					"list": [1, True, "two", (3, [4])]}
+		encoder = BEncoder()
+		self.assertEqual(bencode(metainfo), encoder.encode(metainfo).getvalue())
+		encoder.reset()
+		self.assertEqual("i1e", encoder.encode(1).getvalue())
+
+		sink = io.BytesIO()
+		BEncoder(sink=sink, flush_size=16).encode(metainfo)
+		self.assertEqual(bencode(metainfo), sink.getvalue())
+
+		cached = dict(metainfo, info=bencached(metainfo["info"]))
+		self.assertEqual(bencode(metainfo), BEncoder().encode(cached).getvalue())
+
+		ordered = OrderedDict([("a", 1), ("b", 2)])
+		self.assertEqual("d1:ai1e1:bi2ee", BEncoder(sort_keys=False).encode(ordered).getvalue())
+
 
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
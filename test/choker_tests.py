@@ -0,0 +1,126 @@
+import random
+import unittest
+from coast.choker import Choker
+from coast.ratemeter import RateMeter
+from coast.constants import CHOKE_INTERVAL, DEFAULT_UPLOAD_SLOTS
+
+
+class SimulatedTorrent:
+	def __init__(self):
+		self.active_peers = []
+		self.is_complete = False
+
+
+class SimulatedLink:
+	"""
+	One side of a connection between two simulated clients (stands in for a Peer)
+	"""
+	def __init__(self, owner, remote):
+		self.owner = owner
+		self.remote = remote
+		self.reverse = None
+		self.handshake_exchanged = True
+		self.peer_interested = 1
+		self.am_interested = 1
+		self.am_choking = 1
+		self.peer_choking = 1
+		self.download_meter = RateMeter()
+		self.upload_meter = RateMeter()
+
+	def set_choking(self, choking):
+		self.am_choking = choking
+		self.reverse.peer_choking = choking
+
+	def is_snubbing(self, current_time):
+		return False
+
+
+class SimulatedClient:
+	def __init__(self, name, upload_capacity):
+		self.name = name
+		self.upload_capacity = upload_capacity
+		self.torrent = SimulatedTorrent()
+		self.choker = Choker(self.torrent)
+		self.links = {}
+
+
+def build_swarm(clients):
+	for client in clients:
+		for remote in clients:
+			if remote is not client:
+				client.links[remote] = SimulatedLink(client, remote)
+				client.torrent.active_peers.append(client.links[remote])
+	for client in clients:
+		for remote, link in client.links.items():
+			link.reverse = remote.links[client]
+
+
+def transfer(clients, start_time):
+	"""
+	Every client splits its upload capacity evenly between the peers it has unchoked, for one
+	choking interval starting at the given time
+	"""
+	for client in clients:
+		unchoked = [link for link in client.links.values() if link.am_choking == 0]
+		for link in unchoked:
+			for second in range(CHOKE_INTERVAL):
+				sent = client.upload_capacity / len(unchoked)
+				link.upload_meter.update(sent, start_time + second)
+				link.reverse.download_meter.update(sent, start_time + second)
+
+
+class ChokerTests(unittest.TestCase):
+	def test_upload_slots_scale_with_bandwidth(self):
+		self.assertEqual(DEFAULT_UPLOAD_SLOTS, Choker(SimulatedTorrent()).get_upload_slots())
+		self.assertEqual(2, Choker(SimulatedTorrent(), upload_rate_limit=4 * 1024).get_upload_slots())
+		self.assertEqual(7, Choker(SimulatedTorrent(), upload_rate_limit=100 * 1024).get_upload_slots())
+		self.assertTrue(
+			Choker(SimulatedTorrent(), upload_rate_limit=1000 * 1024).get_upload_slots() >
+			Choker(SimulatedTorrent(), upload_rate_limit=100 * 1024).get_upload_slots())
+
+	def test_reciprocating_peers_unchoke_us(self):
+		random.seed(3)
+		us = SimulatedClient("us", 50 * 1024)
+		reciprocators = [SimulatedClient("reciprocator{}".format(i), 20 * 1024) for i in range(4)]
+		free_riders = [SimulatedClient("free_rider{}".format(i), 0) for i in range(6)]
+		clients = [us] + reciprocators + free_riders
+		build_swarm(clients)
+
+		for simulated_round in range(12):
+			round_time = simulated_round * CHOKE_INTERVAL
+			for client in clients:
+				client.choker.run_round(round_time)
+			transfer(clients, round_time)
+
+		regular_unchokes = [link.remote for link in us.links.values()
+							if link.am_choking == 0 and link is not us.choker.optimistic_peer]
+		unchoking_us = [link.remote for link in us.links.values() if link.peer_choking == 0]
+
+		# we reward the peers that upload to us...
+		self.assertEqual(DEFAULT_UPLOAD_SLOTS - 1, len(regular_unchokes))
+		for remote in regular_unchokes:
+			self.assertTrue(remote in reciprocators)
+		# ...and they return the favour
+		for remote in regular_unchokes:
+			self.assertTrue(remote in unchoking_us)
+
+	def test_seeding_sorts_by_upload_rate(self):
+		torrent = SimulatedTorrent()
+		torrent.is_complete = True
+		choker = Choker(torrent)
+		remote_clients = [SimulatedClient("remote{}".format(i), 0) for i in range(6)]
+		links = []
+		for index, remote in enumerate(remote_clients):
+			link = SimulatedLink(None, remote)
+			link.reverse = SimulatedLink(remote, None)
+			link.upload_meter.update(index * 1000, 0)
+			links.append(link)
+		torrent.active_peers = links
+
+		unchoked = choker.run_round(1)
+		for link in links[-(DEFAULT_UPLOAD_SLOTS - 1):]:
+			self.assertTrue(link in unchoked)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from coast.filemap import FileMap, FileHandlePool
+
+
+class FileMapTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		# 10 + 0 + 25 + 5 = 40 bytes in pieces of 16
+		self.files = [(["a"], 10), (["empty"], 0), (["dir", "b"], 25), (["dir", "c"], 5)]
+		self.file_map = FileMap(self.files, 16, self.directory)
+
+	def tearDown(self):
+		self.file_map.close()
+		shutil.rmtree(self.directory)
+
+	def test_hostile_paths(self):
+		for path in (["..", "..", "evil"], ["/etc", "x"], ["dir", ""], ["."], ["dir/../../x"], []):
+			self.assertRaises(ValueError, FileMap, [(["a"], 4), (path, 4)], 16, self.directory)
+
+		# a directory of the download that links outside of it
+		os.symlink("/tmp", os.path.join(self.directory, "link"))
+		self.assertRaises(ValueError, FileMap, [(["link", "x"], 4)], 16, self.directory)
+
+	def test_piece_lengths(self):
+		self.assertEqual(40, self.file_map.total_length)
+		self.assertEqual(16, self.file_map.get_piece_length(0))
+		self.assertEqual(8, self.file_map.get_piece_length(2))
+
+	def test_spans(self):
+		self.assertEqual([(0, 0, 10), (2, 0, 6)], self.file_map.get_piece_spans(0))
+		self.assertEqual([(2, 6, 16)], self.file_map.get_piece_spans(1))
+		self.assertEqual([(2, 22, 3), (3, 0, 5)], self.file_map.get_piece_spans(2))
+		self.assertEqual([(2, 4, 2)], self.file_map.get_block_spans(0, 14, 2))
+
+	def test_file_pieces(self):
+		self.assertEqual([(0, 1), (0, 0), (0, 3), (2, 3)], [self.file_map.get_file_pieces(i) for i in range(4)])
+
+	def test_write_and_read_across_files(self):
+		data = "".join(chr(ord("a") + i % 26) for i in range(40))
+		for index in range(3):
+			self.file_map.write_block(index, 0, data[index * 16:index * 16 + self.file_map.get_piece_length(index)])
+
+		self.assertEqual(data[:10], open(os.path.join(self.directory, "a")).read())
+		self.assertFalse(os.path.exists(os.path.join(self.directory, "empty")))
+		self.assertEqual(data[10:35], open(os.path.join(self.directory, "dir", "b")).read())
+		self.assertEqual(data[35:], open(os.path.join(self.directory, "dir", "c")).read())
+		self.assertEqual(data[8:20], self.file_map.read_block(0, 8, 12))
+		self.assertEqual(None, self.file_map.read_block(2, 0, 16))
+
+		self.file_map.create_empty_files()
+		self.assertEqual(0, os.path.getsize(os.path.join(self.directory, "empty")))
+
+	def test_handle_pool_is_bounded(self):
+		pool = FileHandlePool(max_open=2)
+		paths = [os.path.join(self.directory, "file{}".format(i)) for i in range(5)]
+		for path in paths:
+			pool.write(path, 0, "data")
+		self.assertEqual(paths[-2:], list(pool.handles))
+		# evicted files are synced before they are closed, the open ones on the next sync
+		self.assertEqual(set(paths[-2:]), pool.dirty)
+		pool.sync()
+		self.assertEqual(set(), pool.dirty)
+
+		# reading an old file reopens it and evicts the least recently used one
+		self.assertEqual("data", pool.read(paths[0], 0, 4))
+		self.assertEqual([paths[4], paths[0]], list(pool.handles))
+		pool.close()
+		self.assertEqual(0, len(pool.handles))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.web.test.requesthelper import DummyRequest
+from coast.httpserver import parse_range, TorrentResource, TorrentListResource
+from coast.filemap import FileMap
+from coast.constants import HTTP_SERVER_CHUNK_SIZE
+
+PIECE_LENGTH = 16384
+
+
+class SimulatedTorrent:
+	def __init__(self, files):
+		self.torrent_name = "simulated"
+		self.file_map = FileMap(files, PIECE_LENGTH, "/nonexistent")
+		self.data = "".join(chr(i % 251) for i in range(self.file_map.total_length))
+		self.have = set(range(len(self.data) / PIECE_LENGTH + 1))
+		self.waits = []
+
+	def wait_for_range(self, offset, length):
+		missing = set(range(offset / PIECE_LENGTH, (offset + length - 1) / PIECE_LENGTH + 1)) - self.have
+		if len(missing) == 0:
+			return defer.succeed(None)
+		waiting = defer.Deferred(lambda deferred: self.waits.remove(deferred))
+		self.waits.append(waiting)
+		return waiting
+
+	def read_range(self, offset, length):
+		return self.data[offset:offset + length]
+
+
+class SimulatedRequest(DummyRequest):
+	"""
+	Holds on to its producer like a real transport instead of pulling from it
+	"""
+	def registerProducer(self, producer, streaming):
+		self.producer = producer
+
+	def unregisterProducer(self):
+		self.producer = None
+
+
+def build_request(path, range_header=None):
+	request = SimulatedRequest(path.split("/"))
+	if range_header is not None:
+		request.requestHeaders.setRawHeaders("range", [range_header])
+	return request
+
+
+class HTTPServerTests(unittest.TestCase):
+	def setUp(self):
+		self.torrent = SimulatedTorrent([(["notes.txt"], 10), (["video", "clip.mp4"], 3 * HTTP_SERVER_CHUNK_SIZE + 5)])
+		self.resource = TorrentResource(self.torrent)
+		self.clip = self.torrent.data[10:]
+
+	def test_parse_range(self):
+		self.assertEqual(None, parse_range(None, 100))
+		self.assertEqual((0, 100), parse_range("bytes=0-", 100))
+		self.assertEqual((10, 21), parse_range("bytes=10-20", 100))
+		self.assertEqual((90, 100), parse_range("bytes=-10", 100))
+		self.assertEqual((90, 100), parse_range("bytes=90-500", 100))
+		self.assertEqual(None, parse_range("bytes=0-1,5-6", 100))
+		self.assertEqual(None, parse_range("items=0-1", 100))
+		self.assertEqual(None, parse_range("bytes=20-10", 100))
+		self.assertRaises(ValueError, parse_range, "bytes=100-", 100)
+		self.assertRaises(ValueError, parse_range, "bytes=-0", 100)
+
+	def test_listing(self):
+		request = build_request("")
+		request.render(TorrentListResource(SimulatedCore([self.torrent])))
+		self.assertEqual("0: simulated\n", "".join(request.written))
+
+		request = build_request("")
+		request.render(self.resource)
+		self.assertEqual("notes.txt\nvideo/clip.mp4\n", "".join(request.written))
+
+	def test_torrent_index(self):
+		torrent_list = TorrentListResource(SimulatedCore([self.torrent]))
+		self.assertTrue(isinstance(torrent_list.getChild("0", None), TorrentResource))
+		for name in ("1", "-1", "+0", " 0", "x", ""):
+			self.assertFalse(isinstance(torrent_list.getChild(name, None), TorrentResource), name)
+
+	def test_whole_file(self):
+		request = build_request("video/clip.mp4")
+		request.render(self.resource)
+		self.assertEqual(1, request.finished)
+		self.assertEqual(self.clip, "".join(request.written))
+		self.assertEqual([str(len(self.clip))], request.responseHeaders.getRawHeaders("content-length"))
+		self.assertEqual(["video/mp4"], request.responseHeaders.getRawHeaders("content-type"))
+
+	def test_range(self):
+		request = build_request("video/clip.mp4", "bytes=100-199")
+		request.render(self.resource)
+		self.assertEqual(206, request.responseCode)
+		self.assertEqual(["bytes 100-199/{}".format(len(self.clip))], request.responseHeaders.getRawHeaders("content-range"))
+		self.assertEqual(self.clip[100:200], "".join(request.written))
+
+		request = build_request("notes.txt", "bytes=10-")
+		request.render(self.resource)
+		self.assertEqual(416, request.responseCode)
+		self.assertEqual(["bytes */10"], request.responseHeaders.getRawHeaders("content-range"))
+
+	def test_waits_for_missing_pieces(self):
+		# the last piece, which the third and fourth chunks share
+		missing_piece = (len(self.torrent.data) - 1) / PIECE_LENGTH
+		self.torrent.have.remove(missing_piece)
+		request = build_request("video/clip.mp4")
+		request.render(self.resource)
+		self.assertEqual(0, request.finished)
+		self.assertEqual(self.clip[:2 * HTTP_SERVER_CHUNK_SIZE], "".join(request.written))
+		self.assertEqual(1, len(self.torrent.waits))
+
+		self.torrent.have.add(missing_piece)
+		self.torrent.waits.pop().callback(None)
+		self.assertEqual(1, request.finished)
+		self.assertEqual(self.clip, "".join(request.written))
+
+	def test_disconnect_cancels_wait(self):
+		self.torrent.have = set()
+		request = build_request("video/clip.mp4", "bytes=0-10")
+		request.render(self.resource)
+		self.assertEqual(1, len(self.torrent.waits))
+		request.processingFailed(Failure(ConnectionDone()))
+		self.assertEqual([], self.torrent.waits)
+
+	def test_pause(self):
+		request = build_request("video/clip.mp4")
+		self.torrent.have = set()
+		request.render(self.resource)
+		request.producer.pauseProducing()
+		self.torrent.have = set(range(len(self.torrent.data) / PIECE_LENGTH + 1))
+		self.torrent.waits.pop().callback(None)
+		self.assertEqual("", "".join(request.written))
+		request.producer.resumeProducing()
+		self.assertEqual(self.clip, "".join(request.written))
+
+
+class SimulatedCore:
+	def __init__(self, torrents):
+		self.active_torrents = torrents
+
+
+if __name__ == "__main__":
+	unittest.main()
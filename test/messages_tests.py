@@ -1,4 +1,3 @@
-import os
 import unittest
 
 from test.test_data import test_captured_request, test_stream_processor_stream, \
@@ -57,8 +56,7 @@ class MessageTests(unittest.TestCase):
 
 	def test_piece_message(self):
 		test_piece_mes = PieceMessage(index=0, begin=0, block=("A"*REQUEST_SIZE))
-		test_piece = Piece(524288, 1670, "test_hash",
-						   os.path.join(os.path.expanduser("~"), "Downloads/"))
+		test_piece = Piece(524288, 1670, "test_hash")
 		test_request_mes = RequestMessage(index=0, begin=0)
 		test_piece.add_non_completed_request_index(test_request_mes)
 		test_piece.append_data(test_piece_mes)
@@ -0,0 +1,48 @@
+import os
+import unittest
+from coast.mmapstorage import MmapStorage
+from test.test_data import StorageTestCase
+
+
+class MmapStorageTests(StorageTestCase):
+	def setUp(self):
+		StorageTestCase.setUp(self)
+		self.file_map = self.build_file_map()
+		self.storage = MmapStorage(self.file_map, self.directory, max_maps=2)
+
+	def tearDown(self):
+		self.storage.close()
+		StorageTestCase.tearDown(self)
+
+	def write_pieces(self):
+		for index in range(3):
+			self.storage.write_block(index, 0, self.data[index * 16:index * 16 + self.file_map.get_piece_length(index)])
+
+	def test_write_and_read_across_files(self):
+		self.write_pieces()
+		# only two files are mapped at a time, the first was written back when it was unmapped
+		self.assertEqual(2, len(self.storage.maps))
+		self.assertEqual(self.data[8:20], self.storage.read_block(0, 8, 12))
+		self.assertEqual(self.data[16:32], self.storage.read_block(1, 0, 16))
+
+		self.storage.flush()
+		self.assertEqual(set(), self.storage.dirty)
+		with open(os.path.join(self.directory, "dir", "b"), "rb") as b_file:
+			self.assertEqual(self.data[10:35], b_file.read())
+
+	def test_files_are_preallocated(self):
+		self.storage.write_block(0, 0, self.data[:4])
+		self.assertEqual(10, os.path.getsize(os.path.join(self.directory, "a")))
+		# nothing is read from (or created for) a file that doesn't exist yet
+		self.assertEqual(None, self.storage.read_block(2, 0, 8))
+		self.assertFalse(os.path.exists(os.path.join(self.directory, "c")))
+
+	def test_skipped_files_are_not_allocated(self):
+		self.file_map.skipped_files = {1}
+		self.write_pieces()
+		self.assertFalse(os.path.exists(os.path.join(self.directory, "dir", "b")))
+		self.assertEqual(self.data[35:], self.storage.read_block(2, 3, 5))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,80 @@
+import os
+import unittest
+from coast.packstorage import PackStorage, INDEX_ENTRY
+from coast.constants import PACK_FILE_NAME, PACK_INDEX_FILE_NAME
+from test.test_data import StorageTestCase
+
+
+class PackStorageTests(StorageTestCase):
+	def setUp(self):
+		StorageTestCase.setUp(self)
+		self.storage = self.build_storage()
+
+	def tearDown(self):
+		self.storage.close()
+		StorageTestCase.tearDown(self)
+
+	def build_storage(self):
+		return PackStorage(self.build_file_map(), self.directory)
+
+	def write_pieces(self):
+		# 2 arrives first, 0 and 1 together as a run
+		self.storage.write_piece(2, self.data[32:])
+		self.storage.write_pieces(0, self.data[:32])
+
+	def test_pieces_are_appended(self):
+		self.write_pieces()
+		self.assertEqual({2: 0, 0: 8, 1: 24}, self.storage.offsets)
+		# the entries are written once the pack has been synced
+		index_path = os.path.join(self.directory, "tmp", PACK_INDEX_FILE_NAME)
+		self.assertFalse(os.path.exists(index_path))
+		self.storage.flush()
+		self.assertEqual(3 * INDEX_ENTRY.size, os.path.getsize(index_path))
+		# a block spanning pieces that aren't next to each other in the pack
+		self.assertEqual(self.data[28:36], self.storage.read_block(1, 12, 8))
+		self.assertEqual(None, self.storage.read_block(2, 4, 8))
+
+	def test_index_is_reloaded(self):
+		self.write_pieces()
+		self.storage.remove_piece(1)
+		self.storage.close()
+		# a torn index entry and an entry pointing past the end of the pack are ignored
+		with open(os.path.join(self.directory, "tmp", PACK_INDEX_FILE_NAME), "ab") as index_file:
+			index_file.write(INDEX_ENTRY.pack(1, 40) + "\x00\x00")
+
+		self.storage = self.build_storage()
+		self.assertEqual([0, 2], self.storage.get_indexed_pieces())
+		self.assertEqual(self.data[:16], self.storage.read_piece(0))
+		self.storage.write_piece(1, self.data[16:32])
+		self.storage.close()
+		self.assertEqual([0, 1, 2], self.build_storage().get_indexed_pieces())
+
+	def test_partial_pieces_are_not_indexed(self):
+		self.storage.write_block(1, 8, self.data[24:32])
+		self.storage.write_block(1, 0, self.data[16:20])
+		self.storage.flush()
+		self.assertFalse(self.storage.has_piece(1))
+		self.storage.close()
+		self.storage = self.build_storage()
+		self.assertEqual([], self.storage.get_indexed_pieces())
+
+		self.storage.write_block(1, 8, self.data[24:32])
+		self.storage.write_block(1, 4, self.data[20:24])
+		self.storage.write_block(1, 0, self.data[16:20])
+		self.assertTrue(self.storage.has_piece(1))
+		self.storage.close()
+		self.assertEqual([1], self.build_storage().get_indexed_pieces())
+
+	def test_finalize(self):
+		self.write_pieces()
+		self.storage.finalize([0, 1, 2])
+		for path, start, end in [(["a"], 0, 10), (["dir", "b"], 10, 35), (["c"], 35, 40)]:
+			with open(os.path.join(self.directory, *path), "rb") as output_file:
+				self.assertEqual(self.data[start:end], output_file.read())
+		self.assertFalse(os.path.exists(os.path.join(self.directory, "tmp", PACK_FILE_NAME)))
+		# blocks are read from the torrent's files afterwards
+		self.assertEqual(self.data[8:24], self.storage.read_block(0, 8, 16))
+
+
+if __name__ == "__main__":
+	unittest.main()
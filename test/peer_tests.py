@@ -3,9 +3,13 @@ from bitarray import bitarray
 
 from coast.peer import Peer
 from coast.piece import Piece
-from coast.messages import BitfieldMessage
-from coast.helpermethods import convert_hex_to_int
-from test.test_data import test_bitfield, test_peer_chunk, test_torrent, test_piece_message
+from coast.torrent import Torrent
+from twisted.test.proto_helpers import StringTransport
+from coast.messages import BitfieldMessage, HaveMessage, InterestedMessage, NotInterestedMessage, RequestMessage
+from coast.constants import REQUEST_SIZE, MAX_UPLOAD_QUEUE
+from coast.helpermethods import convert_hex_to_int, convert_int_to_hex
+from test.test_data import test_bitfield, test_peer_chunk, test_torrent, test_piece_message, test_peer_id, \
+	test_port, test_torrent_file_path
 
 
 class TestPeer(unittest.TestCase):
@@ -42,6 +46,71 @@ class TestPeer(unittest.TestCase):
 		test_piece = Piece(
 			piece_length=test_torrent.metadata["piece_length"],
 			index=0,
-			hash=test_torrent.pieces_hashes[0],
-			download_location=test_torrent.download_root
+			hash=test_torrent.pieces_hashes[0]
 		)
+
+	def test_bitfield_sized_from_torrent(self):
+		test_peer = Peer(test_torrent, test_peer_chunk)
+		self.assertEqual(len(test_torrent.pieces_hashes), len(test_peer.bitfield))
+		self.assertFalse(test_peer.received_bitfield())
+		self.assertFalse(test_peer.has_piece(5))
+
+		test_peer.process_have_message(HaveMessage(data="\x00\x00\x00\x05\x04" + convert_int_to_hex(5, 4)))
+		self.assertTrue(test_peer.received_bitfield())
+		self.assertTrue(test_peer.has_piece(5))
+		self.assertEqual(len(test_torrent.pieces_hashes), len(test_peer.bitfield))
+
+	def test_interest_follows_bitfields(self):
+		interest_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		test_peer = Peer(interest_torrent, test_peer_chunk)
+		self.assertEqual([], test_peer.get_next_messages())
+
+		test_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		interest_messages = test_peer.get_next_messages()
+		self.assertEqual(1, len(interest_messages))
+		self.assertTrue(isinstance(interest_messages[0], InterestedMessage))
+
+		# once we have everything the peer has, we tell it we are no longer interested
+		interest_torrent.bitfield.setall(True)
+		interest_messages = test_peer.get_next_messages()
+		self.assertEqual(1, len(interest_messages))
+		self.assertTrue(isinstance(interest_messages[0], NotInterestedMessage))
+		self.assertEqual(0, test_peer.am_interested)
+
+	def test_requests_are_checked(self):
+		def request(index, begin, length):
+			return RequestMessage(data="\x00\x00\x00\x0d\x06" + convert_int_to_hex(index, 4) +
+				convert_int_to_hex(begin, 4) + convert_int_to_hex(length, 4))
+
+		class FakeProtocol:
+			def __init__(self):
+				self.transport = StringTransport()
+
+		request_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		request_torrent.bitfield.setall(True)
+		last_index = len(request_torrent.bitfield) - 1
+		last_length = request_torrent.file_map.get_piece_length(last_index)
+		test_peer = Peer(request_torrent, test_peer_chunk)
+		test_peer.protocol = FakeProtocol()
+		test_peer.am_choking = 0
+
+		test_peer.process_request_message(request(0, 0, REQUEST_SIZE))
+		# the short block at the end of the torrent
+		test_peer.process_request_message(request(last_index, last_length - 100, 100))
+		self.assertEqual(2, len(test_peer.upload_queue))
+		self.assertFalse(test_peer.protocol.transport.disconnecting)
+
+		for index, begin, length in [(last_index + 1, 0, REQUEST_SIZE), (0, 0, 8 * REQUEST_SIZE),
+				(last_index, last_length - 100, REQUEST_SIZE), (0, 0, 0)]:
+			test_peer.protocol = FakeProtocol()
+			test_peer.process_request_message(request(index, begin, length))
+			self.assertTrue(test_peer.protocol.transport.disconnecting, (index, begin, length))
+			self.assertEqual([], test_peer.upload_queue)
+
+		# requests beyond the queue limit are dropped
+		for begin in range(MAX_UPLOAD_QUEUE + 10):
+			test_peer.process_request_message(request(0, 0, REQUEST_SIZE))
+		self.assertEqual(MAX_UPLOAD_QUEUE, len(test_peer.upload_queue))
+		# nothing is served before the peer's buckets are attached
+		self.assertEqual([], test_peer.serve_requested_blocks())
+		self.assertEqual(MAX_UPLOAD_QUEUE, len(test_peer.upload_queue))
@@ -1,7 +1,7 @@
 import os
 import unittest
 
-from coast.piece import Piece
+from coast.piece import Piece, PieceHashes
 from coast.torrent import Torrent
 from coast.messages import PieceMessage, RequestMessage
 from coast.helpermethods import one_directory_back
@@ -24,10 +24,9 @@ class PieceTests(unittest.TestCase):
 		test_piece_size = test_torrent.metadata["piece_length"]
 		test_piece_index = 0
 		test_piece_hash = test_torrent.pieces_hashes[test_piece_index]
-		test_download_location = test_torrent.download_root
 
 		test_piece_block = PieceMessage(index=0, begin=0, block=("A"*REQUEST_SIZE))
-		test_piece = Piece(test_piece_size, test_piece_index, test_piece_hash, test_download_location)
+		test_piece = Piece(test_piece_size, test_piece_index, test_piece_hash)
 		test_request = RequestMessage(index=test_piece_block.get_index(),
 									  begin=test_piece_block.get_begin())
 		test_piece.add_non_completed_request_index(test_request)
@@ -38,3 +37,26 @@ class PieceTests(unittest.TestCase):
 		self.assertEqual(16384, len([val for val in test_piece.data if val != 0]))
 		# check to see if our next index is correct
 		self.assertEqual(16384, test_piece.get_next_begin())
+
+	def test_reclaimed_block_is_requested_again(self):
+		test_piece = Piece(524288, 0, "test_hash")
+		first_request = RequestMessage(index=0, begin=test_piece.get_next_begin())
+		test_piece.add_non_completed_request_index(first_request)
+		second_request = RequestMessage(index=0, begin=test_piece.get_next_begin())
+		test_piece.add_non_completed_request_index(second_request)
+		self.assertEqual(2 * REQUEST_SIZE, test_piece.get_next_begin())
+
+		test_piece.remove_non_completed_request_index(first_request)
+		self.assertEqual(0, test_piece.get_next_begin())
+
+	def test_piece_hashes_index_contiguous_buffer(self):
+		pieces = "".join(chr(index) * 20 for index in range(5))
+		hashes = PieceHashes(pieces)
+		self.assertEqual(5, len(hashes))
+		self.assertEqual(chr(3) * 20, hashes[3])
+		self.assertEqual(chr(4) * 20, hashes[-1])
+		self.assertEqual([chr(index) * 20 for index in range(5)], list(hashes))
+		with self.assertRaises(IndexError):
+			hashes[5]
+		with self.assertRaises(ValueError):
+			PieceHashes("too short")
@@ -1,9 +1,91 @@
 import unittest
+from twisted.internet.task import Clock
 from twisted.internet.protocol import Protocol, ClientFactory
+from twisted.test.proto_helpers import StringTransport
 
+from coast.peer import Peer
+from coast.torrent import Torrent
+from coast.messages import HandshakeMessage, BitfieldMessage, HaveMessage
+from coast.constants import STORAGE_MEMORY
+from coast.helpermethods import convert_int_to_hex
 from coast.protocols import PeerProtocol, PeerFactory
+from test.test_data import test_torrent_file_path, test_peer_id, test_port, test_peer_chunk
+
+
+def connect(torrent):
+	peer = Peer(torrent, test_peer_chunk)
+	factory = PeerFactory(torrent, Clock(), peer)
+	protocol = factory.buildProtocol(None)
+	protocol.makeConnection(StringTransport())
+	return protocol
 
 
 class ProtocolTests(unittest.TestCase):
 	def test1(self):
-		pass
\ No newline at end of file
+		pass
+
+	def test_handshake_sent_on_connect(self):
+		handshake_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		protocol = connect(handshake_torrent)
+		self.assertEqual(handshake_torrent.get_handshake(), protocol.transport.value())
+
+	def test_handshake_validated_once(self):
+		handshake_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		protocol = connect(handshake_torrent)
+		remote_handshake = HandshakeMessage(info_hash=handshake_torrent.info_hash, peer_id="-XX0001-000000000000")
+		protocol.dataReceived(remote_handshake.message())
+		self.assertTrue(protocol.handshake_exchanged)
+		self.assertFalse(protocol.transport.disconnecting)
+
+		# the info hash is never looked at again once the handshake has been checked
+		handshake_torrent.info_hash = None
+		protocol.dataReceived("\x00\x00\x00\x00")
+		self.assertFalse(protocol.transport.disconnecting)
+
+	def test_wrong_info_hash_disconnects(self):
+		handshake_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		protocol = connect(handshake_torrent)
+		remote_handshake = HandshakeMessage(info_hash="\x00" * 20, peer_id="-XX0001-000000000000")
+		protocol.dataReceived(remote_handshake.message())
+		self.assertTrue(protocol.transport.disconnecting)
+
+	def test_single_inactivity_check_per_connection(self):
+		handshake_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		protocol = connect(handshake_torrent)
+		for read in range(5):
+			protocol.dataReceived("\x00\x00\x00\x00")
+		self.assertEqual(1, len(protocol.reactor.getDelayedCalls()))
+
+	def test_peer_buckets_follow_the_connection(self):
+		bucket_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		peer = Peer(bucket_torrent, test_peer_chunk)
+		self.assertEqual([], bucket_torrent.download_bucket.children)
+		protocol = PeerFactory(bucket_torrent, Clock(), peer).buildProtocol(None)
+		protocol.makeConnection(StringTransport())
+		self.assertEqual([peer.download_bucket], bucket_torrent.download_bucket.children)
+		self.assertEqual([peer.upload_bucket], bucket_torrent.upload_bucket.children)
+
+		protocol.connectionLost(None)
+		self.assertEqual([], bucket_torrent.download_bucket.children)
+		self.assertEqual([], bucket_torrent.upload_bucket.children)
+		self.assertEqual(None, peer.download_bucket)
+
+	def test_pieces_are_announced(self):
+		announcing_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path, storage_mode=STORAGE_MEMORY)
+		# nothing to announce yet
+		protocol = connect(announcing_torrent)
+		self.assertEqual(announcing_torrent.get_handshake(), protocol.transport.value())
+
+		announcing_torrent.bitfield[3] = 1
+		protocol = connect(announcing_torrent)
+		bitfield = announcing_torrent.bitfield.tobytes()
+		self.assertEqual(announcing_torrent.get_handshake() + BitfieldMessage(bitfield=bitfield).message(),
+			protocol.transport.value())
+
+		# a HAVE goes to connected peers once a piece is saved
+		protocol.transport.clear()
+		announcing_torrent.active_peers = [protocol.peer, Peer(announcing_torrent, test_peer_chunk)]
+		piece = announcing_torrent.start_piece(5)
+		piece.data = ["x"] * announcing_torrent.file_map.get_piece_length(5)
+		announcing_torrent.save_completed_peer_piece_to_disk(piece)
+		self.assertEqual(HaveMessage(piece_index=convert_int_to_hex(5, 4)).message(), protocol.transport.value())
@@ -0,0 +1,114 @@
+import unittest
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from coast.ratelimiter import TokenBucket, RateLimiter
+from coast.constants import RATE_LIMIT_REFILL_INTERVAL, RATE_LIMIT_BURST
+
+
+class RateLimiterTests(unittest.TestCase):
+	def test_unlimited_bucket(self):
+		bucket = TokenBucket()
+		bucket.consume(10 ** 9)
+		self.assertFalse(bucket.is_exhausted())
+
+	def test_child_charges_parent(self):
+		parent = TokenBucket(1000)
+		child = parent.add_child()
+		child.consume(int(1000 * RATE_LIMIT_BURST))
+		self.assertTrue(parent.is_exhausted())
+		self.assertTrue(child.is_exhausted())
+		self.assertEqual(1000, child.get_effective_rate())
+
+	def test_transport_paused_and_resumed(self):
+		clock = Clock()
+		limiter = RateLimiter(download_rate=1000, clock=clock)
+		torrent_bucket = limiter.download.add_child()
+		peer_bucket = torrent_bucket.add_child()
+		transport = StringTransport()
+		limiter.start()
+
+		limiter.throttle_download(transport, peer_bucket, 2000)
+		self.assertEqual("paused", transport.producerState)
+
+		# two seconds of refills pay back the debt and leave tokens over
+		for tick in range(int(2.0 / RATE_LIMIT_REFILL_INTERVAL) + 1):
+			clock.advance(RATE_LIMIT_REFILL_INTERVAL)
+		self.assertEqual("producing", transport.producerState)
+
+	def test_busy_torrent_does_not_starve_others(self):
+		clock = Clock()
+		limiter = RateLimiter(download_rate=10000, clock=clock)
+		busy_torrent = limiter.download.add_child()
+		quiet_torrent = limiter.download.add_child()
+		busy_transport = StringTransport()
+		quiet_transport = StringTransport()
+		limiter.start()
+
+		busy_received = 0
+		quiet_received = 0
+		for tick in range(100):
+			clock.advance(RATE_LIMIT_REFILL_INTERVAL)
+			# the busy torrent reads everything it is allowed to before the quiet one gets a turn
+			while busy_transport.producerState == "producing":
+				limiter.throttle_download(busy_transport, busy_torrent, 100)
+				busy_received += 100
+			if quiet_transport.producerState == "producing":
+				limiter.throttle_download(quiet_transport, quiet_torrent, 100)
+				quiet_received += 100
+
+		# the quiet torrent gets every read it asked for
+		self.assertEqual(100 * 100, quiet_received)
+		self.assertTrue(busy_received + quiet_received <= 10000 * (2 + RATE_LIMIT_BURST) + 200)
+
+	def test_runtime_rate_change(self):
+		clock = Clock()
+		limiter = RateLimiter(download_rate=1000, clock=clock)
+		bucket = limiter.download.add_child()
+		transport = StringTransport()
+		limiter.start()
+
+		limiter.throttle_download(transport, bucket, 5000)
+		self.assertEqual("paused", transport.producerState)
+		limiter.set_download_rate(0)
+		clock.advance(RATE_LIMIT_REFILL_INTERVAL)
+		self.assertEqual("producing", transport.producerState)
+
+	def test_refills_only_run_with_a_limit(self):
+		clock = Clock()
+		limiter = RateLimiter(clock=clock)
+		torrent_bucket = limiter.download.add_child()
+		transport = StringTransport()
+		limiter.start()
+		self.assertEqual([], clock.getDelayedCalls())
+
+		torrent_bucket.set_rate(1000)
+		limiter.update_refills()
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+		limiter.throttle_download(transport, torrent_bucket, 5000)
+		self.assertEqual("paused", transport.producerState)
+
+		# lifting the last limit stops the refills and lets the transport go
+		torrent_bucket.set_rate(0)
+		limiter.update_refills()
+		self.assertEqual([], clock.getDelayedCalls())
+		self.assertEqual("producing", transport.producerState)
+		self.assertFalse(torrent_bucket.is_exhausted())
+
+	def test_upload_waiter_called_after_refill(self):
+		clock = Clock()
+		limiter = RateLimiter(upload_rate=1000, clock=clock)
+		bucket = limiter.upload.add_child()
+		called = []
+		limiter.start()
+
+		bucket.consume(1000)
+		limiter.wait_for_upload(bucket, lambda: called.append(True))
+		clock.advance(RATE_LIMIT_REFILL_INTERVAL)
+		self.assertEqual([], called)
+		for tick in range(int(1.0 / RATE_LIMIT_REFILL_INTERVAL)):
+			clock.advance(RATE_LIMIT_REFILL_INTERVAL)
+		self.assertEqual([True], called)
+
+
+if __name__ == "__main__":
+	unittest.main()
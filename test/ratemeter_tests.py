@@ -0,0 +1,42 @@
+import unittest
+from coast.ratemeter import RateMeter
+from coast.constants import RATE_METER_WINDOW, RATE_METER_HALF_LIFE
+
+
+class RateMeterTests(unittest.TestCase):
+	def test_window_rate(self):
+		meter = RateMeter()
+		for second in range(RATE_METER_WINDOW):
+			meter.update(1000, current_time=100 + second)
+		self.assertEqual(1000, meter.get_window_rate(current_time=100 + RATE_METER_WINDOW - 1))
+		# the oldest slot drops out as time moves on
+		self.assertEqual(800, meter.get_window_rate(current_time=100 + RATE_METER_WINDOW))
+		self.assertEqual(0, meter.get_window_rate(current_time=100 + 10 * RATE_METER_WINDOW))
+		self.assertEqual(RATE_METER_WINDOW * 1000, meter.total)
+
+	def test_average_converges_and_decays(self):
+		meter = RateMeter()
+		for second in range(20 * RATE_METER_HALF_LIFE):
+			meter.update(2048, current_time=second)
+		self.assertAlmostEqual(2048, meter.get_rate(current_time=20 * RATE_METER_HALF_LIFE), delta=1)
+
+		# a half life of silence halves the average
+		steady_rate = meter.get_rate(current_time=20 * RATE_METER_HALF_LIFE)
+		self.assertAlmostEqual(steady_rate / 2, meter.get_rate(current_time=21 * RATE_METER_HALF_LIFE), delta=1)
+
+	def test_updates_reach_ancestors(self):
+		client_meter = RateMeter()
+		torrent_meter = client_meter.add_child()
+		first_peer_meter = torrent_meter.add_child()
+		second_peer_meter = torrent_meter.add_child()
+
+		first_peer_meter.update(300, current_time=0)
+		second_peer_meter.update(200, current_time=0)
+		self.assertEqual(300, first_peer_meter.total)
+		self.assertEqual(500, torrent_meter.total)
+		self.assertEqual(500, client_meter.total)
+		self.assertEqual(100, client_meter.get_window_rate(current_time=0))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+from bitarray import bitarray
+from coast.recheck import Recheck
+from coast.filemap import FileMap
+from coast.storage import PieceDirStorage, FileStorage
+from coast.packstorage import PackStorage
+from test.test_data import StorageTestCase, test_storage_piece_length
+
+
+class SimulatedTorrent:
+	def __init__(self, storage, pieces_hashes):
+		self.storage = storage
+		self.pieces_hashes = pieces_hashes
+		self.bitfield = bitarray(len(pieces_hashes), endian="big")
+		self.bitfield.setall(False)
+
+
+def write_piece(storage, index, data):
+	with open(storage.get_piece_path(index), "wb") as piece_file:
+		piece_file.write(data)
+
+
+class RecheckTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		storage = PieceDirStorage(FileMap([(["data"], 20 * 1000)], 1000, self.directory), self.directory)
+		self.torrent = SimulatedTorrent(storage, [hashlib.sha1(chr(index) * 1000).digest() for index in range(20)])
+		for index in range(0, 20, 2):
+			write_piece(storage, index, chr(index) * 1000)
+		write_piece(storage, 5, "corrupt")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def check_results(self):
+		self.assertEqual([index % 2 == 0 for index in range(20)], self.torrent.bitfield.tolist())
+		self.assertFalse(os.path.exists(self.torrent.storage.get_piece_path(5)))
+
+	def test_serial_recheck(self):
+		self.assertTrue(Recheck(self.torrent, processes=1).run())
+		self.check_results()
+
+	def test_parallel_recheck(self):
+		progress = []
+		recheck = Recheck(self.torrent, processes=2, chunk_pieces=3)
+		self.assertTrue(recheck.run(lambda checked, total: progress.append((checked, total))))
+		self.check_results()
+		self.assertEqual((11, 11), progress[-1])
+		self.assertEqual(4, len(progress))
+		self.assertEqual(100.0, recheck.get_progress())
+
+	def test_cancelled_recheck(self):
+		recheck = Recheck(self.torrent, processes=2, chunk_pieces=3)
+		self.assertFalse(recheck.run(lambda checked, total: recheck.cancel()))
+		self.assertEqual(3, recheck.pieces_checked)
+
+	def test_unreadable_piece(self):
+		# a piece that can't be read is missing, it doesn't stop the recheck
+		os.mkdir(self.torrent.storage.get_piece_path(7))
+		self.assertTrue(Recheck(self.torrent, processes=2, chunk_pieces=3).run())
+		self.assertFalse(self.torrent.bitfield[7])
+		self.check_results()
+
+
+class BackendRecheckTests(StorageTestCase):
+	def check_storage(self, storage):
+		pieces_hashes = [hashlib.sha1(self.data[start:start + test_storage_piece_length]).digest()
+						 for start in range(0, len(self.data), test_storage_piece_length)]
+		torrent = SimulatedTorrent(storage, pieces_hashes)
+		recheck = Recheck(torrent, processes=2, chunk_pieces=1)
+		self.assertTrue(recheck.run())
+		self.assertEqual(3, recheck.pieces_checked)
+		return torrent.bitfield.tolist()
+
+	def test_file_storage(self):
+		storage = FileStorage(self.build_file_map(), self.directory)
+		storage.write_block(0, 0, self.data)
+		# piece 1 spans dir/b, which is corrupted
+		storage.write_block(1, 4, "corrupt")
+		storage.flush()
+		self.assertEqual([True, False, True], self.check_storage(storage))
+		storage.close()
+
+	def test_pack_storage(self):
+		storage = PackStorage(self.build_file_map(), self.directory)
+		storage.write_pieces(0, self.data[:32])
+		storage.write_piece(2, "corrupt!")
+		storage.flush()
+		self.assertEqual([True, True, False], self.check_storage(storage))
+		self.assertFalse(storage.has_piece(2))
+		storage.close()
+
+
+if __name__ == "__main__":
+	unittest.main()
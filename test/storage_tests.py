@@ -0,0 +1,91 @@
+import os
+import shutil
+import unittest
+from coast.storage import PieceDirStorage, FileStorage, MemoryStorage
+from coast.mmapstorage import MmapStorage
+from coast.packstorage import PackStorage
+from test.test_data import StorageTestCase
+
+
+class StorageTests(StorageTestCase):
+	def test_backends_are_interchangeable(self):
+		for backend in (PieceDirStorage, FileStorage, MmapStorage, PackStorage, MemoryStorage):
+			file_map = self.build_file_map()
+			storage = backend(file_map, self.directory)
+			self.assertFalse(storage.has_piece(1))
+			storage.write_piece(0, self.data[:16])
+			storage.write_block(1, 8, self.data[24:32])
+			storage.write_block(1, 0, self.data[16:24])
+			self.assertTrue(storage.has_piece(1), backend.__name__)
+			self.assertEqual(self.data[8:24], storage.read_block(0, 8, 8) + storage.read_block(1, 0, 8))
+			self.assertEqual(self.data[16:32], storage.read_piece(1))
+			self.assertEqual(None, storage.read_block(2, 0, 8))
+
+			# the short last piece
+			storage.write_piece(2, self.data[32:])
+			self.assertEqual(8, file_map.get_piece_length(2))
+			self.assertTrue(storage.has_piece(2), backend.__name__)
+			self.assertEqual(self.data[32:], storage.read_piece(2), backend.__name__)
+			self.assertEqual(None, storage.read_block(2, 4, 8))
+			storage.finalize([0, 1, 2])
+			storage.close()
+			if storage.persistent:
+				with open(os.path.join(self.directory, "dir", "b"), "rb") as b_file:
+					self.assertEqual(self.data[10:35], b_file.read(), backend.__name__)
+			shutil.rmtree(self.directory)
+			os.mkdir(self.directory)
+
+	def test_piece_dir_storage(self):
+		storage = PieceDirStorage(self.build_file_map(), self.directory)
+		storage.write_piece(0, self.data[:16])
+		self.assertTrue(os.path.isfile(os.path.join(self.directory, "tmp", "00000000.piece")))
+		self.assertEqual({0}, storage.unsynced_pieces)
+		storage.flush()
+		self.assertEqual(set(), storage.unsynced_pieces)
+		fingerprint = storage.get_fingerprint()
+		self.assertEqual(["tmp/00000000.piece"], [name for name, size, mtime in fingerprint])
+		# a piece file changed in place leaves tmp/ alone, but not the fingerprint
+		os.utime(storage.get_piece_path(0), (1, 1))
+		self.assertNotEqual(fingerprint, storage.get_fingerprint())
+		storage.remove_piece(0)
+		self.assertFalse(storage.has_piece(0))
+		self.assertEqual([], storage.get_fingerprint())
+
+	def test_piece_dir_assembly(self):
+		storage = PieceDirStorage(self.build_file_map(), self.directory)
+		for index in (2, 0):
+			storage.write_piece(index, self.data[index * 16:index * 16 + 16])
+		# the pieces to assemble come from the bitfield, not from the files in tmp/
+		self.assertRaises(IOError, storage.finalize, [0, 1, 2])
+		storage.write_piece(1, self.data[16:32])
+		with open(os.path.join(storage.directory, "leftover.iso"), "wb") as leftover_file:
+			leftover_file.write("stale")
+
+		storage.finalize([0, 1, 2])
+		self.assertEqual(3, storage.assembly_done)
+		self.assertFalse(os.path.exists(storage.directory))
+		with open(os.path.join(self.directory, "dir", "b"), "rb") as b_file:
+			self.assertEqual(self.data[10:35], b_file.read())
+
+	def test_preallocation(self):
+		file_map = self.build_file_map()
+		file_map.skipped_files = {1}
+		storage = FileStorage(file_map, self.directory)
+		self.assertEqual(15, storage.get_required_bytes())
+		self.assertEqual(2, storage.preallocate())
+		self.assertEqual(5, os.path.getsize(os.path.join(self.directory, "c")))
+		self.assertFalse(os.path.exists(os.path.join(self.directory, "dir", "b")))
+		self.assertEqual(0, storage.get_required_bytes())
+		# allocated files are left alone
+		self.assertEqual(0, storage.preallocate())
+
+	def test_memory_storage_is_not_persistent(self):
+		storage = MemoryStorage(self.build_file_map(), self.directory)
+		storage.write_piece(0, self.data[:16])
+		self.assertEqual([], os.listdir(self.directory))
+		self.assertEqual([], storage.get_fingerprint())
+		self.assertFalse(storage.persistent)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,5 +1,9 @@
 import os
+import shutil
+import tempfile
+import unittest
 from coast.helpermethods import one_directory_back
+from coast.filemap import FileMap
 from coast.torrent import Torrent
 from coast.messages import BitfieldMessage
 
@@ -2039,3 +2043,26 @@ test_bitfield_unchoke_miss = "\x00\x00\x01\x7d\x05\xff\xff\xff\xff\xff\xff\xff\x
 							 "\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff" \
 							 "\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff" \
 							 "\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00\x00\x00\x01\x01"
+
+
+# a small torrent for the storage backends: 40 bytes over three files (one in a directory) in 16
+# byte pieces, so pieces 0 and 1 span files and the last piece is only 8 bytes long
+test_storage_files = [(["a"], 10), (["dir", "b"], 25), (["c"], 5)]
+test_storage_piece_length = 16
+test_storage_data = "".join(chr(ord("a") + i % 26) for i in range(40))
+
+
+class StorageTestCase(unittest.TestCase):
+	"""
+	Gives each test a temporary download directory and the storage test torrent's data
+	"""
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.data = test_storage_data
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def build_file_map(self):
+		return FileMap(test_storage_files, test_storage_piece_length, self.directory)
+
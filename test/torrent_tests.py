@@ -1,12 +1,60 @@
 import os
+import time
+import errno
+import hashlib
+import shutil
+import tempfile
+import numpy
 import urllib
 import unittest
+import threading
+from twisted.internet import defer
 
+from coast import bencode
 from coast.peer import Peer
+from coast.piece import Piece
+from coast import torrent as torrent_module
 from coast.torrent import Torrent
-from coast.constants import ERROR_BYTESTRING_CHUNKSIZE
+from coast.messages import BitfieldMessage, ChokeMessage, UnchokeMessage, PieceMessage, RequestMessage, CancelMessage, \
+	StreamProcessor
+from coast.constants import ERROR_BYTESTRING_CHUNKSIZE, MAX_OUTSTANDING_REQUESTS, REQUEST_TIMEOUT, REQUEST_SIZE, \
+	FILE_PRIORITY_SKIP, FILE_PRIORITY_HIGH, STORAGE_MMAP, STORAGE_FILES, \
+	STORAGE_PACK, STORAGE_MEMORY, ACTIVITY_CHECKING
 from coast.helpermethods import one_directory_back, convert_int_to_hex
-from test.test_data import test_torrent
+from test.test_data import test_torrent, test_torrent_file_path, test_peer_id, test_port, test_peer_chunk, \
+	test_bitfield
+
+multiple_file_data = "".join(chr(i) for i in range(60))
+
+
+class InlineThreads:
+	"""
+	Stands in for twisted.internet.threads in the torrent module, running what would go to a
+	thread in place
+	"""
+	def deferToThread(self, function, *args):
+		return defer.maybeDeferred(function, *args)
+
+
+def write_multiple_file_torrent(directory):
+	"""
+	Writes a .torrent with three files (10, 30 and 20 bytes) in 16 byte pieces
+	"""
+	metainfo_path = os.path.join(directory, "multi.torrent")
+	files = [{"path": ["first"], "length": 10}, {"path": ["sub", "second"], "length": 30}, {"path": ["third"], "length": 20}]
+	pieces = "".join(hashlib.sha1(multiple_file_data[i:i + 16]).digest() for i in range(0, 60, 16))
+	with open(metainfo_path, "wb") as metainfo_file:
+		metainfo_file.write(bencode.bencode({"announce": "http://tracker.invalid/announce", "info": {
+			"name": "coast-multiple-file-test", "piece length": 16, "pieces": pieces, "files": files}}))
+	return metainfo_path
+
+
+def write_multiple_file_pieces(torrent, indices):
+	for index in indices:
+		piece_path = os.path.join(torrent.temporary_download_location, "{}.piece".format(str(index).zfill(8)))
+		with open(piece_path, "wb") as piece_file:
+			piece_file.write(multiple_file_data[index * 16:index * 16 + 16])
+		torrent.bitfield[index] = 1
 
 
 class TestTorrent(unittest.TestCase):
@@ -194,5 +242,415 @@ class TestTorrent(unittest.TestCase):
 		#test_torrent.remove_active_peer()
 
 	def test_compile_file_from_pieces(self):
-		test_torrent.temporary_download_location = os.path.join(one_directory_back(os.getcwd()), "test/", test_torrent.torrent_name, "tmp/")
+		test_torrent.storage.directory = os.path.join(one_directory_back(os.getcwd()), "test/", test_torrent.torrent_name, "tmp/")
 		test_torrent.compile_file_from_pieces(preserve_tmp=True)
+
+	def test_reclaim_requests_on_choke(self):
+		reclaim_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		choking_peer = Peer(reclaim_torrent, test_peer_chunk)
+		choking_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		choking_peer.am_interested = 1
+		choking_peer.process_unchoke_message(UnchokeMessage())
+		reclaim_torrent.process_next_round(choking_peer)
+		self.assertEqual(MAX_OUTSTANDING_REQUESTS, len(choking_peer.get_next_messages()))
+		reclaimed_piece = choking_peer.current_piece
+
+		choking_peer.process_choke_message(ChokeMessage())
+		reclaim_torrent.process_next_round(choking_peer)
+		self.assertEqual(None, choking_peer.current_piece)
+		self.assertEqual(MAX_OUTSTANDING_REQUESTS, reclaim_torrent.reclaimed_blocks["choke"])
+		self.assertEqual(0, reclaimed_piece.get_next_begin())
+
+		# another peer picks up the reclaimed blocks straight away
+		helping_peer = Peer(reclaim_torrent, test_peer_chunk)
+		helping_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		helping_peer.am_interested = 1
+		helping_peer.process_unchoke_message(UnchokeMessage())
+		reclaim_torrent.process_next_round(helping_peer)
+		self.assertEqual(0, helping_peer.get_next_messages()[0].get_begin())
+		self.assertTrue(helping_peer.current_piece is reclaimed_piece)
+
+	def test_reclaim_timed_out_requests(self):
+		reclaim_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		silent_peer = Peer(reclaim_torrent, test_peer_chunk)
+		silent_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		silent_peer.am_interested = 1
+		silent_peer.process_unchoke_message(UnchokeMessage())
+		reclaim_torrent.active_peers.append(silent_peer)
+		reclaim_torrent.process_next_round(silent_peer)
+		silent_peer.get_next_messages()
+
+		reclaim_torrent.reclaim_timed_out_requests(current_time=time.time())
+		self.assertEqual(0, reclaim_torrent.reclaimed_blocks["timeout"])
+
+		# only the request that is late is reclaimed
+		late_request = silent_peer.request_buffer[0]
+		late_request.deadline = time.time() - 1
+		reclaim_torrent.reclaim_timed_out_requests(current_time=time.time())
+		self.assertEqual(1, reclaim_torrent.reclaimed_blocks["timeout"])
+		self.assertEqual(MAX_OUTSTANDING_REQUESTS - 1, len(silent_peer.request_buffer))
+		self.assertFalse(late_request in silent_peer.request_buffer)
+		self.assertTrue(silent_peer.current_piece is not None)
+
+		reclaim_torrent.reclaim_timed_out_requests(current_time=time.time() + REQUEST_TIMEOUT + 1)
+		self.assertEqual(MAX_OUTSTANDING_REQUESTS, reclaim_torrent.reclaimed_blocks["timeout"])
+		self.assertEqual(0, len(silent_peer.request_buffer))
+
+	def test_peers_share_partial_piece(self):
+		shared_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		shared_peers = []
+		for peer_number in range(2):
+			shared_peer = Peer(shared_torrent, test_peer_chunk)
+			shared_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+			shared_peer.am_interested = 1
+			shared_peer.process_unchoke_message(UnchokeMessage())
+			shared_peers.append(shared_peer)
+
+		slow_requests = shared_peers[0].get_next_messages()
+		fast_requests = shared_peers[1].get_next_messages()
+
+		# the second peer helps with the started piece instead of opening a new one
+		self.assertEqual(1, len(shared_torrent.partial_pieces))
+		self.assertEqual(set([0]), set(request.get_index() for request in slow_requests + fast_requests))
+		requested_begins = [request.get_begin() for request in slow_requests + fast_requests]
+		self.assertEqual(len(requested_begins), len(set(requested_begins)))
+
+	def test_rarest_piece_requested_first(self):
+		rarest_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		seed_peer = Peer(rarest_torrent, test_peer_chunk)
+		seed_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		common_peer = Peer(rarest_torrent, test_peer_chunk)
+		piece_count = len(rarest_torrent.pieces_hashes)
+		common_peer.process_bitfield_message(BitfieldMessage(bitfield="\xff" * (piece_count / 8 - 1)))
+		self.assertEqual([seed_peer], rarest_torrent.availability_matrix.peers_with_piece(piece_count - 1))
+
+		# only the seed has the last eight pieces, so those are started first
+		rarest_piece = rarest_torrent.get_next_piece_for_download(seed_peer)
+		self.assertEqual(piece_count - 8, rarest_piece.get_index())
+
+		rarest_torrent.availability_matrix.remove_peer(seed_peer)
+		self.assertEqual(None, rarest_torrent.get_next_piece_for_download(seed_peer))
+
+	def test_resume_without_recheck(self):
+		resume_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		try:
+			resume_torrent.bitfield[5] = 1
+			partial_piece = Piece(resume_torrent.metadata["piece_length"], 7, resume_torrent.pieces_hashes[7])
+			partial_piece.restore_block(REQUEST_SIZE, "B" * REQUEST_SIZE)
+			resume_torrent.partial_pieces[7] = partial_piece
+			resume_torrent.save_resume_data()
+
+			resumed_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+			self.assertTrue(resumed_torrent.bitfield[5])
+			self.assertEqual(1, resumed_torrent.bitfield.count(1))
+			self.assertEqual([(REQUEST_SIZE, "B" * REQUEST_SIZE)], resumed_torrent.partial_pieces[7].get_completed_blocks())
+			self.assertEqual(0, resumed_torrent.partial_pieces[7].get_next_begin())
+
+			# a piece file written after the resume file makes it stale, so the pieces are rechecked
+			bad_piece_path = os.path.join(resume_torrent.temporary_download_location, "00000009.piece")
+			with open(bad_piece_path, "w") as bad_piece_file:
+				bad_piece_file.write("not the piece")
+			rechecked_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+			self.assertTrue(rechecked_torrent.recheck_needed)
+			self.assertTrue(os.path.exists(bad_piece_path))
+
+			# the recheck runs on a thread once the torrent is started, downloading starts after it
+			started = []
+			rechecked_torrent.start_downloading = lambda: started.append(rechecked_torrent.activity_status)
+			real_threads = torrent_module.threads
+			torrent_module.threads = InlineThreads()
+			try:
+				rechecked_torrent.start_checking()
+			finally:
+				torrent_module.threads = real_threads
+			self.assertEqual([ACTIVITY_CHECKING], started)
+			self.assertFalse(rechecked_torrent.recheck_needed)
+			self.assertFalse(rechecked_torrent.bitfield.any())
+			self.assertFalse(os.path.exists(bad_piece_path))
+		finally:
+			resume_torrent.resume_file.remove()
+
+	def test_multiple_file_mode(self):
+		metainfo_directory = tempfile.mkdtemp()
+		multi_torrent = Torrent(test_peer_id, test_port, write_multiple_file_torrent(metainfo_directory))
+		try:
+			self.assertEqual(60, multi_torrent.tracker_request["left"])
+			self.assertEqual(4, len(multi_torrent.bitfield))
+			write_multiple_file_pieces(multi_torrent, range(4))
+
+			# the write queue is drained where start_assembly is called, never on the assembly thread
+			drains = []
+			queue_drain = multi_torrent.write_queue.drain
+			multi_torrent.write_queue.drain = lambda: drains.append(threading.current_thread()) or queue_drain()
+			multi_torrent.start_assembly().join()
+			self.assertEqual([threading.current_thread()], drains)
+			self.assertEqual(100.0, multi_torrent.storage.get_assembly_progress())
+			for path, start, end in [(["first"], 0, 10), (["sub", "second"], 10, 40), (["third"], 40, 60)]:
+				with open(os.path.join(multi_torrent.download_root, *path), "rb") as output_file:
+					self.assertEqual(multiple_file_data[start:end], output_file.read())
+
+			# tmp/ is gone, the resume file fingerprints the compiled files instead
+			multi_torrent.save_resume_data()
+			self.assertEqual(["first", "sub/second", "third"],
+				[name for name, size, mtime in multi_torrent.resume_file.load()["fingerprint"]])
+		finally:
+			shutil.rmtree(multi_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_skipped_files(self):
+		metainfo_directory = tempfile.mkdtemp()
+		multi_torrent = Torrent(test_peer_id, test_port, write_multiple_file_torrent(metainfo_directory))
+		try:
+			multi_torrent.set_file_priority(1, FILE_PRIORITY_SKIP)
+			# piece 1 lies wholly inside the skipped file, pieces 0 and 2 share it with wanted files
+			self.assertEqual([True, False, True, True], multi_torrent.get_wanted_pieces().tolist())
+
+			multi_torrent.set_file_priority(2, FILE_PRIORITY_HIGH)
+			peer = Peer(multi_torrent, test_peer_chunk)
+			multi_torrent.availability_matrix.set_bitfield(peer, chr(0xf0))
+			self.assertEqual(2, multi_torrent.get_next_piece_for_download(peer).get_index())
+
+			# progress counts the wanted bytes only: 16 of 16 + 16 + 12
+			write_multiple_file_pieces(multi_torrent, [0])
+			self.assertAlmostEqual(100 * 16 / 44.0, multi_torrent.get_progress())
+
+			multi_torrent.compile_file_from_pieces()
+			self.assertFalse(os.path.exists(os.path.join(multi_torrent.download_root, "sub", "second")))
+			with open(os.path.join(multi_torrent.download_root, "first"), "rb") as first_file:
+				self.assertEqual(multiple_file_data[:10], first_file.read())
+		finally:
+			shutil.rmtree(multi_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_storage_allocation(self):
+		metainfo_directory = tempfile.mkdtemp()
+		file_torrent = Torrent(test_peer_id, test_port, write_multiple_file_torrent(metainfo_directory),
+							   storage_mode=STORAGE_FILES)
+		try:
+			# the files are allocated when the torrent is started, not when it is added
+			self.assertFalse(os.path.exists(os.path.join(file_torrent.download_root, "sub", "second")))
+			file_torrent.allocate_storage()
+			self.assertEqual(30, os.path.getsize(os.path.join(file_torrent.download_root, "sub", "second")))
+			allocated_bytes, written_bytes = file_torrent.get_disk_usage()
+			self.assertTrue(allocated_bytes >= 60)
+			self.assertEqual(0, written_bytes)
+			self.assertEqual(0, file_torrent.storage.get_required_bytes())
+			file_torrent.storage.close()
+
+			# a torrent that doesn't fit on the disk fails before anything is written
+			huge_metainfo_path = os.path.join(metainfo_directory, "huge.torrent")
+			with open(huge_metainfo_path, "wb") as metainfo_file:
+				metainfo_file.write(bencode.bencode({"announce": "http://tracker.invalid/announce", "info": {
+					"name": "coast-huge-test", "piece length": 2 ** 40, "pieces": "\x00" * 20 * 1024,
+					"length": 2 ** 50}}))
+			huge_torrent = Torrent(test_peer_id, test_port, huge_metainfo_path)
+			with self.assertRaises(IOError) as context:
+				huge_torrent.allocate_storage()
+			self.assertEqual(errno.ENOSPC, context.exception.errno)
+		finally:
+			shutil.rmtree(file_torrent.download_root)
+			shutil.rmtree(os.path.join(os.path.dirname(file_torrent.download_root), "coast-huge-test"), ignore_errors=True)
+			shutil.rmtree(metainfo_directory)
+
+	def test_short_last_piece(self):
+		metainfo_directory = tempfile.mkdtemp()
+		metainfo_path = write_multiple_file_torrent(metainfo_directory)
+		short_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_MEMORY)
+		try:
+			# 60 bytes in 16 byte pieces, the last one is 12 bytes long
+			self.assertEqual([16, 16, 16, 12], short_torrent.piece_lengths.tolist())
+			piece = short_torrent.start_piece(3)
+			self.assertEqual(12, piece.piece_length)
+			begin = piece.get_next_begin()
+			request = RequestMessage(index=3, begin=begin, length=piece.get_block_length(begin))
+			self.assertEqual(12, request.get_length())
+			piece.add_non_completed_request_index(request)
+			self.assertEqual(None, piece.get_next_begin())
+
+			# the short block is recognised on the wire
+			stream_processor = StreamProcessor(short_torrent)
+			stream_processor.parse_stream(PieceMessage(index=3, begin=0, block=multiple_file_data[48:]).message())
+			block_message = stream_processor.get_complete_messages()[0]
+			self.assertTrue(request.piece_message_matches_request(block_message))
+
+			piece.append_data(block_message)
+			self.assertTrue(piece.is_complete)
+			self.assertTrue(piece.data_matches_hash())
+			short_torrent.save_completed_peer_piece_to_disk(piece)
+			self.assertEqual(multiple_file_data[48:], short_torrent.read_block(3, 0, 12))
+		finally:
+			shutil.rmtree(short_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_read_at_reads_on_reactor(self):
+		class FakeThreads:
+			in_reactor = False
+
+			def blockingCallFromThread(self, reactor, function):
+				results = []
+				FakeThreads.in_reactor = True
+				function().addBoth(results.append)
+				FakeThreads.in_reactor = False
+				return results[0]
+
+		metainfo_directory = tempfile.mkdtemp()
+		metainfo_path = write_multiple_file_torrent(metainfo_directory)
+		streaming_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_MEMORY)
+		queue_read_block = streaming_torrent.write_queue.read_block
+		reads = []
+
+		def read_block(index, begin, length):
+			reads.append(FakeThreads.in_reactor)
+			return queue_read_block(index, begin, length)
+
+		streaming_torrent.write_queue.read_block = read_block
+		real_threads = torrent_module.threads
+		torrent_module.threads = FakeThreads()
+		try:
+			for index in range(2):
+				piece = streaming_torrent.start_piece(index)
+				piece.data = list(multiple_file_data[index * 16:index * 16 + 16])
+				streaming_torrent.save_completed_peer_piece_to_disk(piece)
+			self.assertEqual(multiple_file_data[4:30], streaming_torrent.read_at(4, 26))
+			self.assertEqual([True, True], reads)
+		finally:
+			torrent_module.threads = real_threads
+			shutil.rmtree(streaming_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_mapped_storage(self):
+		metainfo_directory = tempfile.mkdtemp()
+		metainfo_path = write_multiple_file_torrent(metainfo_directory)
+		mapped_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_MMAP)
+		try:
+			for index in range(4):
+				piece = mapped_torrent.start_piece(index)
+				piece.data = list(multiple_file_data[index * 16:index * 16 + 16])
+				mapped_torrent.save_completed_peer_piece_to_disk(piece)
+			self.assertEqual(multiple_file_data[8:24], mapped_torrent.read_block(0, 8, 16))
+			self.assertEqual(multiple_file_data[48:], mapped_torrent.read_block(3, 0, 12))
+
+			# the pieces are written to the torrent's files, no compiling needed
+			mapped_torrent.compile_file_from_pieces()
+			with open(os.path.join(mapped_torrent.download_root, "sub", "second"), "rb") as second_file:
+				self.assertEqual(multiple_file_data[10:40], second_file.read())
+
+			mapped_torrent.save_resume_data()
+			mapped_torrent.storage.close()
+			self.assertEqual(4, Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_MMAP).bitfield.count(1))
+			mapped_torrent.resume_file.remove()
+			rechecked_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_MMAP)
+			self.assertTrue(rechecked_torrent.recheck_needed)
+			self.assertTrue(rechecked_torrent.recheck_existing_pieces())
+			self.assertEqual(4, rechecked_torrent.bitfield.count(1))
+			rechecked_torrent.storage.close()
+		finally:
+			shutil.rmtree(mapped_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_pack_storage(self):
+		metainfo_directory = tempfile.mkdtemp()
+		metainfo_path = write_multiple_file_torrent(metainfo_directory)
+		pack_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_PACK)
+		try:
+			for index in [3, 0, 1]:
+				piece = pack_torrent.start_piece(index)
+				piece.data = list(multiple_file_data[index * 16:index * 16 + 16])
+				pack_torrent.save_completed_peer_piece_to_disk(piece)
+			pack_torrent.write_queue.flush()
+			pack_torrent.storage.close()
+
+			# without a resume file the pieces are taken from the pack's index
+			pack_torrent.resume_file.remove()
+			resumed_torrent = Torrent(test_peer_id, test_port, metainfo_path, storage_mode=STORAGE_PACK)
+			self.assertEqual([True, True, False, True], resumed_torrent.bitfield.tolist())
+			self.assertEqual(multiple_file_data[48:], resumed_torrent.read_block(3, 0, 12))
+
+			piece = resumed_torrent.start_piece(2)
+			piece.data = list(multiple_file_data[32:48])
+			resumed_torrent.save_completed_peer_piece_to_disk(piece)
+			resumed_torrent.compile_file_from_pieces()
+			with open(os.path.join(resumed_torrent.download_root, "sub", "second"), "rb") as second_file:
+				self.assertEqual(multiple_file_data[10:40], second_file.read())
+		finally:
+			shutil.rmtree(pack_torrent.download_root)
+			shutil.rmtree(metainfo_directory)
+
+	def test_streaming_deadlines(self):
+		streaming_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		piece_length = streaming_torrent.metadata["piece_length"]
+		peers = []
+		for peer_number in range(2):
+			peer = Peer(streaming_torrent, test_peer_chunk)
+			peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+			peer.process_unchoke_message(UnchokeMessage())
+			streaming_torrent.active_peers.append(peer)
+			peers.append(peer)
+
+		streaming_torrent.set_streaming(True, playback_cursor=5 * piece_length + 100)
+		self.assertEqual(range(5, 13), sorted(streaming_torrent.piece_deadlines))
+		self.assertTrue(streaming_torrent.piece_deadlines[5] < streaming_torrent.piece_deadlines[6])
+		piece, begin = streaming_torrent.get_next_block(peers[0])
+		self.assertEqual((5, 0), (piece.get_index(), begin))
+
+		# every block of piece 5 is out with the first peer and its deadline is close
+		for begin in range(0, piece_length, REQUEST_SIZE):
+			request = RequestMessage(index=5, begin=begin)
+			peers[0].request_buffer.append(request)
+			piece.add_non_completed_request_index(request)
+		streaming_torrent.piece_deadlines[5] = time.time() + 1
+
+		# so the second peer is asked for the same block...
+		piece, begin = streaming_torrent.get_next_block(peers[1])
+		self.assertEqual((5, 0), (piece.get_index(), begin))
+		request = RequestMessage(index=5, begin=0)
+		peers[1].request_buffer.append(request)
+		piece.add_non_completed_request_index(request)
+
+		# ...and when it answers first, the first peer's request is cancelled
+		peers[1].process_piece_message(PieceMessage(index=5, begin=0, block="A" * REQUEST_SIZE))
+		self.assertFalse(peers[0].has_request(5, 0))
+		self.assertTrue(isinstance(peers[0].outgoing_messages_buffer[-1], CancelMessage))
+		self.assertFalse(piece.non_completed_request_exists(request))
+
+	def test_wait_for_range(self):
+		waiting_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		piece_length = waiting_torrent.metadata["piece_length"]
+		finished = []
+		waiting_torrent.set_file_priority(0, FILE_PRIORITY_SKIP)
+		waiting_torrent.wait_for_range(7 * piece_length - 10, 20).addCallback(finished.append)
+		self.assertEqual([6, 7], sorted(waiting_torrent.piece_deadlines))
+		# the pieces a read waits for are wanted even in a skipped file
+		self.assertEqual([6, 7], numpy.flatnonzero(waiting_torrent.get_wanted_pieces()).tolist())
+
+		waiting_torrent.bitfield[7] = 1
+		waiting_torrent.notify_range_waiters(7)
+		self.assertEqual([], finished)
+		waiting_torrent.bitfield[6] = 1
+		waiting_torrent.notify_range_waiters(6)
+		self.assertEqual([None], finished)
+		self.assertEqual({}, waiting_torrent.piece_deadlines)
+
+	def test_request_pipeline_crosses_piece_boundary(self):
+		pipeline_torrent = Torrent(test_peer_id, test_port, test_torrent_file_path)
+		pipeline_peer = Peer(pipeline_torrent, test_peer_chunk)
+		pipeline_peer.process_bitfield_message(BitfieldMessage(data=test_bitfield))
+		pipeline_peer.am_interested = 1
+		pipeline_peer.process_unchoke_message(UnchokeMessage())
+		pipeline_torrent.active_peers.append(pipeline_peer)
+		pipeline_peer.get_next_messages()
+
+		blocks_per_piece = pipeline_torrent.metadata["piece_length"] / REQUEST_SIZE
+		for block_number in range(blocks_per_piece + MAX_OUTSTANDING_REQUESTS):
+			answered_request = pipeline_peer.request_buffer[0]
+			pipeline_peer.process_piece_message(PieceMessage(
+				index=answered_request.get_index(),
+				begin=answered_request.get_begin(),
+				block="A" * REQUEST_SIZE))
+			pipeline_peer.get_next_messages()
+			# the window is refilled straight away, even while the first piece is unverified
+			self.assertEqual(MAX_OUTSTANDING_REQUESTS, len(pipeline_peer.request_buffer))
+
+		self.assertTrue(pipeline_torrent.partial_pieces[0].is_complete)
+		self.assertEqual(1, pipeline_peer.current_piece.get_index())
+		self.assertEqual(0.0, pipeline_torrent.get_pipeline_idle_time())
@@ -0,0 +1,60 @@
+import unittest
+from coast.filemap import FileMap
+from coast.storage import MemoryStorage
+from coast.writequeue import WriteQueue
+
+
+class RecordingStorage(MemoryStorage):
+	"""
+	Keeps the runs it was asked to write
+	"""
+	def __init__(self, file_map):
+		MemoryStorage.__init__(self, file_map, "/nonexistent")
+		self.runs = []
+		self.flushes = 0
+
+	def write_pieces(self, index, data):
+		self.runs.append((index, len(data)))
+		MemoryStorage.write_pieces(self, index, data)
+
+	def flush(self):
+		self.flushes += 1
+
+
+class WriteQueueTests(unittest.TestCase):
+	def setUp(self):
+		# ten pieces of 16 bytes, the last one 8
+		self.storage = RecordingStorage(FileMap([(["a"], 152)], 16, "/nonexistent"))
+		self.data = "".join(chr(i) for i in range(152))
+
+	def put(self, queue, indices):
+		for index in indices:
+			queue.put(index, self.data[index * 16:index * 16 + 16])
+
+	def test_consecutive_pieces_are_coalesced(self):
+		queue = WriteQueue(self.storage, max_write=64)
+		self.put(queue, [9, 2, 0, 3, 1, 7, 4, 5])
+		self.assertEqual([], self.storage.runs)
+		self.assertEqual(self.data[33:40], queue.read_block(2, 1, 7))
+
+		queue.flush()
+		# 0 - 4 is cut at max_write, 9 is short but ends the torrent anyway
+		self.assertEqual([(0, 64), (4, 32), (7, 16), (9, 8)], self.storage.runs)
+		self.assertEqual(1, self.storage.flushes)
+		self.assertEqual({}, queue.pending)
+		self.assertEqual(self.data[64:96], self.storage.read_block(4, 0, 16) + self.storage.read_block(5, 0, 16))
+		self.assertEqual(self.data[33:40], queue.read_block(2, 1, 7))
+
+	def test_drains_at_max_dirty(self):
+		queue = WriteQueue(self.storage, max_dirty=48)
+		self.put(queue, [0, 5])
+		self.assertEqual(32, queue.dirty_bytes)
+		self.put(queue, [6])
+		self.assertEqual([(0, 16), (5, 32)], self.storage.runs)
+		self.assertEqual(0, queue.dirty_bytes)
+		# draining doesn't sync
+		self.assertEqual(0, self.storage.flushes)
+
+
+if __name__ == "__main__":
+	unittest.main()